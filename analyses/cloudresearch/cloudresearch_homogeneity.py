@@ -1,64 +1,65 @@
 # Use a sentence embedding model to find the semantic similarity of ideas within each experimental condition
 
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-import numpy as np
 import os
-import scipy.stats as stats
 
-
-# Load the sentence transformer model
-model = SentenceTransformer('all-MiniLM-L6-v2')
-
-# Load the data
-
-data_path = '~/Git_Projects/idea_generation/data/ideas_for_homogeneity_analysis.csv'  # Update with your actual data path
-df = pd.read_csv(data_path)
-
-# For each combination of experimental condition, object, and submitter_id, compute the semantic similarity of ideas
-results = []
-for (Condition, obj, submitter_id), group in df.groupby(['Condition', 'object', 'submitter_id']):
-    ideas = group['use'].tolist()
-
-    # Compute embeddings
-    embeddings = model.encode(ideas)
-
-    # Compute cosine similarity matrix
-    norm_embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
-    similarity_matrix = np.dot(norm_embeddings, norm_embeddings.T)
-
-    # Extract upper triangle of the similarity matrix, excluding the diagonal
-    upper_tri_indices = np.triu_indices_from(similarity_matrix, k=1)
-    similarities = similarity_matrix[upper_tri_indices]
-
-    # Store results
-    for sim in similarities:
-        results.append({
-            'condition': Condition,
-            'object': obj,
-            'submitter_id': submitter_id,
-            'similarity': sim
-        })
-
-# Convert results to DataFrame
-results_df = pd.DataFrame(results)
-
-# Save results to CSV
-output_path = os.path.expanduser('~/Git_Projects/idea_generation/data/cloudresearch_homogeneity.csv')  # Update with your desired output path
-results_df.to_csv(output_path, index=False)
-
-# Compute mean and standard deviation of similarities for each condition
-summary = results_df.groupby('condition')['similarity'].agg(['mean', 'std'])
-
-# Display summary statistics
-print(summary)
-
-# Save summary statistics to CSV
-# summary_output_path = os.path.expanduser('~/Git_Projects/idea_generation/data/compliant_semantic_similarity_summary.csv')  # Update with your desired output path
-# summary.to_csv(summary_output_path)
-
-# Run a simple ANOVA to see if there are significant differences between conditions
-anova_results = stats.f_oneway(*(group['similarity'].values for name, group in results_df.groupby('condition')))
-print("ANOVA results:")
-print(f"F-statistic: {anova_results.statistic}")
-print(f"P-value: {anova_results.pvalue}")
+from analyses.iriss.embedding_store import embed_column
+from analyses.iriss.parallel_groups import group_positions, parallel_group_similarities
+from analyses.iriss.pairwise_output import PairwiseWriter, SimilaritySummary
+
+
+# Guarded so that worker processes started by the process pool do not rerun the analysis
+if __name__ == '__main__':
+    # Load the data
+
+    data_path = '~/Git_Projects/idea_generation/data/ideas_for_homogeneity_analysis.csv'  # Update with your actual data path
+    df = pd.read_csv(data_path)
+
+    # Embed the whole corpus once (duplicates and cached ideas are not re-encoded), then slice per group
+    batch_size = 256  # Lower this if encoding runs out of memory
+    all_embeddings = embed_column(df, 'use', normalization='none', batch_size=batch_size)
+
+    # Pairs are streamed to disk per group; use a '.parquet' path for columnar output with categorical
+    # condition/object columns. Set write_pairs = False to only compute the summary statistics.
+    write_pairs = True
+    output_path = os.path.expanduser('~/Git_Projects/idea_generation/data/cloudresearch_homogeneity.csv')  # Update with your desired output path
+    writer = PairwiseWriter(output_path) if write_pairs else None
+    similarity_summary = SimilaritySummary('condition')
+    n_workers = os.cpu_count()  # Set to 1 to run on a single core
+
+    # For each combination of experimental condition, object, and submitter_id, compute the semantic similarity of ideas
+    grouping = ['Condition', 'object', 'submitter_id']
+    group_keys, groups = group_positions(df, grouping)
+
+    # Groups are independent, so their similarities are computed on a process pool; workers read
+    # the embeddings from shared memory and results come back one group at a time, in group order
+    for group_index, similarities in parallel_group_similarities(all_embeddings, groups, n_workers=n_workers):
+        Condition, obj, submitter_id = group_keys[group_index]
+        # Store results
+        similarity_summary.add(Condition, similarities)
+        if writer is not None:
+            writer.write({
+                'condition': Condition,
+                'object': obj,
+                'submitter_id': submitter_id,
+                'similarity': similarities
+            })
+
+    if writer is not None:
+        writer.close()
+
+    # Compute mean and standard deviation of similarities for each condition
+    summary = similarity_summary.summary()
+
+    # Display summary statistics
+    print(summary)
+
+    # Save summary statistics to CSV
+    # summary_output_path = os.path.expanduser('~/Git_Projects/idea_generation/data/compliant_semantic_similarity_summary.csv')  # Update with your desired output path
+    # summary.to_csv(summary_output_path)
+
+    # Run a simple ANOVA to see if there are significant differences between conditions
+    f_statistic, p_value = similarity_summary.anova()
+    print("ANOVA results:")
+    print(f"F-statistic: {f_statistic}")
+    print(f"P-value: {p_value}")
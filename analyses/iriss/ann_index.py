@@ -0,0 +1,351 @@
+# Approximate nearest-neighbor index over idea embeddings.
+# An inverted-file (IVF) index: a spherical k-means quantizer splits the unit-normalized embeddings
+# into n_lists cells, and every idea is stored in the list of its nearest cell centroid. A query only
+# scores the ideas in its n_probe closest cells, so "which ideas are within distance eps of this one"
+# costs roughly O(N * n_probe / n_lists) per query instead of O(N). Queries are processed one list at
+# a time, with every query that probes the list scored in a single matrix product.
+#
+# Each idea can carry an integer filter code (e.g. its condition-object pair); queries can then be
+# restricted to neighbors with the same code.
+#
+# The index stores the quantizer and the inverted lists, not the vectors: it is saved to .npz with a
+# content hash of the embeddings and reopened on top of the memory-mapped embedding matrix written by
+# embeddings.py, which must hash the same.
+#
+# Usage (from the repository root):
+#     python -m analyses.iriss.ann_index --data data/evaluated_compliant_ideas.csv \
+#         --embeddings data/evaluated_compliant_ideas_embeddings.npy --radius 0.2
+import argparse
+import re
+
+import numpy as np
+
+from analyses.iriss.embedding_store import hash_embeddings
+
+# Queries scored per matrix product; bounds the size of the (queries x list members) block
+_QUERY_CHUNK = 4096
+
+# Leading words that do not change the meaning of a short idea ("a paperweight" == "paperweight")
+_FILLER_PREFIX = re.compile(r'^(?:(?:a|an|the|use it as|use as|as|to)\s+)+')
+_NON_WORD = re.compile(r'[^\w\s]+')
+
+
+def _unit(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+def _spherical_kmeans(vectors, n_clusters, n_iter, rng):
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = ~np.any(sums, axis=1)
+        # Reseed empty cells with random points so every list stays in use
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = _unit(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index for cosine similarity search.
+
+    Args:
+        embeddings (np.ndarray): Array of shape (n, dim); may be a read-only memmap
+        centroids (np.ndarray): Unit-normalized cell centroids of shape (n_lists, dim)
+        list_offsets (np.ndarray): Start of each cell in list_members (with the end as last element)
+        list_members (np.ndarray): Row positions sorted by cell
+        codes (np.ndarray, optional): Integer filter code per row (e.g. condition-object pair); -1 = none
+        n_probe (int): Cells scored per query by default
+    """
+
+    def __init__(self, embeddings, centroids, list_offsets, list_members, codes=None, n_probe=8):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_members = list_members
+        self.codes = None if codes is None else np.asarray(codes, dtype=np.int64)
+        self.n_probe = n_probe
+
+    @classmethod
+    def build(cls, embeddings, codes=None, n_lists=None, n_probe=8, n_iter=10, train_size=50_000, seed=42):
+        """
+        Train the quantizer on a sample of the embeddings and fill the inverted lists.
+
+        Args:
+            embeddings (np.ndarray): Array of shape (n, dim)
+            codes (array-like, optional): Integer filter code per row
+            n_lists (int, optional): Number of cells (defaults to about 4 * sqrt(n))
+            n_probe (int): Cells scored per query by default
+            n_iter (int): k-means iterations
+            train_size (int): Rows sampled to train the quantizer
+            seed (int): Seed for the training sample and the initial centroids
+
+        Returns:
+            IVFIndex: The built index
+        """
+        n = len(embeddings)
+        n_lists = min(n, n_lists or max(1, int(4 * np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(n, min(n, max(train_size, n_lists)), replace=False)
+        centroids = _spherical_kmeans(_unit(embeddings[np.sort(sample)]), n_lists, n_iter, rng)
+
+        assignment = np.empty(n, dtype=np.int64)
+        for start in range(0, n, _QUERY_CHUNK):
+            block = _unit(embeddings[start:start + _QUERY_CHUNK])
+            assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        list_members = np.argsort(assignment, kind='stable')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+        return cls(embeddings, centroids, list_offsets, list_members, codes=codes, n_probe=n_probe)
+
+    def save(self, path):
+        """Write the quantizer, inverted lists, filter codes and embeddings hash (not the vectors) to an .npz file."""
+        arrays = {'centroids': self.centroids, 'list_offsets': self.list_offsets,
+                  'list_members': self.list_members, 'n_rows': np.array(len(self.embeddings)),
+                  'embeddings_hash': np.array(hash_embeddings(self.embeddings))}
+        if self.codes is not None:
+            arrays['codes'] = self.codes
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path, embeddings, n_probe=8):
+        """
+        Reopen an index saved with save() on top of the same embedding matrix.
+
+        Raises:
+            ValueError: If the embeddings differ from the ones the index was built on
+        """
+        with np.load(path) as saved:
+            if int(saved['n_rows']) != len(embeddings):
+                raise ValueError(f"Index was built for {int(saved['n_rows'])} rows, got {len(embeddings)} embeddings")
+            if 'embeddings_hash' not in saved or str(saved['embeddings_hash']) != hash_embeddings(embeddings):
+                raise ValueError(f"Index {path} was built on different embeddings")
+            codes = saved['codes'] if 'codes' in saved else None
+            return cls(embeddings, saved['centroids'], saved['list_offsets'], saved['list_members'],
+                       codes=codes, n_probe=n_probe)
+
+    def __len__(self):
+        return len(self.list_members)
+
+    def _probe(self, queries, n_probe):
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        scores = queries @ self.centroids.T
+        return np.argpartition(-scores, n_probe - 1, axis=1)[:, :n_probe]
+
+    def _iter_candidates(self, queries, n_probe, query_codes, query_ids):
+        """Yield (query rows, member rows, similarity block, valid mask) for every probed cell."""
+        probes = self._probe(queries, n_probe)
+        # Invert the probes: the queries of each cell are a contiguous run of probed_rows
+        probed_cells = probes.ravel()
+        order = np.argsort(probed_cells, kind='stable')
+        probed_rows = order // probes.shape[1]
+        probe_offsets = np.concatenate([[0], np.cumsum(np.bincount(probed_cells, minlength=len(self.centroids)))])
+        for cell in range(len(self.centroids)):
+            members = np.sort(self.list_members[self.list_offsets[cell]:self.list_offsets[cell + 1]])
+            rows = probed_rows[probe_offsets[cell]:probe_offsets[cell + 1]]
+            if not len(members) or not len(rows):
+                continue
+            member_vectors = _unit(self.embeddings[members])
+            for start in range(0, len(rows), _QUERY_CHUNK):
+                chunk = rows[start:start + _QUERY_CHUNK]
+                similarities = queries[chunk] @ member_vectors.T
+                valid = np.ones(similarities.shape, dtype=bool)
+                if query_codes is not None:
+                    valid &= query_codes[chunk, None] == self.codes[None, members]
+                if query_ids is not None:
+                    valid &= query_ids[chunk, None] != members[None, :]
+                yield chunk, members, similarities, valid
+
+    def _prepare(self, queries, query_codes, query_ids):
+        queries = _unit(np.atleast_2d(queries))
+        if query_codes is not None:
+            if self.codes is None:
+                raise ValueError("Filtering by code requires an index built with codes")
+            query_codes = np.asarray(query_codes, dtype=np.int64)
+        if query_ids is not None:
+            query_ids = np.asarray(query_ids, dtype=np.int64)
+        return queries, query_codes, query_ids
+
+    def knn(self, queries, k=10, n_probe=None, query_codes=None, query_ids=None):
+        """
+        Approximate k nearest neighbors of each query by cosine similarity.
+
+        Args:
+            queries (np.ndarray): Array of shape (m, dim)
+            k (int): Neighbors per query
+            n_probe (int, optional): Cells scored per query (defaults to the index setting)
+            query_codes (array-like, optional): Only return neighbors with the same filter code as the query
+            query_ids (array-like, optional): Row position of each query in the index, to skip self-matches
+
+        Returns:
+            tuple: (neighbors, similarities), both of shape (m, k) and sorted by decreasing
+            similarity; missing neighbors have position -1 and similarity -inf
+        """
+        queries, query_codes, query_ids = self._prepare(queries, query_codes, query_ids)
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        best_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for rows, members, similarities, valid in self._iter_candidates(queries, n_probe, query_codes, query_ids):
+            similarities = np.where(valid, similarities, -np.inf)
+            merged_sims = np.concatenate([best_sims[rows], similarities], axis=1)
+            merged_ids = np.concatenate([best_ids[rows], np.broadcast_to(members, similarities.shape)], axis=1)
+            top = np.argpartition(-merged_sims, k - 1, axis=1)[:, :k]
+            best_sims[rows] = np.take_along_axis(merged_sims, top, axis=1)
+            best_ids[rows] = np.take_along_axis(merged_ids, top, axis=1)
+
+        order = np.argsort(-best_sims, axis=1, kind='stable')
+        best_sims = np.take_along_axis(best_sims, order, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+        best_ids[np.isneginf(best_sims)] = -1
+        return best_ids, best_sims
+
+    def radius(self, queries, max_distance, n_probe=None, query_codes=None, query_ids=None):
+        """
+        All indexed ideas within a cosine distance of each query.
+
+        Args:
+            queries (np.ndarray): Array of shape (m, dim)
+            max_distance (float): Cosine distance threshold (1 - cosine similarity)
+            n_probe (int, optional): Cells scored per query (defaults to the index setting)
+            query_codes (array-like, optional): Only return neighbors with the same filter code as the query
+            query_ids (array-like, optional): Row position of each query in the index, to skip self-matches
+
+        Returns:
+            tuple: (query positions, neighbor positions, similarities) of every match, sorted by query
+        """
+        queries, query_codes, query_ids = self._prepare(queries, query_codes, query_ids)
+        found_queries, found_neighbors, found_sims = [], [], []
+        for rows, members, similarities, valid in self._iter_candidates(queries, n_probe, query_codes, query_ids):
+            q, m = np.nonzero(valid & (similarities >= 1 - max_distance))
+            found_queries.append(rows[q])
+            found_neighbors.append(members[m])
+            found_sims.append(similarities[q, m])
+        if not found_queries:
+            return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float32)
+        found_queries = np.concatenate(found_queries)
+        order = np.argsort(found_queries, kind='stable')
+        return found_queries[order], np.concatenate(found_neighbors)[order], np.concatenate(found_sims)[order]
+
+    def neighbor_counts(self, max_distance, same_code=True, n_probe=None):
+        """
+        For every indexed idea, the number of other ideas within max_distance.
+
+        Args:
+            max_distance (float): Cosine distance threshold
+            same_code (bool): Only count neighbors with the same filter code (e.g. condition-object pair)
+            n_probe (int, optional): Cells scored per query
+
+        Returns:
+            np.ndarray: Neighbor count per row
+        """
+        counts = np.zeros(len(self.embeddings), dtype=np.int64)
+        for start in range(0, len(self.embeddings), _QUERY_CHUNK * 4):
+            ids = np.arange(start, min(start + _QUERY_CHUNK * 4, len(self.embeddings)))
+            codes = self.codes[ids] if same_code and self.codes is not None else None
+            found, _, _ = self.radius(self.embeddings[ids], max_distance, n_probe=n_probe,
+                                      query_codes=codes, query_ids=ids)
+            counts[ids] += np.bincount(found, minlength=len(ids))
+        return counts
+
+
+def canonical_idea(text):
+    """Lowercase, drop punctuation and leading filler words ("A paperweight." -> "paperweight")."""
+    text = _NON_WORD.sub(' ', text.lower() if isinstance(text, str) else '')
+    text = ' '.join(text.split())
+    return _FILLER_PREFIX.sub('', text)
+
+
+def collapse_near_duplicates(index, texts=None, max_distance=0.05, n_probe=None):
+    """
+    Group repeated ideas so each set of near-duplicates can be counted once.
+
+    Two ideas are duplicates if they share a filter code (when the index has codes) and either
+    have the same canonical text or lie within max_distance of each other. Duplicates are merged
+    transitively.
+
+    Args:
+        index (IVFIndex): Index over the ideas
+        texts (list, optional): Idea texts aligned with the index rows, for exact canonical matches
+        max_distance (float): Cosine distance under which two ideas count as the same idea
+        n_probe (int, optional): Cells scored per query
+
+    Returns:
+        np.ndarray: Duplicate-group label per row: the position of the group's first row.
+        Keep rows where labels == np.arange(len(labels)) to drop duplicates.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    n = len(index.embeddings)
+    sources, targets = [], []
+    for start in range(0, n, _QUERY_CHUNK * 4):
+        ids = np.arange(start, min(start + _QUERY_CHUNK * 4, n))
+        codes = index.codes[ids] if index.codes is not None else None
+        found, neighbors, _ = index.radius(index.embeddings[ids], max_distance, n_probe=n_probe,
+                                           query_codes=codes, query_ids=ids)
+        sources.append(ids[found])
+        targets.append(neighbors)
+
+    if texts is not None:
+        # Link every row to the first row with the same canonical text (and code)
+        keys = [canonical_idea(text) for text in texts]
+        if index.codes is not None:
+            keys = list(zip(index.codes.tolist(), keys))
+        first = {}
+        sources.append(np.arange(n))
+        targets.append(np.array([first.setdefault(key, i) for i, key in enumerate(keys)], dtype=np.int64))
+
+    sources, targets = np.concatenate(sources), np.concatenate(targets)
+    graph = coo_matrix((np.ones(len(sources), dtype=np.int8), (sources, targets)), shape=(n, n))
+    _, components = connected_components(graph, directed=False)
+    # Label each component by its smallest row position
+    labels = np.full(components.max() + 1, n, dtype=np.int64)
+    np.minimum.at(labels, components, np.arange(n))
+    return labels[components]
+
+
+def main():
+    import pandas as pd
+
+    from analyses.iriss.embedding_store import load_embedding_matrix
+
+    parser = argparse.ArgumentParser(description="Count near neighbors of every idea with an IVF index.")
+    parser.add_argument('--data', default='data/evaluated_compliant_ideas.csv', help="Ideas CSV")
+    parser.add_argument('--embeddings', default='data/evaluated_compliant_ideas_embeddings.npy',
+                        help="Embedding matrix written by embeddings.py")
+    parser.add_argument('--index', default='data/evaluated_compliant_ideas_ivf.npz', help="Index file (built if missing)")
+    parser.add_argument('--radius', type=float, default=0.2, help="Cosine distance for neighbor counts")
+    parser.add_argument('--duplicate-distance', type=float, default=0.05, help="Cosine distance for near-duplicates")
+    parser.add_argument('--n-probe', type=int, default=8)
+    parser.add_argument('--output', default='data/idea_neighbor_counts.csv')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.data)
+    embeddings, row_ids = load_embedding_matrix(args.embeddings)
+    df = df.iloc[row_ids].reset_index(drop=True)
+    codes = df.groupby(['condition', 'object']).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+
+    try:
+        index = IVFIndex.load(args.index, embeddings, n_probe=args.n_probe)
+    except (FileNotFoundError, ValueError) as error:
+        # Missing, or built on other embeddings: (re)build it
+        if isinstance(error, ValueError):
+            print(f"{error}; rebuilding")
+        index = IVFIndex.build(embeddings, codes=codes, n_probe=args.n_probe)
+        index.save(args.index)
+
+    out = df[['condition', 'object', 'submitter_id', 'use']].copy()
+    out['neighbors_within_radius'] = index.neighbor_counts(args.radius)
+    out['duplicate_group'] = collapse_near_duplicates(index, df['use'].tolist(), args.duplicate_distance)
+    out.to_csv(args.output, index=False)
+
+    unique = out['duplicate_group'] == np.arange(len(out))
+    print(f"{unique.sum()} distinct ideas out of {len(out)} after collapsing near-duplicates")
+    print(out.groupby('condition')['neighbors_within_radius'].agg(['mean', 'std', 'count']))
+
+
+if __name__ == '__main__':
+    main()
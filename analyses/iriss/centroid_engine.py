@@ -0,0 +1,117 @@
+# Group-wise centroid similarities computed in one pass.
+# Instead of recomputing the mean of "all other ideas" for every idea, we compute one sum per
+# group and subtract the idea's own contribution (or its submitter's contribution). The centroid
+# of the remaining ideas is that difference divided by a positive count, which does not change
+# the cosine similarity, so the division is skipped.
+import numpy as np
+
+
+def _as_codes(codes):
+    """Convert group codes to int64, mapping missing codes (NaN from ngroup) to -1."""
+    codes = np.asarray(codes)
+    if codes.dtype.kind == 'f':
+        codes = np.where(np.isnan(codes), -1, codes)
+    return codes.astype(np.int64)
+
+
+def _group_sums(codes, values, n_groups):
+    """Sum the rows of values for each integer code in [0, n_groups)."""
+    sums = np.zeros((n_groups,) + values.shape[1:], dtype=np.float64)
+    if len(codes) == 0:
+        return sums
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    sums[sorted_codes[starts]] = np.add.reduceat(values[order], starts, axis=0)
+    return sums
+
+
+def _cosine_rows(a, b):
+    """Row-wise cosine similarity; NaN where either vector has zero norm."""
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    dots = np.einsum('ij,ij->i', a, b)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(norms > 0, dots / norms, np.nan)
+
+
+def _similarity_to_rest(embeddings, group_codes, unit_codes):
+    """
+    Cosine similarity of each row to the centroid of its group minus its own unit.
+
+    Args:
+        embeddings (np.ndarray): Array of shape (n, dim)
+        group_codes (np.ndarray): Integer group code per row; negative codes are skipped
+        unit_codes (np.ndarray): Integer code of the unit (row or submitter) removed from the centroid
+
+    Returns:
+        np.ndarray: float64 similarities, NaN where no other ideas remain
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    group_codes = _as_codes(group_codes)
+    unit_codes = _as_codes(unit_codes)
+    result = np.full(len(embeddings), np.nan)
+
+    valid = group_codes >= 0
+    if not valid.any():
+        return result
+    x = embeddings[valid]
+    groups = group_codes[valid]
+    units = unit_codes[valid]
+
+    n_groups = groups.max() + 1
+    n_units = units.max() + 1
+    group_sums = _group_sums(groups, x, n_groups)
+    group_counts = np.bincount(groups, minlength=n_groups)
+    unit_sums = _group_sums(units, x, n_units)
+    unit_counts = np.bincount(units, minlength=n_units)
+
+    rest = group_sums[groups] - unit_sums[units]
+    rest_counts = group_counts[groups] - unit_counts[units]
+    similarity = _cosine_rows(x, rest)
+    similarity[rest_counts <= 0] = np.nan
+    result[valid] = similarity
+    return result
+
+
+def leave_one_out_similarity(embeddings, group_codes):
+    """
+    Cosine similarity of each idea to the centroid of all OTHER ideas in its group.
+
+    Args:
+        embeddings (np.ndarray): Array of shape (n, dim)
+        group_codes (array-like): Integer group code per idea (e.g. from groupby(...).ngroup());
+            ideas with a negative code get NaN
+
+    Returns:
+        np.ndarray: Similarities aligned with the rows of embeddings (NaN for singleton groups)
+    """
+    return _similarity_to_rest(embeddings, group_codes, np.arange(len(group_codes)))
+
+
+def leave_submitter_out_similarity(embeddings, group_codes, submitter_codes):
+    """
+    Cosine similarity of each idea to the centroid of the ideas from OTHER submitters in its group.
+
+    Args:
+        embeddings (np.ndarray): Array of shape (n, dim)
+        group_codes (array-like): Integer group code per idea; ideas with a negative code get NaN
+        submitter_codes (array-like): Integer submitter code per idea; a negative code (missing
+            submitter) makes the idea count as its own submitter
+
+    Returns:
+        np.ndarray: Similarities aligned with the rows of embeddings (NaN when no other submitter exists)
+    """
+    group_codes = _as_codes(group_codes)
+    submitter_codes = _as_codes(submitter_codes)
+    n = len(group_codes)
+
+    # Give ideas with a missing submitter a unique submitter code each
+    missing = submitter_codes < 0
+    submitter_codes = submitter_codes.copy()
+    next_code = submitter_codes.max() + 1 if n else 0
+    submitter_codes[missing] = next_code + np.arange(missing.sum())
+
+    # One unit per (group, submitter) pair
+    pairs = np.stack([group_codes, submitter_codes], axis=1)
+    _, unit_codes = np.unique(pairs, axis=0, return_inverse=True)
+    return _similarity_to_rest(embeddings, group_codes, unit_codes.reshape(-1))
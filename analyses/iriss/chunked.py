@@ -0,0 +1,222 @@
+# Out-of-core centroid metrics for idea corpora larger than memory (e.g. several merged waves).
+# The ideas files are read in row batches with explicit dtypes (categorical condition/object).
+# Pass 1 embeds each batch through the embedding cache, appends it to an on-disk embedding matrix
+# and adds it to running per-group embedding sums. Pass 2 streams the matrix back batch by batch,
+# scores every idea against the centroid of the rest of its group (group sum minus its own or its
+# submitter's contribution), streams the scores to disk, and keeps per-condition mean/std with the
+# running (Welford/Chan) accumulators of SimilaritySummary. Memory holds one batch plus one
+# embedding sum per group, however many rows there are.
+#
+# Usage (from the repository root):
+#     python -m analyses.iriss.chunked --data data/wave1.csv data/wave2.csv \
+#         --embeddings data/all_waves_embeddings.npy --output data/all_waves_centroids.csv
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from analyses.iriss.embedding_store import (DEFAULT_BATCH_SIZE, DEFAULT_CACHE_PATH, DEFAULT_MODEL, EmbeddingMatrixWriter,
+                                            EmbeddingStore, load_embedding_matrix)
+from analyses.iriss.pairwise_output import PairwiseWriter, SimilaritySummary
+
+IDEA_COLUMNS = ('condition', 'object', 'submitter_id', 'use')
+IDEA_DTYPES = {
+    'condition': 'category',
+    'object': 'category',
+    'submitter_id': 'string',
+    'ResponseId': 'string',
+    'use': 'string',
+}
+DEFAULT_CHUNK_ROWS = 50_000
+
+
+def iter_idea_chunks(paths, chunk_rows=DEFAULT_CHUNK_ROWS, columns=IDEA_COLUMNS):
+    """
+    Read one or more ideas CSV files in row batches.
+
+    Args:
+        paths (list): CSV files, read one after the other (e.g. one per data collection wave)
+        chunk_rows (int): Rows per batch
+        columns (tuple): Columns to read, with dtypes from IDEA_DTYPES
+
+    Yields:
+        DataFrame: A batch whose index is the global row position across all files
+    """
+    offset = 0
+    dtypes = {column: IDEA_DTYPES[column] for column in columns if column in IDEA_DTYPES}
+    for path in paths:
+        with pd.read_csv(os.path.expanduser(path), usecols=list(columns), dtype=dtypes, chunksize=chunk_rows) as reader:
+            for chunk in reader:
+                chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+                offset += len(chunk)
+                yield chunk
+
+
+class KeyCodes:
+    """Assigns stable integer codes to group keys as they are first seen across batches."""
+
+    def __init__(self):
+        self.codes = {}
+        self.keys = []
+
+    def encode(self, chunk, by):
+        """Return the code of every row of chunk for the key columns by; rows with a missing key get -1."""
+        local = chunk.groupby(list(by), observed=True, sort=False).ngroup().to_numpy()
+        local = np.where(np.isnan(local), -1, local).astype(np.int64) if local.dtype.kind == 'f' else local
+        if not (local >= 0).any():
+            # Every row has a missing key (e.g. no submitter_id in the whole batch)
+            return np.full(len(local), -1, dtype=np.int64)
+        first_rows = pd.Series(np.arange(len(chunk))).groupby(local).first()
+        lookup = np.full(int(local.max()) + 1 if len(local) else 0, -1, dtype=np.int64)
+        key_frame = chunk.iloc[first_rows.to_numpy()][list(by)]
+        for code, key in zip(first_rows.index, key_frame.itertuples(index=False, name=None)):
+            if code < 0:
+                continue
+            if key not in self.codes:
+                self.codes[key] = len(self.keys)
+                self.keys.append(key)
+            lookup[code] = self.codes[key]
+        return np.where(local >= 0, lookup[np.maximum(local, 0)], -1)
+
+
+class RunningSums:
+    """Running embedding sum and row count per integer code, grown as new codes appear."""
+
+    def __init__(self, dim):
+        self.sums = np.zeros((0, dim))
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, codes, embeddings):
+        valid = codes >= 0
+        codes, embeddings = codes[valid], np.asarray(embeddings, dtype=np.float64)[valid]
+        if len(codes) == 0:
+            return
+        needed = int(codes.max()) + 1
+        if needed > len(self.counts):
+            size = max(needed, 2 * len(self.counts))
+            self.sums = np.vstack([self.sums, np.zeros((size - len(self.sums), self.sums.shape[1]))])
+            self.counts = np.concatenate([self.counts, np.zeros(size - len(self.counts), dtype=np.int64)])
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        self.sums[sorted_codes[starts]] += np.add.reduceat(embeddings[order], starts, axis=0)
+        self.counts += np.bincount(codes, minlength=len(self.counts))
+
+
+def _similarity_to_rest(embeddings, group_sums, group_counts, own_sums, own_counts):
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    rest = group_sums - own_sums
+    norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(rest, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        similarity = np.where(norms > 0, np.einsum('ij,ij->i', embeddings, rest) / norms, np.nan)
+    similarity[group_counts - own_counts <= 0] = np.nan
+    return similarity
+
+
+def chunked_centroid_similarity(paths, embeddings_path, output_path, exclude='self', normalization='strip_lower',
+                                chunk_rows=DEFAULT_CHUNK_ROWS, model_name=DEFAULT_MODEL,
+                                cache_path=DEFAULT_CACHE_PATH, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Similarity of every idea to the centroid of the rest of its condition-object pair, out of core.
+
+    Args:
+        paths (list): Ideas CSV files
+        embeddings_path (str): Where to write the embedding matrix of all rows (.npy)
+        output_path (str): Per-idea output (.csv or .parquet), written in batches
+        exclude (str): 'self' leaves out the idea itself (centroid.py); 'submitter' leaves out all
+            ideas of its submitter in the pair (doshi_analysis.py, without its one-idea sampling)
+        normalization (str): Text normalization used for embedding
+        chunk_rows (int): Rows per batch
+        model_name (str): SentenceTransformer model name
+        cache_path (str): Embedding cache location
+        batch_size (int): Encoder batch size for cache misses
+
+    Returns:
+        SimilaritySummary: Per-condition count, mean and std of the similarities
+    """
+    if exclude not in ('self', 'submitter'):
+        raise ValueError("exclude must be 'self' or 'submitter'")
+    group_keys, unit_keys = KeyCodes(), KeyCodes()
+    group_codes, unit_codes = [], []
+    groups = units = None
+
+    # Pass 1: embed, append to the matrix, accumulate group sums
+    store = EmbeddingStore(cache_path, model_name=model_name, normalization=normalization)
+    try:
+        with EmbeddingMatrixWriter(embeddings_path) as matrix:
+            for chunk in iter_idea_chunks(paths, chunk_rows):
+                embeddings = store.encode(chunk['use'].tolist(), batch_size=batch_size)
+                matrix.append(embeddings, chunk.index.to_numpy())
+                codes = group_keys.encode(chunk, ['condition', 'object'])
+                if groups is None:
+                    groups, units = RunningSums(embeddings.shape[1]), RunningSums(embeddings.shape[1])
+                groups.add(codes, embeddings)
+                group_codes.append(codes.astype(np.int32))
+                if exclude == 'submitter':
+                    submitter_codes = unit_keys.encode(chunk, ['condition', 'object', 'submitter_id'])
+                    units.add(submitter_codes, embeddings)
+                    unit_codes.append(submitter_codes.astype(np.int32))
+    finally:
+        store.close()
+
+    # Pass 2: score each idea against its group's sum minus its own (or its submitter's) contribution
+    embeddings, _ = load_embedding_matrix(embeddings_path)
+    group_codes = np.concatenate(group_codes) if group_codes else np.empty(0, dtype=np.int32)
+    unit_codes = np.concatenate(unit_codes) if unit_codes else None
+    conditions = np.array([condition for condition, _ in group_keys.keys] + [None], dtype=object)
+    summary = SimilaritySummary('condition')
+    column = 'semantic_distance' if exclude == 'self' else 'similarity_to_cond_obj'
+
+    with PairwiseWriter(output_path, chunk_rows=chunk_rows) as writer:
+        for chunk in iter_idea_chunks(paths, chunk_rows):
+            rows = slice(chunk.index[0], chunk.index[-1] + 1)
+            x = np.asarray(embeddings[rows], dtype=np.float64)
+            codes = group_codes[rows]
+            valid = codes >= 0
+            safe = np.maximum(codes, 0)
+            if exclude == 'self':
+                own_sums, own_counts = x, np.ones(len(x), dtype=np.int64)
+            else:
+                # An idea with a missing submitter is its own submitter, as in leave_submitter_out_similarity
+                units_here = unit_codes[rows]
+                own = units_here >= 0
+                safe_units = np.maximum(units_here, 0)
+                own_sums = np.where(own[:, None], units.sums[safe_units], x)
+                own_counts = np.where(own, units.counts[safe_units], 1)
+            similarity = _similarity_to_rest(x, groups.sums[safe], groups.counts[safe], own_sums, own_counts)
+            similarity[~valid] = np.nan
+            values = 1 - similarity if exclude == 'self' else similarity
+
+            chunk_conditions = conditions[np.where(valid, codes, -1)]
+            for condition in pd.unique(chunk_conditions[valid]):
+                condition_values = values[chunk_conditions == condition]
+                summary.add(condition, condition_values[~np.isnan(condition_values)])
+            output = {name: chunk[name].astype(object).to_numpy() for name in IDEA_COLUMNS}
+            output[column] = values
+            writer.write(output)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Out-of-core centroid similarities for large idea corpora.")
+    parser.add_argument('--data', nargs='+', required=True, help="Ideas CSV files (e.g. one per wave)")
+    parser.add_argument('--embeddings', required=True, help="Output .npy embedding matrix of all rows")
+    parser.add_argument('--output', required=True, help="Per-idea output (.csv or .parquet)")
+    parser.add_argument('--exclude', choices=('self', 'submitter'), default='self',
+                        help="Leave out the idea itself (centroid.py) or its submitter's ideas (doshi_analysis.py)")
+    parser.add_argument('--normalization', choices=('strip_lower', 'none'), default='strip_lower')
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    summary = chunked_centroid_similarity(args.data, args.embeddings, args.output, exclude=args.exclude,
+                                          normalization=args.normalization, chunk_rows=args.chunk_rows,
+                                          batch_size=args.batch_size)
+    print(summary.summary(include_count=True))
+    f_statistic, p_value = summary.anova()
+    print(f"ANOVA: F = {f_statistic}, p = {p_value}")
+
+
+if __name__ == '__main__':
+    main()
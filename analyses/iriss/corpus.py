@@ -0,0 +1,155 @@
+# Compact, typed in-memory representation of the idea corpus.
+# Read with plain pandas, every row holds Python strings for condition, object and submitter, and
+# every per-group filter compares those strings row by row. IdeaCorpus dictionary-encodes the key
+# columns into small integer codes, keeps the idea texts in one Arrow string array, and sorts the
+# rows by the key columns once at load time. Every condition, condition-object pair and submitter
+# within a pair is then a contiguous range of rows whose boundaries are precomputed, so metrics
+# slice ranges (views, no copies) instead of building boolean masks.
+#
+# Rows remember their position in the source file (row_ids). Arrays aligned with the file, such as
+# a saved embedding matrix, are put into corpus order once with corpus.take(array).
+#
+# Usage:
+#     corpus = IdeaCorpus.read_csv('data/evaluated_compliant_ideas.csv')
+#     embeddings = encode_ideas(corpus.text_list())
+#     keys, slices = corpus.groups(['condition', 'object'])
+#     for (condition, obj), rows in zip(keys, slices):
+#         group_embeddings = embeddings[rows]
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+DEFAULT_KEYS = ('condition', 'object', 'submitter_id')
+
+
+class IdeaCorpus:
+    """
+    Ideas sorted by their key columns, with integer-coded keys and Arrow-backed texts.
+
+    Use IdeaCorpus.read_csv or IdeaCorpus.from_frame to build one.
+
+    Attributes:
+        keys (tuple): Key columns, outermost first; groups are contiguous for any prefix of keys
+        codes (dict): Integer code per row for each key column (int8/int16/int32, -1 = missing)
+        categories (dict): Sorted labels of each key column; codes index into them
+        texts (pyarrow.Array): Idea texts in corpus order (nulls for missing ideas)
+        row_ids (np.ndarray): Position of each corpus row in the source data
+    """
+
+    def __init__(self, keys, codes, categories, texts, row_ids, text_column='use'):
+        self.keys = tuple(keys)
+        self.text_column = text_column
+        self.codes = codes
+        self.categories = categories
+        self.texts = texts
+        self.row_ids = row_ids
+        self._bounds = {}
+
+    @classmethod
+    def from_frame(cls, df, keys=DEFAULT_KEYS, text_column='use'):
+        """
+        Build a corpus from a DataFrame.
+
+        Args:
+            df (DataFrame): Ideas with the key columns and a text column; its positional row order
+                is the one row_ids refers to
+            keys (tuple): Key columns, outermost first
+            text_column (str): Column with the idea texts
+
+        Returns:
+            IdeaCorpus
+        """
+        keys = tuple(keys)
+        categoricals = {key: pd.Categorical(df[key]) for key in keys}
+        # Missing keys (code -1) sort first within their parent group; groups() skips them
+        order = np.lexsort([categoricals[key].codes for key in reversed(keys)])
+        codes = {key: categoricals[key].codes[order] for key in keys}
+        categories = {key: categoricals[key].categories.to_numpy(dtype=object) for key in keys}
+        texts = pa.array(df[text_column].to_numpy(dtype=object)[order], type=pa.large_string(), from_pandas=True)
+        return cls(keys, codes, categories, texts, order.astype(np.int64), text_column)
+
+    @classmethod
+    def read_csv(cls, path, keys=DEFAULT_KEYS, text_column='use'):
+        """Read only the key and text columns of an ideas CSV, with categorical keys."""
+        dtypes = {**{key: 'category' for key in keys}, text_column: 'string'}
+        df = pd.read_csv(os.path.expanduser(path), usecols=list(keys) + [text_column], dtype=dtypes)
+        return cls.from_frame(df, keys=keys, text_column=text_column)
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    @property
+    def nbytes(self):
+        """Memory held by the codes, texts and row positions."""
+        return sum(codes.nbytes for codes in self.codes.values()) + self.texts.nbytes + self.row_ids.nbytes
+
+    def bounds(self, by):
+        """
+        Boundaries of the contiguous groups of the key columns by.
+
+        Args:
+            by (list): A prefix of self.keys (e.g. ['condition', 'object'])
+
+        Returns:
+            np.ndarray: Group g spans rows bounds[g]:bounds[g + 1]
+        """
+        by = tuple(by)
+        if by != self.keys[:len(by)]:
+            raise ValueError(f"Groups are only contiguous for a prefix of {list(self.keys)}, got {list(by)}")
+        if by not in self._bounds:
+            change = np.zeros(max(len(self) - 1, 0), dtype=bool)
+            for key in by:
+                change |= self.codes[key][1:] != self.codes[key][:-1]
+            self._bounds[by] = np.flatnonzero(np.r_[True, change, True]) if len(self) else np.zeros(1, dtype=np.int64)
+        return self._bounds[by]
+
+    def groups(self, by):
+        """
+        Keys and row ranges of the groups of by, like parallel_groups.group_positions but without sorting.
+
+        Returns:
+            tuple: (list of group keys, list of slices), in sorted key order; groups with a missing
+            key are skipped. A slice selects the group's rows of any array in corpus order.
+        """
+        bounds = self.bounds(by)
+        starts = bounds[:-1]
+        key_codes = np.stack([self.codes[key][starts] for key in by], axis=1) if len(starts) else np.empty((0, len(by)))
+        keys, slices = [], []
+        for codes, start, stop in zip(key_codes.tolist(), starts.tolist(), bounds[1:].tolist()):
+            if min(codes) < 0:
+                continue
+            keys.append(tuple(self.categories[column][code] for column, code in zip(by, codes)))
+            slices.append(slice(start, stop))
+        return keys, slices
+
+    def group_codes(self, by):
+        """Group number per row for the groups of by (consecutive, ascending in corpus order)."""
+        bounds = self.bounds(by)
+        return np.repeat(np.arange(len(bounds) - 1), np.diff(bounds))
+
+    def labels(self, column, rows=slice(None)):
+        """Decoded labels of a key column for the given rows (None where missing)."""
+        codes = self.codes[column][rows]
+        labels = np.append(self.categories[column], None)
+        return labels[np.where(codes >= 0, codes, -1)]
+
+    def text_list(self, rows=slice(None)):
+        """Idea texts of the given rows as Python strings (None where missing)."""
+        start, stop, step = rows.indices(len(self))
+        if step != 1:
+            raise ValueError("rows must be a contiguous slice")
+        return self.texts.slice(start, stop - start).to_pylist()
+
+    def take(self, array):
+        """Reorder an array aligned with the source rows (e.g. an embedding matrix) into corpus order."""
+        return np.asarray(array)[self.row_ids]
+
+    def to_frame(self):
+        """DataFrame of the corpus in corpus order, with categorical keys, Arrow-backed text and row_id."""
+        columns = {key: pd.Categorical.from_codes(self.codes[key], categories=self.categories[key])
+                   for key in self.keys}
+        columns[self.text_column] = pd.array(self.texts, dtype=pd.ArrowDtype(pa.large_string()))
+        columns['row_id'] = self.row_ids
+        return pd.DataFrame(columns)
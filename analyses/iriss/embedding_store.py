@@ -0,0 +1,367 @@
+# Persistent, content-addressed cache of sentence embeddings shared by the analysis scripts.
+# Every script reads through this store, so only texts that have never been seen before
+# (for a given model and normalization) are sent to the encoder.
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+DEFAULT_MODEL = 'all-MiniLM-L6-v2'
+# data/embedding_cache.sqlite in the repository (ignored by git), whatever the working directory;
+# the EMBEDDING_CACHE_PATH environment variable overrides it
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_CACHE_PATH = os.path.expanduser(
+    os.environ.get('EMBEDDING_CACHE_PATH', os.path.join(_REPO_ROOT, 'data', 'embedding_cache.sqlite'))
+)
+
+# How an idea is cleaned up before it is embedded. The normalization is part of the cache key,
+# so embeddings of raw and preprocessed text never get mixed up.
+NORMALIZATIONS = {
+    'none': lambda text: text,
+    'strip_lower': lambda text: text.strip().lower(),
+}
+
+# Sentences per forward pass when encoding cache misses. Larger batches amortize the
+# per-call overhead of the model; lower it if memory is tight.
+DEFAULT_BATCH_SIZE = 256
+
+# SQLite limits the number of bound parameters per statement
+_QUERY_CHUNK = 500
+
+
+def normalize_ideas(texts, normalization='strip_lower'):
+    """
+    Apply a named normalization to a list of ideas.
+
+    Args:
+        texts (iterable): Raw idea texts; missing values are treated as empty strings
+        normalization (str): One of the keys of NORMALIZATIONS
+
+    Returns:
+        list: Normalized idea texts
+    """
+    if normalization not in NORMALIZATIONS:
+        raise ValueError(f"Unknown normalization '{normalization}'. Choose from {sorted(NORMALIZATIONS)}")
+    normalize = NORMALIZATIONS[normalization]
+    return [normalize(text if isinstance(text, str) else "") for text in texts]
+
+
+class EmbeddingStore:
+    """
+    SQLite-backed embedding cache keyed by (model name, normalization, text hash).
+
+    Args:
+        path (str): Location of the SQLite cache file
+        model_name (str): SentenceTransformer model used for cache misses
+        normalization (str): Normalization applied to texts before hashing and encoding
+        backend (str): Encoder backend (see encoders.BACKENDS); non-fp32 backends get their own cache keys
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, model_name=DEFAULT_MODEL, normalization='strip_lower', backend='torch'):
+        if normalization not in NORMALIZATIONS:
+            raise ValueError(f"Unknown normalization '{normalization}'. Choose from {sorted(NORMALIZATIONS)}")
+        self.path = path
+        self.model_name = model_name
+        self.normalization = normalization
+        self.backend = backend
+        # fp32 keeps the plain model name so existing cache entries stay valid
+        self.model_id = model_name if backend == 'torch' else f"{model_name}@{backend}"
+        self._model = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT, normalization TEXT, dim INTEGER, vector BLOB)"
+        )
+        self._conn.commit()
+
+    @property
+    def model(self):
+        # Only load the model when there is something new to encode
+        if self._model is None:
+            from analyses.iriss.encoders import get_encoder
+            self._model = get_encoder(self.model_name, self.backend)
+        return self._model
+
+    def key(self, normalized_text):
+        """Return the cache key for an already-normalized text."""
+        payload = f"{self.model_id}\x00{self.normalization}\x00{normalized_text}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """Return a dict mapping each cached key to its float32 vector."""
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), _QUERY_CHUNK):
+            chunk = keys[start:start + _QUERY_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+            )
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, keys, vectors):
+        """Insert vectors for the given keys, ignoring keys that are already cached."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO embeddings (key, model, normalization, dim, vector) VALUES (?, ?, ?, ?, ?)",
+            [
+                (key, self.model_id, self.normalization, vector.shape[0], vector.tobytes())
+                for key, vector in zip(keys, vectors)
+            ],
+        )
+        self._conn.commit()
+
+    def encode(self, texts, batch_size=DEFAULT_BATCH_SIZE, show_progress_bar=False):
+        """
+        Embed texts, reading cached vectors and encoding only unseen texts.
+
+        Args:
+            texts (iterable): Raw idea texts (normalized by the store)
+            batch_size (int): Batch size passed to the encoder for cache misses
+            show_progress_bar (bool): Show the encoder progress bar for cache misses
+
+        Returns:
+            np.ndarray: float32 array of shape (len(texts), dim), aligned with texts
+        """
+        normalized = normalize_ideas(texts, self.normalization)
+        keys = [self.key(text) for text in normalized]
+        cached = self.get_many(set(keys))
+
+        # Encode each unseen text once, even if it appears many times
+        missing = {}
+        for key, text in zip(keys, normalized):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            new_vectors = self.model.encode(
+                list(missing.values()), batch_size=batch_size, show_progress_bar=show_progress_bar
+            )
+            self.put_many(missing.keys(), new_vectors)
+            cached.update(zip(missing.keys(), np.asarray(new_vectors, dtype=np.float32)))
+
+        if not keys:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([cached[key] for key in keys])
+
+    def close(self):
+        self._conn.close()
+
+
+def encode_ideas(texts, model_name=DEFAULT_MODEL, normalization='strip_lower', cache_path=DEFAULT_CACHE_PATH,
+                 batch_size=DEFAULT_BATCH_SIZE, show_progress_bar=False, backend='torch'):
+    """
+    Embed ideas through the shared embedding cache.
+
+    Args:
+        texts (iterable): Raw idea texts
+        model_name (str): SentenceTransformer model name
+        normalization (str): 'strip_lower' (strip whitespace, lowercase) or 'none'
+        cache_path (str): Location of the SQLite cache file
+        batch_size (int): Batch size used when encoding cache misses
+        show_progress_bar (bool): Show the encoder progress bar for cache misses
+        backend (str): 'torch' (fp32), 'int8', 'onnx' or 'onnx_int8' (see encoders.py)
+
+    Returns:
+        np.ndarray: Embeddings aligned with texts
+    """
+    store = EmbeddingStore(cache_path, model_name=model_name, normalization=normalization, backend=backend)
+    try:
+        return store.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar)
+    finally:
+        store.close()
+
+
+def embed_column(df, column='use', normalization='strip_lower', batch_size=DEFAULT_BATCH_SIZE, **kwargs):
+    """
+    Embed one text column of a DataFrame in a single batched pass.
+
+    Duplicate texts are encoded once and cached texts are not encoded at all, so scripts
+    embed the whole corpus up front and then slice rows per group by position.
+
+    Args:
+        df (DataFrame): Data with a text column
+        column (str): Name of the text column
+        normalization (str): 'strip_lower' or 'none'
+        batch_size (int): Batch size used when encoding cache misses
+        **kwargs: Passed on to encode_ideas (e.g. model_name, cache_path, backend)
+
+    Returns:
+        np.ndarray: Embeddings aligned with the rows of df (positional)
+    """
+    return encode_ideas(df[column].tolist(), normalization=normalization, batch_size=batch_size, **kwargs)
+
+
+def _row_ids_path(matrix_path):
+    return os.path.splitext(matrix_path)[0] + '_row_ids.npy'
+
+
+def save_embedding_matrix(path, embeddings, row_ids, dtype='float32'):
+    """
+    Write embeddings as a binary .npy matrix with a companion row-id index.
+
+    The matrix is written to a temporary file and moved into place, so readers that
+    memory-map the artifact never see a half-written file.
+
+    Args:
+        path (str): Output path of the .npy matrix
+        embeddings (np.ndarray): Array of shape (n_rows, dim)
+        row_ids (array-like): One integer id per row (e.g. the row position in the source CSV)
+        dtype (str): 'float32' or 'float16'
+
+    Returns:
+        str: Path of the row-id index written next to the matrix
+    """
+    if dtype not in ('float32', 'float16'):
+        raise ValueError("dtype must be 'float32' or 'float16'")
+    embeddings = np.ascontiguousarray(embeddings, dtype=dtype)
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    if len(row_ids) != len(embeddings):
+        raise ValueError(f"Got {len(row_ids)} row ids for {len(embeddings)} embeddings")
+
+    index_path = _row_ids_path(path)
+    for target, array in ((index_path, row_ids), (path, embeddings)):
+        tmp_path = target + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, target)
+    return index_path
+
+
+# Fixed .npy header size of EmbeddingMatrixWriter, so the final shape can be written in place
+_APPEND_HEADER_BYTES = 128
+
+
+def _npy_header(shape, dtype):
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': shape})
+    # Format 1.0: magic, version, 2-byte header length, then the header dict padded with spaces
+    header = header.ljust(_APPEND_HEADER_BYTES - 10 - 1) + '\n'
+    return np.lib.format.MAGIC_PREFIX + b'\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+
+class EmbeddingMatrixWriter:
+    """
+    Builds an embedding matrix file chunk by chunk, for corpora that do not fit in memory.
+
+    Rows are appended to a temporary .npy file whose header is rewritten with the final shape on
+    close; the matrix and its row-id index are then moved into place, in the same layout as
+    save_embedding_matrix, so load_embedding_matrix opens the result.
+
+    With keep_rows, an existing matrix written by this class is extended in place instead: rows
+    after its first keep_rows are cut off (e.g. rows of a run that never finished), new rows are
+    appended, and close() rewrites the headers with the new shape.
+
+    Args:
+        path (str): Output path of the .npy matrix
+        dtype (str): 'float32' or 'float16'
+        keep_rows (int, optional): Append to the existing matrix after this many rows
+    """
+
+    def __init__(self, path, dtype='float32', keep_rows=None):
+        if dtype not in ('float32', 'float16'):
+            raise ValueError("dtype must be 'float32' or 'float16'")
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.n_rows = 0
+        self.dim = None
+        self._in_place = keep_rows is not None
+        if self._in_place:
+            self._matrix = self._reopen(path, self.dtype, keep_rows)
+            self._row_ids = self._reopen(_row_ids_path(path), np.dtype(np.int64), keep_rows)
+            self.n_rows = keep_rows
+            return
+        self._matrix = open(path + '.tmp', 'wb')
+        self._row_ids = open(_row_ids_path(path) + '.tmp', 'wb')
+        for f in (self._matrix, self._row_ids):
+            f.write(b'\x00' * _APPEND_HEADER_BYTES)
+
+    def _reopen(self, path, dtype, keep_rows):
+        f = open(path, 'r+b')
+        np.lib.format.read_magic(f)
+        shape, _, stored_dtype = np.lib.format.read_array_header_1_0(f)
+        if f.tell() != _APPEND_HEADER_BYTES or stored_dtype != dtype or shape[0] < keep_rows:
+            f.close()
+            raise ValueError(f"{path} was not written by EmbeddingMatrixWriter with {keep_rows} or more {dtype} rows")
+        if len(shape) == 2:
+            self.dim = shape[1] or None
+        row_bytes = dtype.itemsize * (shape[1] if len(shape) == 2 else 1)
+        f.truncate(_APPEND_HEADER_BYTES + keep_rows * row_bytes)
+        f.seek(0, os.SEEK_END)
+        return f
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def append(self, embeddings, row_ids):
+        """Append a chunk of embeddings with one integer row id per row."""
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.dtype)
+        row_ids = np.ascontiguousarray(row_ids, dtype=np.int64)
+        if len(row_ids) != len(embeddings):
+            raise ValueError(f"Got {len(row_ids)} row ids for {len(embeddings)} embeddings")
+        if len(embeddings) == 0:
+            return
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dimensional embeddings, got {embeddings.shape[1]}")
+        self._matrix.write(embeddings.tobytes())
+        self._row_ids.write(row_ids.tobytes())
+        self.n_rows += len(embeddings)
+
+    def close(self):
+        """Write the final headers and move the files into place."""
+        for f, shape, dtype in ((self._row_ids, (self.n_rows,), np.int64),
+                                (self._matrix, (self.n_rows, self.dim or 0), self.dtype)):
+            f.seek(0)
+            f.write(_npy_header(shape, dtype))
+            if self._in_place:
+                f.flush()
+                os.fsync(f.fileno())
+            f.close()
+        if self._in_place:
+            return
+        os.replace(_row_ids_path(self.path) + '.tmp', _row_ids_path(self.path))
+        os.replace(self.path + '.tmp', self.path)
+
+    def abort(self):
+        """Discard the partially written files (in place: leave the headers, so the new rows are ignored)."""
+        for f in (self._matrix, self._row_ids):
+            f.close()
+            if not self._in_place:
+                os.remove(f.name)
+
+
+def load_embedding_matrix(path, mmap_row_ids=False):
+    """
+    Open a matrix written by save_embedding_matrix without parsing or copying it.
+
+    Args:
+        path (str): Path of the .npy matrix
+        mmap_row_ids (bool): Memory-map the row ids too instead of reading them
+
+    Returns:
+        tuple: (read-only np.memmap of shape (n_rows, dim), np.ndarray of row ids)
+    """
+    embeddings = np.load(path, mmap_mode='r')
+    row_ids = np.load(_row_ids_path(path), mmap_mode='r' if mmap_row_ids else None)
+    return embeddings, row_ids
+
+
+def hash_embeddings(embeddings, chunk_rows=20_000):
+    """Content hash of an embedding matrix (shape and float32 values), read in row chunks."""
+    digest = hashlib.sha256(str(embeddings.shape).encode('utf-8'))
+    for start in range(0, len(embeddings), chunk_rows):
+        digest.update(np.ascontiguousarray(embeddings[start:start + chunk_rows], dtype=np.float32).tobytes())
+    return digest.hexdigest()
@@ -1,25 +1,24 @@
 import pandas as pd
-import numpy as np
-from scipy.spatial.distance import cosine
-from sentence_transformers import SentenceTransformer
 
-# 1. Load data
-file_path = 'data/evaluated_compliant_ideas.csv' 
-df = pd.read_csv(file_path)
+from analyses.iriss.embedding_store import encode_ideas, save_embedding_matrix
 
-# 2. Initialize Model
-model = SentenceTransformer('all-MiniLM-L6-v2')
 
-# 3. Generate Embeddings
-ideas = df['use'].fillna("").tolist()
-# Preprocess ideas (e.g., strip whitespace, convert to lowercase) to ensure consistency
-ideas = [idea.strip().lower() for idea in ideas]
-all_embeddings = model.encode(ideas, show_progress_bar=True)
+# Guarded so that importing this module does not run the analysis
+if __name__ == '__main__':
+    # 1. Load data
+    file_path = 'data/evaluated_compliant_ideas.csv' 
+    df = pd.read_csv(file_path)
 
-# Append embeddings to dataframe for k-means clustering
-embedding_cols = [f'embedding_{i}' for i in range(all_embeddings.shape[1])]
-embeddings_df = pd.DataFrame(all_embeddings, columns=embedding_cols)
-df = pd.concat([df, embeddings_df], axis=1)
+    # 2. Generate Embeddings through the shared cache (only unseen ideas are encoded)
+    ideas = df['use'].fillna("").tolist()
+    # Preprocess ideas (e.g., strip whitespace, convert to lowercase) to ensure consistency
+    all_embeddings = encode_ideas(ideas, normalization='strip_lower', show_progress_bar=True)
 
-# Save the file as a csv
-df.to_csv('data/evaluated_compliant_ideas_with_embeddings.csv', index=False)
+    # Save the embeddings as a binary matrix aligned with the rows of the input CSV.
+    # Downstream code opens it with load_embedding_matrix (memory-mapped, no parsing).
+    save_embedding_matrix(
+        'data/evaluated_compliant_ideas_embeddings.npy',
+        all_embeddings,
+        row_ids=df.index.to_numpy(),
+        dtype='float32',
+    )
@@ -0,0 +1,200 @@
+# Sentence encoder backends for CPU inference.
+#   'torch'     - SentenceTransformer with fp32 PyTorch (the reference)
+#   'int8'      - the same model with its Linear layers dynamically quantized to int8
+#   'onnx'      - ONNX Runtime export of the model (sentence-transformers >= 3.2)
+#   'onnx_int8' - ONNX Runtime with the pre-quantized int8 weights shipped with the model
+# Every backend is wrapped in length-bucketed batching: texts are sorted by length and grouped
+# under a token budget, so short ideas are encoded in large batches and long ones in small
+# batches, with little padding in either.
+#
+# Check a backend against fp32 on the idea corpus with:
+#     python -m analyses.iriss.encoders --data data/evaluated_compliant_ideas.csv --backend int8
+import argparse
+import threading
+
+import numpy as np
+
+BACKENDS = ('torch', 'int8', 'onnx', 'onnx_int8')
+DEFAULT_ONNX_INT8_FILE = 'onnx/model_quint8_avx2.onnx'
+
+# Approximate tokens per batch; about 128 short ideas of ~16 tokens each
+DEFAULT_BATCH_TOKENS = 2048
+
+
+def _approx_tokens(text):
+    # WordPiece averages roughly four characters per token on English text, plus [CLS]/[SEP]
+    return len(text) // 4 + 2
+
+
+class BucketedEncoder:
+    """
+    Wraps a SentenceTransformer-like model and encodes texts in length buckets.
+
+    Args:
+        model: Object with an encode(texts, batch_size=..., show_progress_bar=...) method
+        batch_tokens (int): Approximate token budget per batch
+    """
+
+    def __init__(self, model, batch_tokens=DEFAULT_BATCH_TOKENS):
+        self.model = model
+        self.batch_tokens = batch_tokens
+
+    def encode(self, texts, batch_size=None, show_progress_bar=False, **kwargs):
+        """
+        Encode texts in length-sorted batches and return embeddings in the original order.
+
+        batch_size caps the number of texts per batch on top of the token budget.
+        show_progress_bar is passed on to the model, which shows a bar per length bucket.
+        """
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        lengths = np.array([_approx_tokens(t) for t in texts])
+        order = np.argsort(lengths, kind='stable')
+
+        batches = []
+        current, current_max = [], 0
+        for i in order:
+            longest = max(current_max, lengths[i])
+            # Padded size of the batch is (number of texts) x (longest text)
+            if current and (longest * (len(current) + 1) > self.batch_tokens
+                            or (batch_size and len(current) >= batch_size)):
+                batches.append(current)
+                current, longest = [], lengths[i]
+            current.append(i)
+            current_max = longest
+        batches.append(current)
+
+        embeddings = None
+        for batch in batches:
+            vectors = np.asarray(self.model.encode([texts[i] for i in batch], batch_size=len(batch),
+                                                   show_progress_bar=show_progress_bar, **kwargs), dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            embeddings[batch] = vectors
+        return embeddings
+
+
+def load_encoder(model_name, backend='torch', batch_tokens=DEFAULT_BATCH_TOKENS, onnx_file=DEFAULT_ONNX_INT8_FILE):
+    """
+    Load a sentence encoder for the given backend.
+
+    Args:
+        model_name (str): SentenceTransformer model name
+        backend (str): One of BACKENDS
+        batch_tokens (int): Token budget per length bucket
+        onnx_file (str): Quantized ONNX file inside the model repository (for 'onnx_int8')
+
+    Returns:
+        BucketedEncoder: Encoder with an encode(texts, batch_size, show_progress_bar) method
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown encoder backend '{backend}'. Choose from {BACKENDS}")
+    from sentence_transformers import SentenceTransformer
+
+    if backend == 'torch':
+        model = SentenceTransformer(model_name)
+    elif backend == 'int8':
+        # Dynamic quantization only runs on CPU
+        import torch
+        model = SentenceTransformer(model_name, device='cpu')
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == 'onnx':
+        model = SentenceTransformer(model_name, backend='onnx')
+    else:
+        model = SentenceTransformer(model_name, backend='onnx', model_kwargs={'file_name': onnx_file})
+    return BucketedEncoder(model, batch_tokens=batch_tokens)
+
+
+# Encoders already loaded in this process, shared by every EmbeddingStore
+_ENCODERS = {}
+_ENCODERS_LOCK = threading.Lock()
+
+
+def get_encoder(model_name, backend='torch'):
+    """
+    Return the process-wide encoder for a model and backend, loading it on first use.
+
+    Loading a model takes seconds, so scripts that embed several columns or normalizations
+    (and the pipeline, which embeds twice) load each model only once.
+    """
+    key = (model_name, backend)
+    with _ENCODERS_LOCK:
+        if key not in _ENCODERS:
+            _ENCODERS[key] = load_encoder(model_name, backend)
+        return _ENCODERS[key]
+
+
+def _unit(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def compare_to_reference(candidate, reference, n_pairs=100_000, seed=42):
+    """
+    Compare a backend's embeddings with fp32 reference embeddings of the same texts.
+
+    Args:
+        candidate (np.ndarray): Embeddings from the backend being checked
+        reference (np.ndarray): Embeddings of the same texts from the fp32 reference
+        n_pairs (int): Random idea pairs used to compare pairwise cosine similarities
+        seed (int): Seed for drawing the pairs
+
+    Returns:
+        dict: Agreement statistics (self-similarity and pairwise similarity errors)
+    """
+    a, b = _unit(candidate), _unit(reference)
+    self_similarity = np.einsum('ij,ij->i', a, b)
+
+    rng = np.random.default_rng(seed)
+    i = rng.integers(0, len(a), n_pairs)
+    j = rng.integers(0, len(a), n_pairs)
+    keep = i != j
+    i, j = i[keep], j[keep]
+    sim_candidate = np.einsum('ij,ij->i', a[i], a[j])
+    sim_reference = np.einsum('ij,ij->i', b[i], b[j])
+    error = sim_candidate - sim_reference
+
+    return {
+        'n_texts': len(a),
+        'n_pairs': len(i),
+        'mean_self_cosine': float(self_similarity.mean()),
+        'min_self_cosine': float(self_similarity.min()),
+        'pairwise_mean_abs_error': float(np.abs(error).mean()),
+        'pairwise_max_abs_error': float(np.abs(error).max()),
+        'pairwise_correlation': float(np.corrcoef(sim_candidate, sim_reference)[0, 1]),
+    }
+
+
+def main():
+    import time
+
+    import pandas as pd
+
+    from analyses.iriss.embedding_store import DEFAULT_MODEL, normalize_ideas
+
+    parser = argparse.ArgumentParser(description="Compare an encoder backend with the fp32 reference.")
+    parser.add_argument('--data', default='data/evaluated_compliant_ideas.csv', help="Ideas CSV with a 'use' column")
+    parser.add_argument('--backend', default='int8', choices=BACKENDS)
+    parser.add_argument('--model', default=DEFAULT_MODEL)
+    parser.add_argument('--limit', type=int, default=None, help="Only use the first N ideas")
+    args = parser.parse_args()
+
+    texts = normalize_ideas(pd.read_csv(args.data)['use'].tolist(), 'strip_lower')[:args.limit]
+    timings = {}
+    embeddings = {}
+    for backend in ('torch', args.backend):
+        encoder = load_encoder(args.model, backend)
+        start = time.perf_counter()
+        embeddings[backend] = encoder.encode(texts)
+        timings[backend] = time.perf_counter() - start
+
+    report = compare_to_reference(embeddings[args.backend], embeddings['torch'])
+    report['seconds_fp32'] = timings['torch']
+    report[f'seconds_{args.backend}'] = timings[args.backend]
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,16 @@
 # Import csv of ideas and sample a fixed number of ideas per condition-object pair
 import pandas as pd
+import hashlib
 import os
-import numpy as np
+import re
 import requests
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from analyses.iriss.stratified_sampling import stratified_sample
 
 # Import Qualtrics configuration
 try:
@@ -14,50 +21,25 @@ except ImportError:
     QUALTRICS_DATACENTER = "your-datacenter"
     SURVEY_ID = "YOUR_SURVEY_ID_HERE"
 
-# Load the data
-data_path = os.path.expanduser('~/Git_Projects/idea_generation/data/iriss_trial_data.csv')  # Update with your actual data path
-df = pd.read_csv(data_path)
-
-# Define the number of ideas to sample per condition-object pair
-n_samples = 5
-sampled_ideas = []
-# For each combination of experimental condition and object, sample n ideas
-for (condition, obj), group in df.groupby(['condition', 'object']):
-    sampled_group = group.sample(n=n_samples, random_state=42)  # Set random_state for reproducibility
-    sampled_ideas.append(sampled_group)
-
-# Combine all sampled ideas into a single DataFrame
-sampled_df = pd.concat(sampled_ideas)
+# Use the Qualtrics API to create a new survey with the sampled ideas
 
-# Save the sampled ideas to a new CSV
-output_path = os.path.expanduser('~/Git_Projects/idea_generation/data/sampled_ideas.csv')  # Update with your desired output path
-sampled_df.to_csv(output_path, index=False)
+def qualtrics_base_url(datacenter):
+    """Return the Qualtrics v3 API root for a datacenter."""
+    return f"https://{datacenter}.qualtrics.com/API/v3"
 
-# Use the Qualtrics API to create a new survey with the sampled ideas
 
-def create_qualtrics_question(api_token, datacenter, survey_id, question_text, choices):
+def build_question_payload(question_text, choices, data_export_tag="Q1"):
     """
-    Create a multiple choice question in Qualtrics with the provided choices.
+    Build the JSON payload for a single-answer multiple choice question.
     
     Args:
-        api_token (str): Your Qualtrics API token
-        datacenter (str): Your Qualtrics datacenter
-        survey_id (str): The survey ID where you want to add the question
         question_text (str): The text of the question
         choices (list): List of choice texts for the question
+        data_export_tag (str): Export tag identifying the question in the data
     
     Returns:
-        dict: API response
+        dict: Question definition for the Qualtrics API
     """
-    # Construct the API URL
-    base_url = f"https://{datacenter}.qualtrics.com/API/v3/survey-definitions/{survey_id}/questions"
-    
-    # Set up headers
-    headers = {
-        'X-API-TOKEN': api_token,
-        'Content-Type': 'application/json'
-    }
-    
     # Create choices dictionary for the API
     choices_dict = {}
     for i, choice in enumerate(choices, 1):
@@ -65,10 +47,9 @@ def create_qualtrics_question(api_token, datacenter, survey_id, question_text, c
             "Display": choice
         }
     
-    # Construct the request payload
-    payload = {
+    return {
         "QuestionText": question_text,
-        "DataExportTag": "Q1",  # You can customize this
+        "DataExportTag": data_export_tag,
         "QuestionType": "MC",   # Multiple Choice
         "Selector": "SAVR",     # Single Answer Vertical
         "Configuration": {
@@ -85,9 +66,40 @@ def create_qualtrics_question(api_token, datacenter, survey_id, question_text, c
         },
         "Language": []
     }
+
+
+def create_qualtrics_question(api_token, datacenter, survey_id, question_text, choices,
+                              data_export_tag="Q1", session=None, base_url=None):
+    """
+    Create a multiple choice question in Qualtrics with the provided choices.
+    
+    Args:
+        api_token (str): Your Qualtrics API token
+        datacenter (str): Your Qualtrics datacenter
+        survey_id (str): The survey ID where you want to add the question
+        question_text (str): The text of the question
+        choices (list): List of choice texts for the question
+        data_export_tag (str): Export tag identifying the question in the data
+        session (requests.Session, optional): Session to reuse pooled connections
+        base_url (str, optional): API root, e.g. a local mock server (defaults to the datacenter URL)
+    
+    Returns:
+        dict: API response
+    """
+    # Construct the API URL
+    url = f"{base_url or qualtrics_base_url(datacenter)}/survey-definitions/{survey_id}/questions"
+    
+    # Set up headers
+    headers = {
+        'X-API-TOKEN': api_token,
+        'Content-Type': 'application/json'
+    }
+    
+    # Construct the request payload
+    payload = build_question_payload(question_text, choices, data_export_tag)
     
     try:
-        response = requests.post(base_url, headers=headers, json=payload)
+        response = (session or requests).post(url, headers=headers, json=payload)
         response.raise_for_status()  # Raises an HTTPError for bad responses
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -97,6 +109,167 @@ def create_qualtrics_question(api_token, datacenter, survey_id, question_text, c
         print(f"Error parsing JSON response: {e}")
         return None
 
+
+MAX_EXPORT_TAG_LENGTH = 64
+
+
+def make_data_export_tag(condition, obj):
+    """
+    Deterministic export tag for a condition-object question (e.g. 'high_agency_brick').
+    
+    The same pair always gets the same tag, so re-running an upload can recognize
+    questions that already exist. Tags that would be too long are shortened and end in a
+    hash of the full pair, so two pairs with a common prefix do not share a tag.
+    """
+    tag = re.sub(r'[^0-9a-zA-Z]+', '_', f"{condition}_{obj}").strip('_').lower()
+    if len(tag) <= MAX_EXPORT_TAG_LENGTH:
+        return tag
+    digest = hashlib.sha1(f"{condition}\x00{obj}".encode('utf-8')).hexdigest()[:8]
+    return f"{tag[:MAX_EXPORT_TAG_LENGTH - 9]}_{digest}"
+
+
+def check_unique_export_tags(questions):
+    """Raise ValueError if two questions share a DataExportTag (one would be skipped as existing)."""
+    seen = {}
+    for question in questions:
+        tag = question['data_export_tag']
+        if tag in seen:
+            raise ValueError(f"Questions {seen[tag]!r} and {question['question_text']!r} "
+                             f"share the export tag {tag!r}")
+        seen[tag] = question['question_text']
+
+
+def make_qualtrics_session(api_token, max_workers=8, max_retries=5, backoff_factor=0.5):
+    """
+    Create a requests session with a connection pool sized for max_workers and
+    automatic retries with exponential backoff on 429 and 5xx responses
+    (honoring the Retry-After header).
+    
+    Only GET requests are retried automatically. Creating a question (POST) is not
+    idempotent: a 5xx or a dropped connection may come after Qualtrics created it,
+    so upload_questions_bulk decides itself whether to send a POST again.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({'X-API-TOKEN': api_token})
+    return session
+
+
+def get_existing_export_tags(session, base_url, survey_id):
+    """Return the DataExportTags of the questions already in the survey."""
+    response = session.get(f"{base_url}/survey-definitions/{survey_id}/questions")
+    response.raise_for_status()
+    elements = response.json().get("result", {}).get("elements", [])
+    return {element.get("DataExportTag") for element in elements}
+
+
+def _retry_after_seconds(response, default):
+    try:
+        return float(response.headers.get("Retry-After", default))
+    except ValueError:
+        return default
+
+
+def upload_question_once(session, base_url, survey_id, question, max_retries=5, backoff_factor=0.5):
+    """
+    Create one question, retrying without ever creating it twice.
+    
+    A 429 means the request was not processed, so it is sent again after the Retry-After
+    delay. After an ambiguous failure (5xx, timeout or dropped connection) the question may
+    have been created anyway, so the survey's export tags are read again and the POST is only
+    repeated if the tag is still missing.
+    
+    Returns:
+        dict or str: API response, 'exists' if an ambiguous attempt turned out to have created
+        the question, or None on failure
+    """
+    url = f"{base_url}/survey-definitions/{survey_id}/questions"
+    payload = build_question_payload(question['question_text'], question['choices'], question['data_export_tag'])
+    for attempt in range(max_retries + 1):
+        delay = backoff_factor * 2 ** attempt
+        try:
+            response = session.post(url, json=payload)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            print(f"Error making API request for {question['data_export_tag']}: {e}")
+        else:
+            if response.status_code == 429:
+                time.sleep(_retry_after_seconds(response, delay))
+                continue
+            if response.status_code < 500:
+                try:
+                    response.raise_for_status()
+                    return response.json()
+                except requests.exceptions.HTTPError as e:
+                    print(f"Error making API request for {question['data_export_tag']}: {e}")
+                    return None
+                except json.JSONDecodeError as e:
+                    print(f"Error parsing JSON response for {question['data_export_tag']}: {e}")
+                    return None
+            print(f"Server error {response.status_code} for {question['data_export_tag']}")
+        if attempt == max_retries:
+            break
+        time.sleep(delay)
+        # The failed attempt may have created the question: check before sending it again
+        try:
+            if question['data_export_tag'] in get_existing_export_tags(session, base_url, survey_id):
+                return "exists"
+        except requests.exceptions.RequestException as e:
+            print(f"Could not re-read existing questions: {e}")
+            return None
+    return None
+
+
+def upload_questions_bulk(api_token, datacenter, survey_id, questions, max_workers=8,
+                          max_retries=5, backoff_factor=0.5, base_url=None):
+    """
+    Create many questions concurrently over one pooled session.
+    
+    Questions whose DataExportTag already exists in the survey are skipped, so an
+    interrupted upload can simply be run again. Tags must be unique within questions
+    (ValueError otherwise), since a repeated tag would be skipped.
+    
+    Args:
+        api_token (str): Your Qualtrics API token
+        datacenter (str): Your Qualtrics datacenter
+        survey_id (str): The survey ID where you want to add the questions
+        questions (list): Dicts with 'question_text', 'choices' and 'data_export_tag'
+        max_workers (int): Maximum number of requests in flight
+        max_retries (int): Retries per request on 429/5xx and connection errors
+        backoff_factor (float): Base of the exponential backoff between retries (seconds)
+        base_url (str, optional): API root, e.g. a local mock server (defaults to the datacenter URL)
+    
+    Returns:
+        dict: DataExportTag -> API response ('skipped' for existing questions, 'exists' for
+        questions found in the survey after an ambiguous failure, None on failure)
+    """
+    check_unique_export_tags(questions)
+    base_url = base_url or qualtrics_base_url(datacenter)
+    session = make_qualtrics_session(api_token, max_workers, max_retries, backoff_factor)
+    try:
+        existing = get_existing_export_tags(session, base_url, survey_id)
+        results = {q['data_export_tag']: "skipped" for q in questions if q['data_export_tag'] in existing}
+        pending = [q for q in questions if q['data_export_tag'] not in existing]
+        
+        def upload(question):
+            return upload_question_once(session, base_url, survey_id, question, max_retries, backoff_factor)
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for question, result in zip(pending, executor.map(upload, pending)):
+                results[question['data_export_tag']] = result
+        return results
+    finally:
+        session.close()
+
 # Prepare the sampled ideas for Qualtrics
 def prepare_ideas_for_qualtrics(sampled_df, condition_filter=None, object_filter=None):
     """
@@ -110,8 +283,8 @@ def prepare_ideas_for_qualtrics(sampled_df, condition_filter=None, object_filter
     Returns:
         list: List of idea texts formatted for Qualtrics choices
     """
-    # Filter data if specified
-    filtered_df = sampled_df.copy()
+    # Filter data if specified (no copy needed, the filters below create new frames)
+    filtered_df = sampled_df
     if condition_filter:
         filtered_df = filtered_df[filtered_df['condition'] == condition_filter]
     if object_filter:
@@ -138,9 +311,26 @@ def prepare_ideas_for_qualtrics(sampled_df, condition_filter=None, object_filter
     
     return formatted_ideas
 
-# Example usage
+# Example usage. Loading and sampling happen only when run as a script, so the upload helpers can be
+# imported (e.g. to test them against a mock server) without the data file
 if __name__ == "__main__":
-    # Load your sampled data
+    # Load the data
+    data_path = os.path.expanduser('~/Git_Projects/idea_generation/data/iriss_trial_data.csv')  # Update with your actual data path
+    df = pd.read_csv(data_path)
+
+    # Define the number of ideas to sample per condition-object pair
+    n_samples = 5
+    # For each combination of experimental condition and object, sample n ideas (all ideas if a pair has fewer)
+    # in a single pass; seed for reproducibility
+    sample = stratified_sample(df, ['condition', 'object'], n_samples, seed=42)
+
+    # All sampled ideas in a single DataFrame, sorted by condition-object pair
+    sampled_df = sample.frame
+
+    # Save the sampled ideas to a new CSV
+    output_path = os.path.expanduser('~/Git_Projects/idea_generation/data/sampled_ideas.csv')  # Update with your desired output path
+    sampled_df.to_csv(output_path, index=False)
+
     print("Sampled ideas saved to:", output_path)
     print(f"Total sampled ideas: {len(sampled_df)}")
     print(f"Ideas by condition:")
@@ -179,11 +369,24 @@ if __name__ == "__main__":
         else:
             print("Failed to create question.")
     
-    # Optional: Create separate questions for each condition-object pair
+    # Create separate questions for each condition-object pair
     print("\n" + "="*30)
     print("CONDITION-OBJECT BREAKDOWN")
     print("="*30)
-    for (condition, obj), group in sampled_df.groupby(['condition', 'object']):
-        ideas = prepare_ideas_for_qualtrics(sampled_df, condition, obj)
+    questions = []
+    for (condition, obj), group in sample.items():
+        # Each pair is a contiguous slice of the sample, so no re-filtering is needed
+        ideas = prepare_ideas_for_qualtrics(group)
         print(f"{condition} - {obj}: {len(ideas)} ideas")
-        # You could create separate questions for each combination if needed
+        questions.append({
+            'question_text': f"Please select the most creative use for a {obj}:",
+            'choices': ideas,
+            'data_export_tag': make_data_export_tag(condition, obj),
+        })
+    
+    if QUALTRICS_API_TOKEN != "YOUR_API_TOKEN_HERE":
+        results = upload_questions_bulk(QUALTRICS_API_TOKEN, QUALTRICS_DATACENTER, SURVEY_ID, questions)
+        n_created = sum(1 for r in results.values() if r not in (None, "skipped"))
+        n_skipped = sum(1 for r in results.values() if r == "skipped")
+        n_failed = sum(1 for r in results.values() if r is None)
+        print(f"\nCreated {n_created} questions, skipped {n_skipped} existing, {n_failed} failed.")
@@ -0,0 +1,407 @@
+# Homogeneity metrics that are updated as new responses arrive, instead of recomputed from scratch.
+# The state keeps, per condition-object group and per submitter within a group:
+#   - sums of raw and unit-normalized embeddings and idea counts (for centroids),
+#   - the group's second-moment matrix sum(u u^T) of unit embeddings,
+#   - the sum and sum of squares of the similarities of each submitter's own idea pairs.
+# The similarities of all pairs in a group follow from these sums without visiting pairs:
+#   sum over pairs i<j of u_i.u_j       = (|sum u|^2 - n) / 2
+#   sum over pairs i<j of (u_i.u_j)^2   = (||sum u u^T||_F^2 - n) / 2
+# and subtracting each submitter's own pairs leaves the different-submitter pairs of
+# semantic_similarity.py. Same-submitter pairs are the person-level pairs of
+# person_level_homogeneity.py. Adding a batch costs time proportional to the new rows (plus the
+# earlier ideas of the same submitters); group summaries cost O(#groups x dim^2) and the
+# leave-submitter-out centroid summary O(#submitter-groups x dim), independent of the number of pairs.
+# Ideas with a missing submitter_id each count as their own submitter, as in the full scripts.
+#
+# The state records the embedding model and text normalization it was built with and a fingerprint
+# of every batch added to it, so a batch encoded differently or added twice is rejected. The CLI
+# writes the new scores and the state only after the whole batch has been added; the state records
+# how much of the scores file belongs to it, and a rerun after a crash first cuts the file back to that.
+#
+# The pickled state holds only these sums. The unit embeddings of every idea, needed to score new
+# ideas against their submitter's earlier ones, are appended to an embedding matrix next to the
+# state file (<state>.vectors.npy, written with EmbeddingMatrixWriter). Its row-id column links each
+# row to the previous row of the same submitter, so a submitter's ideas are read back by following
+# the links from the submitter's last row; saving writes only the new rows.
+#
+# Usage (from the repository root), once per batch of new submissions:
+#     python -m analyses.iriss.incremental --state data/homogeneity_state.pkl --data data/new_batch.csv
+import argparse
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from analyses.iriss.chunked import KeyCodes
+from analyses.iriss.embedding_store import DEFAULT_MODEL, EmbeddingMatrixWriter, load_embedding_matrix
+from analyses.iriss.pairwise_output import SimilaritySummary
+
+
+def _unit_rows(embeddings):
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(norms > 0, embeddings / norms, 0.0)
+
+
+def _cosine_rows(a, b):
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(norms > 0, np.einsum('ij,ij->i', a, b) / norms, np.nan)
+
+
+def _grow(array, size):
+    if len(array) >= size:
+        return array
+    grown = np.zeros((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def batch_fingerprint(df, embeddings):
+    """Fingerprint of a batch: its key columns and embeddings, independent of the row index."""
+    digest = hashlib.sha256()
+    digest.update(pd.util.hash_pandas_object(df[['condition', 'object', 'submitter_id']], index=False).to_numpy().tobytes())
+    digest.update(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+class IncrementalHomogeneity:
+    """
+    Running state of the centroid, pairwise and person-level homogeneity metrics.
+
+    Args:
+        dim (int): Embedding dimension
+        model_id (str): Embedding model of every batch (EmbeddingStore.model_id)
+        normalization (str): Text normalization of every batch
+    """
+
+    def __init__(self, dim, model_id=DEFAULT_MODEL, normalization='strip_lower'):
+        self.dim = dim
+        self.model_id = model_id
+        self.normalization = normalization
+        self.batches = set()
+        # Bytes of each scores file (by absolute path) written for the batches in this state
+        self.scores_bytes = {}
+        self.group_keys = KeyCodes()  # (condition, object)
+        self.unit_keys = KeyCodes()  # (condition, object, submitter_id)
+        self.n_rows = 0
+
+        # Per group
+        self.group_sums = np.zeros((0, dim))
+        self.group_unit_sums = np.zeros((0, dim))
+        self.group_counts = np.zeros(0, dtype=np.int64)
+        self.group_moments = np.zeros((0, dim, dim))
+        # Per group, totals over its submitters: sum |U_s|^2, sum n_s^2, and own-pair sums
+        self.group_unit_norms = np.zeros(0)
+        self.group_unit_squares = np.zeros(0, dtype=np.int64)
+        self.group_own_pair_sums = np.zeros(0)
+        self.group_own_pair_squares = np.zeros(0)
+
+        # Per submitter within a group
+        self.unit_group = np.zeros(0, dtype=np.int64)
+        self.unit_sums = np.zeros((0, dim))
+        self.unit_unit_sums = np.zeros((0, dim))
+        self.unit_counts = np.zeros(0, dtype=np.int64)
+        self.unit_pair_sums = np.zeros(0)
+        self.unit_pair_squares = np.zeros(0)
+        # 1 + row of the submitter's last idea in the vector file (0 = none yet)
+        self.unit_last = np.zeros(0, dtype=np.int64)
+
+        # Rows of the vector file; only the first n_vectors belong to this state
+        self.n_vectors = 0
+        self._init_vectors()
+
+    def _init_vectors(self):
+        # Rows already in the vector file (memory-mapped) and rows added since the last save
+        self._stored_vectors = np.empty((0, self.dim), dtype=np.float32)
+        self._stored_links = np.empty(0, dtype=np.int64)
+        self._vectors_path = None
+        self._pending = []
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in ('_stored_vectors', '_stored_links', '_vectors_path', '_pending'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_vectors()
+
+    def _earlier_vectors(self, unit):
+        """Unit embeddings of the submitter's ideas so far, oldest first."""
+        n_stored = len(self._stored_links)
+        rows = []
+        link = self.unit_last[unit]
+        while link:
+            position = link - 1
+            if position >= n_stored:
+                vector, link = self._pending[position - n_stored]
+            else:
+                vector, link = self._stored_vectors[position], int(self._stored_links[position])
+            rows.append(vector)
+        return np.array(rows[::-1], dtype=np.float32).reshape(-1, self.dim)
+
+    def _append_vectors(self, unit, u):
+        for vector in u.astype(np.float32):
+            self._pending.append((vector, self.unit_last[unit]))
+            self.n_vectors += 1
+            self.unit_last[unit] = self.n_vectors
+
+    def _grow_to(self, n_groups, n_units):
+        for name in ('group_sums', 'group_unit_sums', 'group_counts', 'group_moments', 'group_unit_norms',
+                     'group_unit_squares', 'group_own_pair_sums', 'group_own_pair_squares'):
+            setattr(self, name, _grow(getattr(self, name), n_groups))
+        for name in ('unit_group', 'unit_sums', 'unit_unit_sums', 'unit_counts', 'unit_pair_sums', 'unit_pair_squares',
+                     'unit_last'):
+            setattr(self, name, _grow(getattr(self, name), n_units))
+
+    def _singleton_units(self, group_codes, unit_codes):
+        """Give each idea with a known group but a missing submitter a unit of its own."""
+        missing = np.flatnonzero((group_codes >= 0) & (unit_codes < 0))
+        if len(missing) == 0:
+            return unit_codes
+        unit_codes = unit_codes.copy()
+        unit_codes[missing] = len(self.unit_keys.keys) + np.arange(len(missing))
+        # Reserve the codes; the keys are never looked up, since encode skips missing submitters
+        self.unit_keys.keys.extend(self.group_keys.keys[group] + (None,) for group in group_codes[missing])
+        return unit_codes
+
+    def add(self, df, embeddings):
+        """
+        Add new ideas and return their centroid scores against the updated state.
+
+        Args:
+            df (DataFrame): New ideas with condition, object and submitter_id columns
+            embeddings (np.ndarray): Their embeddings, aligned with the rows of df
+
+        Raises:
+            ValueError: If the same batch (same keys and embeddings) was already added
+
+        Returns:
+            DataFrame: df with 'semantic_distance' (to the centroid of the other ideas in the
+            condition-object pair, as in centroid.py) and 'similarity_to_cond_obj' (to the centroid
+            of the other submitters' ideas, as in doshi_analysis.py)
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float64)
+        fingerprint = batch_fingerprint(df, embeddings)
+        if fingerprint in self.batches:
+            raise ValueError("This batch of ideas was already added to the state")
+        group_codes = self.group_keys.encode(df, ['condition', 'object'])
+        unit_codes = self._singleton_units(group_codes, self.unit_keys.encode(df, ['condition', 'object', 'submitter_id']))
+        self._grow_to(len(self.group_keys.keys), len(self.unit_keys.keys))
+        unit_embeddings = _unit_rows(embeddings)
+
+        valid = np.flatnonzero(unit_codes >= 0)
+        order = valid[np.argsort(unit_codes[valid], kind='stable')]
+        bounds = np.flatnonzero(np.r_[True, np.diff(unit_codes[order]) != 0, True]) if len(order) else []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            rows = order[start:stop]
+            unit, group = unit_codes[rows[0]], group_codes[rows[0]]
+            x, u = embeddings[rows], unit_embeddings[rows]
+
+            # New own pairs: new ideas against the submitter's earlier ideas, and among themselves
+            earlier = self._earlier_vectors(unit)
+            cross = u @ earlier.T
+            within = (u @ u.T)[np.triu_indices(len(u), k=1)]
+            pair_sum = cross.sum() + within.sum()
+            pair_squares = np.sum(cross ** 2) + np.sum(within ** 2)
+
+            # Replace the submitter's old contribution to the group totals with the new one
+            self.group_unit_norms[group] -= self.unit_unit_sums[unit] @ self.unit_unit_sums[unit]
+            self.group_unit_squares[group] -= self.unit_counts[unit] ** 2
+            self.unit_group[unit] = group
+            self.unit_sums[unit] += x.sum(axis=0)
+            self.unit_unit_sums[unit] += u.sum(axis=0)
+            self.unit_counts[unit] += len(rows)
+            self.unit_pair_sums[unit] += pair_sum
+            self.unit_pair_squares[unit] += pair_squares
+            self._append_vectors(unit, u)
+            self.group_unit_norms[group] += self.unit_unit_sums[unit] @ self.unit_unit_sums[unit]
+            self.group_unit_squares[group] += self.unit_counts[unit] ** 2
+            self.group_own_pair_sums[group] += pair_sum
+            self.group_own_pair_squares[group] += pair_squares
+
+            self.group_sums[group] += x.sum(axis=0)
+            self.group_unit_sums[group] += u.sum(axis=0)
+            self.group_counts[group] += len(rows)
+            self.group_moments[group] += u.T @ u
+        self.n_rows += len(df)
+        self.batches.add(fingerprint)
+
+        scored = df.copy()
+        scored['semantic_distance'], scored['similarity_to_cond_obj'] = self.score(group_codes, unit_codes, embeddings)
+        return scored
+
+    def score(self, group_codes, unit_codes, embeddings):
+        """Leave-one-out distance and leave-submitter-out similarity of ideas against the current state."""
+        valid = (group_codes >= 0) & (unit_codes >= 0)
+        groups, units = np.maximum(group_codes, 0), np.maximum(unit_codes, 0)
+        group_sums, group_counts = self.group_sums[groups], self.group_counts[groups]
+
+        leave_one_out = _cosine_rows(embeddings, group_sums - embeddings)
+        leave_one_out[~valid | (group_counts <= 1)] = np.nan
+        leave_submitter_out = _cosine_rows(embeddings, group_sums - self.unit_sums[units])
+        leave_submitter_out[~valid | (group_counts - self.unit_counts[units] <= 0)] = np.nan
+        return 1 - leave_one_out, leave_submitter_out
+
+    def _conditions(self):
+        return [condition for condition, _ in self.group_keys.keys]
+
+    def pairwise_summary(self):
+        """Different-submitter pairs within each condition-object pair (semantic_similarity.py)."""
+        summary = SimilaritySummary('condition')
+        n = len(self.group_keys.keys)
+        counts = self.group_counts[:n].astype(np.float64)
+        norms = np.einsum('ij,ij->i', self.group_unit_sums[:n], self.group_unit_sums[:n])
+        frobenius = np.einsum('ijk,ijk->i', self.group_moments[:n], self.group_moments[:n])
+        pair_counts = (counts ** 2 - self.group_unit_squares[:n]) / 2
+        pair_sums = (norms - self.group_unit_norms[:n]) / 2
+        # Same-submitter blocks of ||M||_F^2: each idea with itself (n) plus both orders of own pairs
+        own_frobenius = counts + 2 * self.group_own_pair_squares[:n]
+        pair_squares = (frobenius - own_frobenius) / 2
+        for condition, count, total, squares in zip(self._conditions(), pair_counts, pair_sums, pair_squares):
+            summary.add_moments(condition, int(round(count)), total, squares)
+        return summary
+
+    def person_summary(self):
+        """Pairs of ideas from the same submitter within each condition-object pair (person_level_homogeneity.py)."""
+        summary = SimilaritySummary('condition')
+        n = len(self.group_keys.keys)
+        pair_counts = (self.group_unit_squares[:n] - self.group_counts[:n]) // 2
+        for condition, count, total, squares in zip(self._conditions(), pair_counts, self.group_own_pair_sums[:n],
+                                                    self.group_own_pair_squares[:n]):
+            summary.add_moments(condition, int(count), total, squares)
+        return summary
+
+    def centroid_summary(self):
+        """
+        Mean leave-submitter-out centroid similarity per condition, over all ideas.
+
+        The mean of an idea's similarity to a fixed vector r is (sum of unit embeddings) . r / |r|,
+        so it is computed per submitter-group instead of per idea.
+        """
+        k = len(self.unit_keys.keys)
+        groups = self.unit_group[:k]
+        rest = self.group_sums[groups] - self.unit_sums[:k]
+        rest_norms = np.linalg.norm(rest, axis=1)
+        scored = (self.group_counts[groups] - self.unit_counts[:k] > 0) & (rest_norms > 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            totals = np.where(scored, np.einsum('ij,ij->i', self.unit_unit_sums[:k], rest) / rest_norms, 0.0)
+        conditions = np.array(self._conditions(), dtype=object)[groups]
+        frame = pd.DataFrame({'condition': conditions, 'total': totals,
+                              'count': np.where(scored, self.unit_counts[:k], 0)})
+        frame = frame.groupby('condition')[['total', 'count']].sum()
+        frame['mean'] = frame['total'] / frame['count']
+        return frame[['mean', 'count']]
+
+    def _open_vectors(self, vectors_path):
+        vectors, links = load_embedding_matrix(vectors_path, mmap_row_ids=True)
+        if len(links) < self.n_vectors:
+            raise ValueError(f"{vectors_path} has {len(links)} rows, the state expects {self.n_vectors}")
+        # Rows past n_vectors come from a save that did not finish; the next save cuts them off
+        self._stored_vectors, self._stored_links = vectors[:self.n_vectors], links[:self.n_vectors]
+        self._vectors_path = vectors_path
+
+    def save(self, path):
+        """
+        Append the new unit embeddings to <path>.vectors.npy, then write the state with pickle (atomically).
+
+        Raises:
+            ValueError: If the state was loaded from another path (its vector file stays there)
+        """
+        vectors_path = path + '.vectors.npy'
+        n_stored = len(self._stored_links)
+        if n_stored and self._vectors_path != vectors_path:
+            raise ValueError(f"Save the state where it was loaded from ({self._vectors_path[:-len('.vectors.npy')]})")
+        if self._pending:
+            with EmbeddingMatrixWriter(vectors_path, keep_rows=n_stored or None) as writer:
+                writer.append(np.stack([vector for vector, _ in self._pending]),
+                              np.array([link for _, link in self._pending], dtype=np.int64))
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        if self._pending:
+            self._pending = []
+            self._open_vectors(vectors_path)
+
+    @staticmethod
+    def load(path, model_id=None, normalization=None):
+        """
+        Read a saved state, checking that it was built with the given model and normalization.
+
+        Raises:
+            ValueError: If model_id or normalization (when given) differ from the state's
+        """
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if state.n_vectors:
+            state._open_vectors(path + '.vectors.npy')
+        for name, expected in (('model_id', model_id), ('normalization', normalization)):
+            if expected is not None and getattr(state, name) != expected:
+                raise ValueError(f"{path} was built with {name}={getattr(state, name)!r}, not {expected!r}")
+        return state
+
+    def write_scores(self, path, scored):
+        """
+        Append scores to a CSV file after cutting it back to the rows this state has written.
+
+        Rows left over from a run that crashed before saving the state are dropped. Save the state
+        afterwards so it records the new length.
+        """
+        key = os.path.abspath(path)
+        offset = self.scores_bytes.get(key, 0)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(scored.to_csv(header=offset == 0, index=False).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            self.scores_bytes[key] = f.tell()
+
+
+def main():
+    from analyses.iriss.chunked import iter_idea_chunks
+    from analyses.iriss.embedding_store import DEFAULT_CACHE_PATH, EmbeddingStore
+
+    parser = argparse.ArgumentParser(description="Update homogeneity metrics with a batch of new ideas.")
+    parser.add_argument('--state', default='data/homogeneity_state.pkl', help="State file (created if missing)")
+    parser.add_argument('--data', nargs='+', required=True, help="CSV files with only the NEW ideas")
+    parser.add_argument('--normalization', choices=('strip_lower', 'none'), default='strip_lower',
+                        help="Must stay the same for every batch added to a state file")
+    parser.add_argument('--output', default='data/incremental_centroid_scores.csv',
+                        help="CSV the new ideas' centroid scores are appended to (kept in step with the state)")
+    args = parser.parse_args()
+
+    store = EmbeddingStore(DEFAULT_CACHE_PATH, normalization=args.normalization)
+    state = None
+    if os.path.exists(args.state):
+        state = IncrementalHomogeneity.load(args.state, model_id=store.model_id, normalization=args.normalization)
+    scored = []
+    try:
+        for chunk in iter_idea_chunks(args.data):
+            embeddings = store.encode(chunk['use'].tolist())
+            if state is None:
+                state = IncrementalHomogeneity(embeddings.shape[1], model_id=store.model_id,
+                                               normalization=args.normalization)
+            scored.append(state.add(chunk, embeddings))
+    finally:
+        store.close()
+    # Nothing is written until the whole batch is in; the state is saved last and records the scores
+    state.write_scores(args.output, pd.concat(scored, ignore_index=True))
+    state.save(args.state)
+
+    print(f"{state.n_rows} ideas in the state")
+    for name, summary in (('Pairwise (different submitters)', state.pairwise_summary()),
+                          ('Person-level (same submitter)', state.person_summary())):
+        f_statistic, p_value = summary.anova()
+        print(f"\n{name}:\n{summary.summary(include_count=True)}\nANOVA: F = {f_statistic}, p = {p_value}")
+    print(f"\nLeave-submitter-out centroid similarity:\n{state.centroid_summary()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Blocked pairwise cosine similarity.
+# The upper triangle of the similarity matrix is computed one fixed-size tile at a time with a
+# float32 matrix product, so memory stays at O(block_size^2) however large a group gets. Each tile
+# is masked (i < j, and optionally different submitters) and handed to the caller, which feeds
+# it to a reducer such as SimilaritySummary or PairwiseWriter.
+import numpy as np
+
+DEFAULT_BLOCK_SIZE = 2048
+
+
+def normalize_rows(embeddings):
+    """Return float32 unit-length rows (rows with zero norm become NaN, as before)."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def iter_similarity_blocks(embeddings, submitters=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Yield the upper-triangle cosine similarities of a group, one tile at a time.
+
+    Args:
+        embeddings (np.ndarray): Array of shape (n, dim)
+        submitters (array-like, optional): Submitter per row; if given, only pairs from
+            different submitters are kept
+        block_size (int): Rows/columns per tile
+
+    Yields:
+        tuple: (i, j, similarities) with i < j global row positions and float32 similarities
+    """
+    unit = normalize_rows(embeddings)
+    n = len(unit)
+    if submitters is not None:
+        submitters = np.asarray(submitters)
+    # Strict upper triangle for tiles on the diagonal, sliced for the smaller last tile
+    # (sized to the group, so small groups do not pay for a full block_size x block_size mask)
+    tile_size = min(block_size, n)
+    upper = np.triu(np.ones((tile_size, tile_size), dtype=bool), k=1)
+
+    for row_start in range(0, n, block_size):
+        row_stop = min(row_start + block_size, n)
+        rows = unit[row_start:row_stop]
+        for col_start in range(row_start, n, block_size):
+            col_stop = min(col_start + block_size, n)
+            tile = rows @ unit[col_start:col_stop].T
+
+            if col_start == row_start:
+                mask = upper[:row_stop - row_start, :col_stop - col_start].copy()
+            else:
+                mask = np.ones(tile.shape, dtype=bool)
+            if submitters is not None:
+                mask &= submitters[row_start:row_stop, None] != submitters[None, col_start:col_stop]
+
+            local_i, local_j = np.nonzero(mask)
+            if len(local_i) == 0:
+                continue
+            yield local_i + row_start, local_j + col_start, tile[local_i, local_j]
@@ -0,0 +1,210 @@
+# Streaming output for pairwise similarity scripts.
+# Pairs are passed in as NumPy arrays per group and written to disk in chunks, so memory use
+# depends on the chunk size rather than on the total number of pairs. Summary statistics and the
+# one-way ANOVA are computed from running per-condition accumulators, so they are available even
+# when the individual pairs are never written.
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class PairwiseWriter:
+    """
+    Chunked writer for pairwise similarity rows.
+
+    The format follows the file extension: '.parquet' writes row groups with pyarrow, with the
+    categorical columns dictionary-encoded; '.csv' appends chunks to a CSV file.
+
+    Args:
+        path (str): Output path ending in '.parquet' or '.csv'
+        chunk_rows (int): Number of buffered rows that triggers a write
+        categorical_columns (tuple): Columns stored as categoricals in Parquet output
+    """
+
+    def __init__(self, path, chunk_rows=1_000_000, categorical_columns=('condition', 'object')):
+        self.path = os.path.expanduser(path)
+        self.format = os.path.splitext(self.path)[1].lower().lstrip('.')
+        if self.format not in ('parquet', 'csv'):
+            raise ValueError(f"Unsupported output format for {path}; use .parquet or .csv")
+        if self.format == 'parquet':
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError as e:
+                raise ImportError("Writing .parquet output requires pyarrow (pip install pyarrow)") from e
+
+        self.chunk_rows = chunk_rows
+        self.categorical_columns = tuple(categorical_columns)
+        self.rows_written = 0
+        self._buffer = []
+        self._buffered_rows = 0
+        self._parquet_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, columns):
+        """
+        Buffer one group of pairs.
+
+        Args:
+            columns (dict): Column name -> array of values, or a scalar repeated for every pair
+                (e.g. the group's condition). Column order must be the same on every call.
+        """
+        n_rows = max((len(v) for v in columns.values() if np.ndim(v) > 0), default=0)
+        if n_rows == 0:
+            return
+        chunk = {
+            name: np.asarray(values) if np.ndim(values) > 0 else np.full(n_rows, values, dtype=object)
+            for name, values in columns.items()
+        }
+        self._buffer.append(chunk)
+        self._buffered_rows += n_rows
+        if self._buffered_rows >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """Write buffered rows to disk."""
+        if not self._buffer:
+            return
+        names = list(self._buffer[0])
+        frame = pd.DataFrame({name: np.concatenate([chunk[name] for chunk in self._buffer]) for name in names})
+        self._buffer = []
+        self._buffered_rows = 0
+
+        if self.format == 'csv':
+            frame.to_csv(self.path, mode='w' if self.rows_written == 0 else 'a',
+                         header=self.rows_written == 0, index=False)
+        else:
+            self._write_parquet(frame)
+        self.rows_written += len(frame)
+
+    def _write_parquet(self, frame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        # Dictionary-encode categorical columns (int32 codes, so every chunk shares one schema)
+        for name in self.categorical_columns:
+            if name in table.column_names:
+                position = table.column_names.index(name)
+                encoded = pa.array(frame[name].astype(str)).dictionary_encode()
+                table = table.set_column(position, name, encoded)
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        self._parquet_writer.write_table(table.cast(self._parquet_writer.schema))
+
+    def close(self):
+        """Flush remaining rows and close the file."""
+        self.flush()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+
+class SimilaritySummary:
+    """
+    Running count, mean and sum of squared deviations of similarities per condition.
+
+    Batches are merged with Chan's parallel update, which stays numerically stable for
+    millions of values.
+    """
+
+    def __init__(self, name='condition'):
+        self.name = name
+        self._stats = {}
+
+    def add(self, key, values):
+        """Add a batch of similarity values for one condition."""
+        values = np.asarray(values, dtype=np.float64)
+        n_b = len(values)
+        if n_b == 0:
+            return
+        mean_b = values.mean()
+        m2_b = np.sum((values - mean_b) ** 2)
+        self._merge(key, n_b, mean_b, m2_b)
+
+    def add_moments(self, key, count, total, sum_squares):
+        """Add pre-aggregated values for one condition, given their count, sum and sum of squares."""
+        if count <= 0:
+            return
+        mean_b = total / count
+        self._merge(key, count, mean_b, max(sum_squares - total * mean_b, 0.0))
+
+    def _merge(self, key, n_b, mean_b, m2_b):
+        n_a, mean_a, m2_a = self._stats.get(key, (0, 0.0, 0.0))
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        mean = mean_a + delta * n_b / n
+        m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+        self._stats[key] = (n, mean, m2)
+
+    def summary(self, include_count=False):
+        """Return a DataFrame with the mean and (sample) standard deviation (and optionally count) per condition."""
+        keys = sorted(self._stats)
+        counts = np.array([self._stats[k][0] for k in keys], dtype=np.float64)
+        means = np.array([self._stats[k][1] for k in keys])
+        m2 = np.array([self._stats[k][2] for k in keys])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(m2 / (counts - 1))
+        frame = pd.DataFrame({'mean': means, 'std': std}, index=pd.Index(keys, name=self.name))
+        if include_count:
+            frame['count'] = counts.astype(np.int64)
+        return frame
+
+    def anova(self):
+        """
+        One-way ANOVA across conditions from the accumulated statistics.
+
+        Returns:
+            tuple: (F-statistic, p-value), identical to scipy.stats.f_oneway on the raw values
+        """
+        counts = np.array([s[0] for s in self._stats.values()], dtype=np.float64)
+        means = np.array([s[1] for s in self._stats.values()])
+        m2 = np.array([s[2] for s in self._stats.values()])
+        n_total = counts.sum()
+        grand_mean = np.sum(counts * means) / n_total
+        df_between = len(counts) - 1
+        df_within = n_total - len(counts)
+        ss_between = np.sum(counts * (means - grand_mean) ** 2)
+        ss_within = m2.sum()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            f_statistic = (ss_between / df_between) / (ss_within / df_within)
+        from scipy.stats import f
+        p_value = f.sf(f_statistic, df_between, df_within)
+        return f_statistic, p_value
+
+
+class SimilarityHistogram:
+    """
+    Fixed-bin histogram of similarities per condition, for distributions of arbitrarily many pairs.
+
+    Args:
+        bins (array-like): Bin edges shared by all conditions
+    """
+
+    def __init__(self, bins=np.linspace(-1, 1, 201), name='condition'):
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.name = name
+        self._counts = {}
+
+    def add(self, key, values):
+        """Add a batch of similarity values for one condition."""
+        counts, _ = np.histogram(values, bins=self.bins)
+        if key in self._counts:
+            self._counts[key] += counts
+        else:
+            self._counts[key] = counts
+
+    def to_frame(self):
+        """Return a long DataFrame with one row per condition and bin."""
+        frames = [
+            pd.DataFrame({self.name: key, 'bin_start': self.bins[:-1], 'bin_end': self.bins[1:], 'count': counts})
+            for key, counts in sorted(self._counts.items())
+        ]
+        if not frames:
+            return pd.DataFrame(columns=[self.name, 'bin_start', 'bin_end', 'count'])
+        return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,129 @@
+# Multi-core execution of per-group pairwise similarities.
+# The embedding matrix is copied once into a shared-memory block; worker processes attach to it
+# by name instead of receiving pickled arrays. Groups are split into contiguous shards of group
+# positions, each worker returns the similarities of its shard, and results are yielded group by
+# group in group order, so the output is identical to a serial run regardless of the number of
+# workers and only a few shards are held in memory at a time.
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from analyses.iriss.pairwise_kernel import iter_similarity_blocks
+
+# Target number of pairs per shard; bounds the memory of results waiting to be consumed
+DEFAULT_SHARD_PAIRS = 4_000_000
+
+# Set in each worker process by _attach
+_EMBEDDINGS = None
+_SHARED_BLOCK = None
+
+
+def group_positions(df, by):
+    """
+    Row positions of every group of df, without building a DataFrame per group.
+
+    Args:
+        df (DataFrame): Data with a positional row order matching the embedding matrix
+        by (list): Grouping columns
+
+    Returns:
+        tuple: (list of group keys, list of np.ndarray row positions), in groupby's sorted key order
+    """
+    codes = df.groupby(by, sort=True).ngroup().to_numpy()
+    valid = ~np.isnan(codes) if codes.dtype.kind == 'f' else codes >= 0
+    positions = np.flatnonzero(valid)
+    codes = codes[valid].astype(np.int64)
+    order = np.argsort(codes, kind='stable')
+    sorted_positions = positions[order]
+    bounds = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0, True])
+    groups = [sorted_positions[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+    key_rows = df.iloc[[g[0] for g in groups]][list(by)]
+    keys = list(key_rows.itertuples(index=False, name=None))
+    return keys, groups
+
+
+def _attach(name, shape, dtype):
+    global _EMBEDDINGS, _SHARED_BLOCK
+    _SHARED_BLOCK = shared_memory.SharedMemory(name=name)
+    _EMBEDDINGS = np.ndarray(shape, dtype=dtype, buffer=_SHARED_BLOCK.buf)
+
+
+def _group_size(rows):
+    return rows.stop - rows.start if isinstance(rows, slice) else len(rows)
+
+
+def _shard_similarities(shard, embeddings=None):
+    """Upper-triangle similarities of every group in a shard (list of row positions or slices)."""
+    embeddings = _EMBEDDINGS if embeddings is None else embeddings
+    results = []
+    for positions in shard:
+        blocks = [similarities for _, _, similarities in iter_similarity_blocks(embeddings[positions])]
+        results.append(np.concatenate(blocks) if blocks else np.empty(0, dtype=np.float32))
+    return results
+
+
+def _shards(groups, n_shards, max_shard_pairs=DEFAULT_SHARD_PAIRS):
+    """Split groups into contiguous shards with roughly equal numbers of pairs, at most about max_shard_pairs each."""
+    sizes = np.array([_group_size(g) for g in groups], dtype=np.float64)
+    pair_counts = sizes * (sizes - 1) // 2 + 1
+    cumulative = np.cumsum(pair_counts)
+    n_shards = max(n_shards, int(np.ceil(cumulative[-1] / max_shard_pairs)))
+    cuts = np.searchsorted(cumulative, cumulative[-1] * np.arange(1, n_shards) / n_shards)
+    bounds = np.unique(np.r_[0, cuts, len(groups)])
+    return [groups[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def parallel_group_similarities(embeddings, groups, n_workers=None, shards_per_worker=4, max_pending=None):
+    """
+    Compute the within-group pairwise similarities of many groups on a process pool, one group at a time.
+
+    Only max_pending shards are submitted at once and each shard holds at most about
+    DEFAULT_SHARD_PAIRS pairs (unless a single group is larger), so memory holds the results of a
+    few shards instead of every pair of the corpus. Consume each group (e.g. feed it to a
+    PairwiseWriter and a SimilaritySummary) before asking for the next.
+
+    Args:
+        embeddings (np.ndarray): Array of shape (n, dim)
+        groups (list): Row positions of each group (e.g. from group_positions), or contiguous row
+            slices (e.g. from IdeaCorpus.groups)
+        n_workers (int, optional): Worker processes (defaults to os.cpu_count()); 1 runs serially
+        shards_per_worker (int): Minimum shards per worker, for load balancing between unequal groups
+        max_pending (int, optional): Shards submitted but not yet consumed (defaults to 2 per worker)
+
+    Yields:
+        tuple: (group index, float32 array of upper-triangle similarities), in the order of groups
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    if not groups:
+        return
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if n_workers == 1:
+        for group_index, positions in enumerate(groups):
+            yield group_index, _shard_similarities([positions], embeddings)[0]
+        return
+
+    shards = iter(_shards(groups, n_workers * shards_per_worker))
+    max_pending = max_pending or 2 * n_workers
+    block = shared_memory.SharedMemory(create=True, size=max(embeddings.nbytes, 1))
+    try:
+        np.ndarray(embeddings.shape, dtype=embeddings.dtype, buffer=block.buf)[:] = embeddings
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_attach,
+                                 initargs=(block.name, embeddings.shape, embeddings.dtype.str)) as executor:
+            pending = deque(executor.submit(_shard_similarities, shard) for shard in islice(shards, max_pending))
+            group_index = 0
+            # Results are taken in submission order, so the output does not depend on the number of workers
+            while pending:
+                shard_result = pending.popleft().result()
+                next_shard = next(shards, None)
+                if next_shard is not None:
+                    pending.append(executor.submit(_shard_similarities, next_shard))
+                for similarities in shard_result:
+                    yield group_index, similarities
+                    group_index += 1
+    finally:
+        block.close()
+        block.unlink()
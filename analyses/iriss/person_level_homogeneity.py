@@ -1,64 +1,93 @@
 # Use a sentence embedding model to find the semantic similarity of ideas within each experimental condition
 
-import pandas as pd
-from sentence_transformers import SentenceTransformer
 import numpy as np
 import os
-import scipy.stats as stats
 
-
-# Load the sentence transformer model
-model = SentenceTransformer('all-MiniLM-L6-v2')
-
-# Load the data
-
-data_path = '~/Git_Projects/idea_generation/data/evaluated_compliant_ideas.csv'  # Update with your actual data path
-df = pd.read_csv(data_path)
-
-# For each combination of experimental condition, object, and ResponseId, compute the semantic similarity of ideas
-results = []
-for (condition, obj, response_id), group in df.groupby(['condition', 'object', 'ResponseId']):
-    ideas = group['use'].tolist()
-
-    # Compute embeddings
-    embeddings = model.encode(ideas)
-
-    # Compute cosine similarity matrix
-    norm_embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
-    similarity_matrix = np.dot(norm_embeddings, norm_embeddings.T)
-
-    # Extract upper triangle of the similarity matrix, excluding the diagonal
-    upper_tri_indices = np.triu_indices_from(similarity_matrix, k=1)
-    similarities = similarity_matrix[upper_tri_indices]
-
-    # Store results
-    for sim in similarities:
-        results.append({
-            'condition': condition,
-            'object': obj,
-            'ResponseId': response_id,
-            'similarity': sim
-        })
-
-# Convert results to DataFrame
-results_df = pd.DataFrame(results)
-
-# Save results to CSV
-output_path = os.path.expanduser('~/Git_Projects/idea_generation/data/semantic_similarities.csv')  # Update with your desired output path
-results_df.to_csv(output_path, index=False)
-
-# Compute mean and standard deviation of similarities for each condition
-summary = results_df.groupby('condition')['similarity'].agg(['mean', 'std'])
-
-# Display summary statistics
-print(summary)
-
-# Save summary statistics to CSV
-summary_output_path = os.path.expanduser('~/Git_Projects/idea_generation/data/semantic_similarity_summary.csv')  # Update with your desired output path
-summary.to_csv(summary_output_path)
-
-# Run a simple ANOVA to see if there are significant differences between conditions
-anova_results = stats.f_oneway(*(group['similarity'].values for name, group in results_df.groupby('condition')))
-print("ANOVA results:")
-print(f"F-statistic: {anova_results.statistic}")
-print(f"P-value: {anova_results.pvalue}")
+from analyses.iriss.corpus import IdeaCorpus
+from analyses.iriss.embedding_store import encode_ideas
+from analyses.iriss.parallel_groups import parallel_group_similarities
+from analyses.iriss.pairwise_output import PairwiseWriter, SimilaritySummary
+from analyses.iriss.resampling import SubmitterStats, bootstrap_condition_means, permutation_test
+
+
+def person_similarities(corpus, embeddings, writer=None, n_workers=None):
+    """
+    Cosine similarities of the pairs of ideas from the same person within each condition-object pair.
+
+    Args:
+        corpus (IdeaCorpus): Ideas keyed by condition, object and ResponseId
+        embeddings (np.ndarray): Embeddings in corpus order
+        writer (PairwiseWriter, optional): Receives the pairs of every group
+        n_workers (int, optional): Worker processes (defaults to os.cpu_count()); 1 runs serially
+
+    Returns:
+        tuple: (SimilaritySummary by condition, SubmitterStats for the participant-level resampling tests)
+    """
+    similarity_summary = SimilaritySummary('condition')
+    submitter_stats = SubmitterStats()
+
+    # For each combination of experimental condition, object, and ResponseId, compute the semantic similarity of ideas
+    group_keys, groups = corpus.groups(['condition', 'object', 'ResponseId'])
+
+    # Groups are independent, so their similarities are computed on a process pool; workers read
+    # the embeddings from shared memory and results come back one group at a time, in group order
+    for group_index, similarities in parallel_group_similarities(embeddings, groups, n_workers=n_workers):
+        condition, obj, response_id = group_keys[group_index]
+        # Store results
+        similarity_summary.add(condition, similarities)
+        submitter_stats.add_values(condition, np.full(len(similarities), response_id), similarities)
+        if writer is not None:
+            writer.write({
+                'condition': condition,
+                'object': obj,
+                'ResponseId': response_id,
+                'similarity': similarities
+            })
+    return similarity_summary, submitter_stats
+
+
+# Guarded so that worker processes started by the process pool do not rerun the analysis
+if __name__ == '__main__':
+    # Load the data
+
+    data_path = '~/Git_Projects/idea_generation/data/evaluated_compliant_ideas.csv'  # Update with your actual data path
+    # Ideas sorted by condition, object and response, with integer-coded keys: every response's ideas
+    # for one object are a contiguous range of rows
+    corpus = IdeaCorpus.read_csv(data_path, keys=['condition', 'object', 'ResponseId'])
+
+    # Embed the whole corpus once (duplicates and cached ideas are not re-encoded), then slice per group
+    batch_size = 256  # Lower this if encoding runs out of memory
+    all_embeddings = encode_ideas(corpus.text_list(), normalization='none', batch_size=batch_size)
+
+    # Pairs are streamed to disk per group; use a '.parquet' path for columnar output with categorical
+    # condition/object columns. Set write_pairs = False to only compute the summary statistics.
+    write_pairs = True
+    output_path = os.path.expanduser('~/Git_Projects/idea_generation/data/semantic_similarities.csv')  # Update with your desired output path
+    writer = PairwiseWriter(output_path) if write_pairs else None
+    n_workers = os.cpu_count()  # Set to 1 to run on a single core
+    similarity_summary, submitter_stats = person_similarities(corpus, all_embeddings, writer=writer, n_workers=n_workers)
+
+    if writer is not None:
+        writer.close()
+
+    # Compute mean and standard deviation of similarities for each condition
+    summary = similarity_summary.summary()
+
+    # Display summary statistics
+    print(summary)
+
+    # Save summary statistics to CSV
+    summary_output_path = os.path.expanduser('~/Git_Projects/idea_generation/data/semantic_similarity_summary.csv')  # Update with your desired output path
+    summary.to_csv(summary_output_path)
+
+    # Run a simple ANOVA to see if there are significant differences between conditions
+    f_statistic, p_value = similarity_summary.anova()
+    print("ANOVA results:")
+    print(f"F-statistic: {f_statistic}")
+    print(f"P-value: {p_value}")
+
+    # Pairs from the same person are not independent: resample and permute whole participants instead
+    print("Cluster bootstrap by participant:")
+    print(bootstrap_condition_means(submitter_stats, n_workers=n_workers))
+    print("Permutation test (condition labels permuted across participants):")
+    print(permutation_test(submitter_stats, n_workers=n_workers))
@@ -0,0 +1,339 @@
+# Single entry point for the IRISS homogeneity analyses.
+# Each analysis script is a stage (load -> embed -> centroid / pairwise / person-level metrics ->
+# summaries and ANOVA) that calls the same function as the script, so the pipeline and the scripts
+# cannot drift apart. Stages exchange artifacts on disk; besides its value, a stage can write files
+# (e.g. the pair-level similarities), which are cached under the same key. An artifact is stored under a key that
+# hashes the stage's code version, its parameters and the content hashes of its inputs, so a rerun
+# only recomputes stages whose inputs actually changed; a stage that reruns but produces identical
+# output does not invalidate the stages after it. Embedding is additionally row-incremental through
+# the shared embedding cache, so a changed row only re-encodes that row.
+#
+# With --collapse-duplicates DISTANCE, near-duplicate ideas within a condition-object pair
+# (ann_index.collapse_near_duplicates) are counted once: every metric stage keeps only the first
+# idea of each duplicate group.
+#
+# Usage (from the repository root):
+#     python -m analyses.iriss.pipeline --data data/evaluated_compliant_ideas.csv
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from analyses.iriss.ann_index import IVFIndex, collapse_near_duplicates
+from analyses.iriss.centroid import centroid_distances
+from analyses.iriss.corpus import IdeaCorpus
+from analyses.iriss.doshi_analysis import doshi_similarities, sample_one_idea
+from analyses.iriss.embedding_store import DEFAULT_BATCH_SIZE, DEFAULT_CACHE_PATH, DEFAULT_MODEL, embed_column
+from analyses.iriss.pairwise_output import PairwiseWriter
+from analyses.iriss.person_level_homogeneity import person_similarities
+from analyses.iriss.semantic_similarity import pairwise_similarities
+
+DEFAULT_PARAMS = {
+    'data_path': 'data/evaluated_compliant_ideas.csv',
+    'model_name': DEFAULT_MODEL,
+    'encoder_backend': 'torch',
+    'embedding_cache': DEFAULT_CACHE_PATH,
+    'batch_size': DEFAULT_BATCH_SIZE,
+    'doshi_seed': 42,
+    'n_workers': None,  # worker processes of the person-level stage; does not change its output
+    'collapse_duplicates': None,  # cosine distance under which ideas count as one; None keeps every idea
+}
+
+
+class Stage:
+    """
+    One pipeline step.
+
+    Args:
+        name (str): Artifact name produced by the stage
+        func (callable): func(params, *input_artifacts) -> DataFrame or np.ndarray; stages with
+            files are called as func(params, *input_artifacts, files={suffix: path to write})
+        inputs (tuple): Names of the artifacts the stage reads
+        params (tuple): Names of the pipeline parameters that affect the output
+        version (int): Bump when the stage's code changes, to invalidate old artifacts
+        files (tuple): Suffixes of extra files the stage writes (e.g. 'pairs.parquet')
+    """
+
+    def __init__(self, name, func, inputs=(), params=(), version=1, files=()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.params = tuple(params)
+        self.version = version
+        self.files = tuple(files)
+
+
+def _hash_bytes(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# --- Stage functions ---
+
+def load_ideas(params):
+    df = pd.read_csv(os.path.expanduser(params['data_path']))
+    return df.reset_index(drop=True)
+
+
+def make_embed(normalization):
+    def embed(params, ideas):
+        return embed_column(ideas, 'use', normalization=normalization, batch_size=params['batch_size'],
+                            model_name=params['model_name'], backend=params['encoder_backend'],
+                            cache_path=os.path.expanduser(params['embedding_cache']))
+    return embed
+
+
+def duplicates_stage(params, ideas, embeddings):
+    # ann_index.py: duplicate-group label per idea (its own position when duplicates are not collapsed)
+    if params['collapse_duplicates'] is None:
+        return np.arange(len(ideas))
+    codes = ideas.groupby(['condition', 'object']).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    index = IVFIndex.build(embeddings, codes=codes)
+    return collapse_near_duplicates(index, ideas['use'].tolist(), params['collapse_duplicates'])
+
+
+def _distinct(ideas, embeddings, duplicate_groups):
+    """Keep the first idea of each duplicate group, with its embedding."""
+    keep = np.asarray(duplicate_groups) == np.arange(len(ideas))
+    if keep.all():
+        return ideas, embeddings
+    return ideas[keep].reset_index(drop=True), np.asarray(embeddings)[keep]
+
+
+def centroid_stage(params, ideas, embeddings, duplicate_groups):
+    # centroid.py
+    ideas, embeddings = _distinct(ideas, embeddings, duplicate_groups)
+    out = ideas.copy()
+    out['semantic_distance'] = centroid_distances(ideas, embeddings)
+    return out
+
+
+def doshi_stage(params, ideas, raw_embeddings, duplicate_groups):
+    # doshi_analysis.py
+    ideas, raw_embeddings = _distinct(ideas, raw_embeddings, duplicate_groups)
+    sampled = sample_one_idea(ideas, seed=params['doshi_seed'])
+    embeddings = raw_embeddings[sampled.index.to_numpy()]
+    sampled = sampled.reset_index(drop=True)
+    sampled['similarity_to_cond_obj'] = doshi_similarities(sampled, embeddings)
+    return sampled
+
+
+def _summary_frame(summary, metric):
+    f_statistic, p_value = summary.anova()
+    frame = summary.summary(include_count=True).reset_index()
+    frame.insert(0, 'metric', metric)
+    frame['anova_F'] = f_statistic
+    frame['anova_p'] = p_value
+    return frame
+
+
+def pairwise_stage(params, ideas, embeddings, duplicate_groups, files):
+    # semantic_similarity.py; the pairs are written to the stage's pairs file
+    ideas, embeddings = _distinct(ideas, embeddings, duplicate_groups)
+    corpus = IdeaCorpus.from_frame(ideas)
+    with PairwiseWriter(files['pairs.parquet']) as writer:
+        summary, _ = pairwise_similarities(corpus, corpus.take(embeddings), writer=writer)
+    return _summary_frame(summary, 'pairwise_similarity')
+
+
+def person_stage(params, ideas, raw_embeddings, duplicate_groups, files):
+    # person_level_homogeneity.py; the pairs are written to the stage's pairs file
+    ideas, raw_embeddings = _distinct(ideas, raw_embeddings, duplicate_groups)
+    corpus = IdeaCorpus.from_frame(ideas, keys=('condition', 'object', 'ResponseId'))
+    with PairwiseWriter(files['pairs.parquet']) as writer:
+        summary, _ = person_similarities(corpus, corpus.take(raw_embeddings), writer=writer,
+                                         n_workers=params['n_workers'])
+    return _summary_frame(summary, 'person_level_similarity')
+
+
+def combine_summaries(params, centroids, doshi, pairwise, person):
+    frames = []
+    for metric, frame, column in (('semantic_distance', centroids, 'semantic_distance'),
+                                  ('doshi_similarity', doshi, 'similarity_to_cond_obj')):
+        stats = frame.groupby('condition')[column].agg(['mean', 'std', 'count']).reset_index()
+        stats.insert(0, 'metric', metric)
+        frames.append(stats)
+    frames.extend([pairwise, person])
+    return pd.concat(frames, ignore_index=True)
+
+
+STAGES = [
+    Stage('ideas', load_ideas, params=('data_path',)),
+    Stage('embeddings', make_embed('strip_lower'), inputs=('ideas',), params=('model_name', 'encoder_backend')),
+    Stage('raw_embeddings', make_embed('none'), inputs=('ideas',), params=('model_name', 'encoder_backend')),
+    Stage('duplicate_groups', duplicates_stage, inputs=('ideas', 'embeddings'), params=('collapse_duplicates',)),
+    Stage('centroids', centroid_stage, inputs=('ideas', 'embeddings', 'duplicate_groups'), version=3),
+    Stage('doshi', doshi_stage, inputs=('ideas', 'raw_embeddings', 'duplicate_groups'), params=('doshi_seed',),
+          version=3),
+    Stage('pairwise_summary', pairwise_stage, inputs=('ideas', 'embeddings', 'duplicate_groups'), version=3,
+          files=('pairs.parquet',)),
+    Stage('person_summary', person_stage, inputs=('ideas', 'raw_embeddings', 'duplicate_groups'), version=3,
+          files=('pairs.parquet',)),
+    Stage('summary', combine_summaries, inputs=('centroids', 'doshi', 'pairwise_summary', 'person_summary')),
+]
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order, reusing cached artifacts whose key has not changed.
+
+    Args:
+        cache_dir (str): Directory holding the stage artifacts
+        params (dict): Pipeline parameters (defaults in DEFAULT_PARAMS)
+        stages (list): Stage definitions, in an order where inputs come first
+    """
+
+    def __init__(self, cache_dir='data/pipeline_cache', params=None, stages=STAGES):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.params = {**DEFAULT_PARAMS, **(params or {})}
+        self.stages = {stage.name: stage for stage in stages}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _required(self, targets):
+        """Return the stages needed for the targets, inputs first."""
+        order = []
+
+        def visit(name):
+            if name in order:
+                return
+            for dependency in self.stages[name].inputs:
+                visit(dependency)
+            order.append(name)
+
+        for target in targets:
+            visit(target)
+        return order
+
+    def _source_hash(self, stage):
+        # The loading stage depends on the content of the data file, not just its path
+        if stage.name == 'ideas':
+            return _hash_file(os.path.expanduser(self.params['data_path']))
+        return ''
+
+    def _artifact_path(self, name, key, value=None):
+        extension = '.npy' if isinstance(value, np.ndarray) else '.pkl'
+        if value is None:
+            for extension in ('.npy', '.pkl'):
+                path = os.path.join(self.cache_dir, f"{name}-{key[:20]}{extension}")
+                if os.path.exists(path):
+                    return path
+            return None
+        return os.path.join(self.cache_dir, f"{name}-{key[:20]}{extension}")
+
+    def _file_path(self, name, key, suffix):
+        return os.path.join(self.cache_dir, f"{name}-{key[:20]}.{suffix}")
+
+    def _read(self, path):
+        if path.endswith('.npy'):
+            return np.load(path, mmap_mode='r')
+        return pd.read_pickle(path)
+
+    def _write(self, path, value):
+        tmp_path = path + '.tmp'
+        if isinstance(value, np.ndarray):
+            with open(tmp_path, 'wb') as f:
+                np.save(f, value)
+        else:
+            value.to_pickle(tmp_path, compression=None)
+        # The hash goes next to the artifact before the artifact is moved into place, so an artifact
+        # never exists without its hash; a hash without an artifact is simply overwritten next time
+        content_hash = _hash_file(tmp_path)
+        with open(path + '.sha256.tmp', 'w') as f:
+            f.write(content_hash)
+        os.replace(path + '.sha256.tmp', path + '.sha256')
+        os.replace(tmp_path, path)
+        return content_hash
+
+    def run(self, targets=('summary',), force=()):
+        """
+        Compute the targets, rerunning only stages whose inputs or parameters changed.
+
+        Args:
+            targets (iterable): Artifact names to produce
+            force (iterable): Stage names to recompute even if a cached artifact exists
+
+        Returns:
+            dict: Artifact name -> path of the artifact file; the files a stage writes are listed
+            as "<stage name>.<suffix>" (e.g. "pairwise_summary.pairs.parquet")
+        """
+        hashes, paths, values = {}, {}, {}
+        for name in self._required(targets):
+            stage = self.stages[name]
+            key = _hash_bytes(
+                stage.name, stage.version, self._source_hash(stage),
+                json.dumps({p: self.params[p] for p in stage.params}, sort_keys=True),
+                *(hashes[i] for i in stage.inputs),
+            )
+            path = self._artifact_path(name, key)
+            file_paths = {suffix: self._file_path(name, key, suffix) for suffix in stage.files}
+            # An artifact without its hash (written by an older version, or left by a crash) is recomputed
+            cached = (path is not None and os.path.exists(path + '.sha256')
+                      and all(os.path.exists(p) for p in file_paths.values()))
+            if cached and name not in force:
+                print(f"[cached]   {name}")
+                with open(path + '.sha256') as f:
+                    hashes[name] = f.read().strip()
+            else:
+                print(f"[running]  {name}")
+                inputs = [values[i] if i in values else self._read(paths[i]) for i in stage.inputs]
+                if stage.files:
+                    # Written under a partial name (keeping the extension) and moved into place once complete
+                    partial = {suffix: self._file_path(name, key, 'partial.' + suffix) for suffix in stage.files}
+                    value = stage.func(self.params, *inputs, files=partial)
+                    for suffix in stage.files:
+                        os.replace(partial[suffix], file_paths[suffix])
+                else:
+                    value = stage.func(self.params, *inputs)
+                path = self._artifact_path(name, key, value)
+                hashes[name] = self._write(path, value)
+                values[name] = value
+            paths[name] = path
+            for suffix, file_path in file_paths.items():
+                paths[f"{name}.{suffix}"] = file_path
+        return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the IRISS homogeneity analyses with stage caching.")
+    parser.add_argument('--data', default=DEFAULT_PARAMS['data_path'], help="Ideas CSV")
+    parser.add_argument('--cache-dir', default='data/pipeline_cache', help="Directory for stage artifacts")
+    parser.add_argument('--output', default='data/homogeneity_summary.csv', help="Where to write the summary table")
+    parser.add_argument('--targets', nargs='+', default=['summary'], help="Artifacts to produce")
+    parser.add_argument('--force', nargs='*', default=[], help="Stages to recompute regardless of the cache")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--encoder-backend', default='torch', choices=('torch', 'int8', 'onnx', 'onnx_int8'))
+    parser.add_argument('--n-workers', type=int, default=None, help="Worker processes for the person-level stage")
+    parser.add_argument('--collapse-duplicates', type=float, default=None, metavar='DISTANCE',
+                        help="Count ideas within this cosine distance (or with the same canonical text) once")
+    args = parser.parse_args()
+
+    pipeline = Pipeline(args.cache_dir, params={
+        'data_path': args.data, 'batch_size': args.batch_size, 'encoder_backend': args.encoder_backend,
+        'n_workers': args.n_workers, 'collapse_duplicates': args.collapse_duplicates,
+    })
+    paths = pipeline.run(args.targets, force=args.force)
+    print("\nStage outputs:")
+    for name, path in paths.items():
+        print(f"  {name}: {path}")
+    if 'summary' in paths:
+        summary = pd.read_pickle(paths['summary'])
+        summary.to_csv(args.output, index=False)
+        print(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+# Cluster bootstrap and permutation tests for condition differences in homogeneity.
+# Pairwise similarities are not independent (every idea appears in many pairs), so inference
+# resamples submitters instead of pairs. Each submitter is reduced once to sufficient statistics
+# (sum, count and sum of squares of the values it contributes); a pair between two submitters
+# contributes half of its value to each. A resampled condition mean is then a weighted sum over
+# submitters, so every resample costs O(#submitters) instead of O(#pairs). Resamples are drawn in
+# batches as weight matrices and reduced with matrix products; batches can be spread over worker
+# processes, each with its own seed derived from the base seed, so results do not depend on the
+# number of workers (by default one per CPU).
+#
+# The unit of resampling is the (condition, submitter) entry of SubmitterStats. The permutation test
+# shuffles condition labels across these entries, which is a permutation of whole submitters only if
+# every submitter is in one condition; permutation_test checks this and raises ValueError otherwise.
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class SubmitterStats:
+    """
+    Per-(condition, submitter) sums, counts and sums of squares of similarity values.
+
+    Totals over submitters equal the totals over the raw values, so condition means and the
+    ANOVA F-statistic computed from these statistics match those of the raw values.
+    """
+
+    def __init__(self):
+        self._stats = {}
+
+    def _accumulate(self, condition, submitters, values, weight):
+        submitters = np.asarray(submitters)
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        keys, inverse = np.unique(submitters, return_inverse=True)
+        sums = np.bincount(inverse, weights=values * weight, minlength=len(keys))
+        counts = np.bincount(inverse, minlength=len(keys)) * weight
+        squares = np.bincount(inverse, weights=values ** 2 * weight, minlength=len(keys))
+        for key, s, n, q in zip(keys.tolist(), sums, counts, squares):
+            total = self._stats.setdefault((condition, key), np.zeros(3))
+            total += (s, n, q)
+
+    def add_values(self, condition, submitters, values):
+        """Add one value per submitter entry (e.g. per-idea centroid similarities)."""
+        self._accumulate(condition, submitters, values, 1.0)
+
+    def add_pairs(self, condition, submitters_a, submitters_b, values):
+        """Add pair similarities; each pair counts half towards each of its two submitters."""
+        self._accumulate(condition, submitters_a, values, 0.5)
+        self._accumulate(condition, submitters_b, values, 0.5)
+
+    def shared_submitters(self):
+        """Submitters with values in more than one condition (sorted)."""
+        conditions = {}
+        for condition, submitter in self._stats:
+            conditions.setdefault(submitter, set()).add(condition)
+        return sorted(submitter for submitter, found in conditions.items() if len(found) > 1)
+
+    def arrays(self):
+        """
+        Return (conditions, condition codes, sums, counts, sums of squares), one entry per submitter.
+
+        conditions is the sorted list of condition names; codes index into it.
+        """
+        keys = sorted(self._stats)
+        conditions = sorted({condition for condition, _ in keys})
+        position = {condition: i for i, condition in enumerate(conditions)}
+        codes = np.array([position[condition] for condition, _ in keys], dtype=np.int64)
+        totals = np.array([self._stats[key] for key in keys]).reshape(-1, 3)
+        return conditions, codes, totals[:, 0], totals[:, 1], totals[:, 2]
+
+
+def _f_statistic(sums, counts, squares):
+    """One-way ANOVA F from per-condition totals; the arrays have shape (..., n_conditions)."""
+    n_groups = sums.shape[-1]
+    n_total = counts.sum(axis=-1)
+    between_part = np.sum(sums ** 2 / counts, axis=-1)
+    ss_between = between_part - sums.sum(axis=-1) ** 2 / n_total
+    ss_within = squares.sum(axis=-1) - between_part
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (ss_between / (n_groups - 1)) / (ss_within / (n_total - n_groups))
+
+
+def _bootstrap_batch(args):
+    codes, sums, counts, n_conditions, size, seed = args
+    rng = np.random.default_rng(seed)
+    means = np.empty((size, n_conditions))
+    for k in range(n_conditions):
+        members = np.flatnonzero(codes == k)
+        # Multinomial counts = how often each submitter is drawn in each resample
+        weights = rng.multinomial(len(members), np.full(len(members), 1 / len(members)), size=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[:, k] = (weights @ sums[members]) / (weights @ counts[members])
+    return means
+
+
+def _permutation_batch(args):
+    codes, sums, counts, squares, n_conditions, size, seed = args
+    rng = np.random.default_rng(seed)
+    # One random permutation of the condition labels per row
+    labels = codes[np.argsort(rng.random((size, len(codes))), axis=1)]
+    group_sums = np.empty((size, n_conditions))
+    group_counts = np.empty((size, n_conditions))
+    group_squares = np.empty((size, n_conditions))
+    for k in range(n_conditions):
+        mask = (labels == k).astype(np.float64)
+        group_sums[:, k] = mask @ sums
+        group_counts[:, k] = mask @ counts
+        group_squares[:, k] = mask @ squares
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = group_sums / group_counts
+    return np.column_stack([_f_statistic(group_sums, group_counts, group_squares), means])
+
+
+def _run_batches(func, make_args, n_resamples, seed, batch_size, n_workers):
+    sizes = [min(batch_size, n_resamples - start) for start in range(0, n_resamples, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [make_args(size, child) for size, child in zip(sizes, seeds)]
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers == 1 or len(tasks) == 1:
+        return np.concatenate([func(task) for task in tasks])
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return np.concatenate(list(executor.map(func, tasks)))
+
+
+def _differences(conditions):
+    return list(combinations(range(len(conditions)), 2))
+
+
+def bootstrap_condition_means(stats, n_resamples=10_000, seed=42, ci=0.95, batch_size=DEFAULT_BATCH_SIZE,
+                              n_workers=None):
+    """
+    Cluster bootstrap of condition means, resampling submitters within each condition.
+
+    Args:
+        stats (SubmitterStats): Accumulated per-submitter statistics
+        n_resamples (int): Bootstrap resamples
+        seed (int): Base seed
+        ci (float): Confidence level of the percentile intervals
+        batch_size (int): Resamples drawn per matrix product
+        n_workers (int, optional): Worker processes (None = os.cpu_count()); 1 runs serially
+
+    Returns:
+        DataFrame: One row per condition mean and per pairwise difference, with the estimate,
+        bootstrap standard error and percentile confidence interval
+    """
+    conditions, codes, sums, counts, _ = stats.arrays()
+    n_conditions = len(conditions)
+    means = _run_batches(_bootstrap_batch, lambda size, child: (codes, sums, counts, n_conditions, size, child),
+                         n_resamples, seed, batch_size, n_workers)
+    observed = np.bincount(codes, weights=sums, minlength=n_conditions) / np.bincount(codes, weights=counts,
+                                                                                    minlength=n_conditions)
+
+    labels = list(conditions)
+    estimates = [observed]
+    replicates = [means]
+    for a, b in _differences(conditions):
+        labels.append(f"{conditions[a]} - {conditions[b]}")
+        estimates.append(observed[[a]] - observed[[b]])
+        replicates.append(means[:, [a]] - means[:, [b]])
+    estimates = np.concatenate(estimates)
+    replicates = np.concatenate(replicates, axis=1)
+
+    alpha = (1 - ci) / 2
+    return pd.DataFrame({
+        'estimate': estimates,
+        'se': np.nanstd(replicates, axis=0, ddof=1),
+        'ci_low': np.nanquantile(replicates, alpha, axis=0),
+        'ci_high': np.nanquantile(replicates, 1 - alpha, axis=0),
+    }, index=pd.Index(labels, name='comparison'))
+
+
+def permutation_test(stats, n_permutations=10_000, seed=42, batch_size=DEFAULT_BATCH_SIZE, n_workers=None):
+    """
+    Permutation test of condition differences, permuting condition labels across submitters.
+
+    Args:
+        stats (SubmitterStats): Accumulated per-submitter statistics
+        n_permutations (int): Random permutations
+        seed (int): Base seed
+        batch_size (int): Permutations drawn per matrix product
+        n_workers (int, optional): Worker processes (None = os.cpu_count()); 1 runs serially
+
+    Returns:
+        DataFrame: The ANOVA F-statistic and each pairwise difference of condition means, with
+        observed values and permutation p-values (two-sided for differences)
+
+    Raises:
+        ValueError: If a submitter has values in more than one condition, so that permuting
+            entries would not permute whole submitters
+    """
+    shared = stats.shared_submitters()
+    if shared:
+        raise ValueError(f"{len(shared)} submitters appear in more than one condition (e.g. {shared[:5]}); "
+                         "condition labels can only be permuted across submitters in a single condition")
+    conditions, codes, sums, counts, squares = stats.arrays()
+    n_conditions = len(conditions)
+    permuted = _run_batches(_permutation_batch,
+                            lambda size, child: (codes, sums, counts, squares, n_conditions, size, child),
+                            n_permutations, seed, batch_size, n_workers)
+
+    def totals(values):
+        return np.bincount(codes, weights=values, minlength=n_conditions)
+
+    observed_means = totals(sums) / totals(counts)
+    observed_f = _f_statistic(totals(sums), totals(counts), totals(squares))
+    rows = [('F', observed_f, (np.sum(permuted[:, 0] >= observed_f) + 1) / (n_permutations + 1))]
+    permuted_means = permuted[:, 1:]
+    for a, b in _differences(conditions):
+        observed = observed_means[a] - observed_means[b]
+        null = permuted_means[:, a] - permuted_means[:, b]
+        p_value = (np.sum(np.abs(null) >= abs(observed)) + 1) / (n_permutations + 1)
+        rows.append((f"{conditions[a]} - {conditions[b]}", observed, p_value))
+    return pd.DataFrame(rows, columns=['comparison', 'observed', 'p_value']).set_index('comparison')
@@ -1,70 +1,97 @@
 # Use a sentence embedding model to find the semantic similarity of ideas within each experimental condition
 
-import pandas as pd
-from sentence_transformers import SentenceTransformer
 import numpy as np
 import os
-import scipy.stats as stats
-import nltk
-from nltk.corpus import stopwords
-
-nltk.download('stopwords')
-
-# Load the sentence transformer model
-model = SentenceTransformer("all-MiniLM-L6-v2")
-
-# Load the data
-
-data_path = '~/Git_Projects/idea_generation/data/evaluated_compliant_ideas.csv'  # Update with your actual data path
-df = pd.read_csv(data_path)
-
-# Compute the pairwise cosine similarity of ideas by condition and object
-# Create a new column to track whether the comparison is within the same submitter or not
-
-results = []
-for (condition, obj), group in df.groupby(['condition', 'object']):
-    ideas = group['use'].tolist()
 
+from analyses.iriss.corpus import IdeaCorpus
+from analyses.iriss.embedding_store import encode_ideas
+from analyses.iriss.pairwise_kernel import iter_similarity_blocks
+from analyses.iriss.pairwise_output import PairwiseWriter, SimilaritySummary
+from analyses.iriss.resampling import SubmitterStats, bootstrap_condition_means, permutation_test
+
+
+def pairwise_similarities(corpus, embeddings, writer=None):
+    """
+    Cosine similarities of the pairs of ideas from different submitters within each condition-object pair.
+
+    Args:
+        corpus (IdeaCorpus): Ideas keyed by condition, object and submitter_id
+        embeddings (np.ndarray): Embeddings in corpus order
+        writer (PairwiseWriter, optional): Receives every pair, one tile at a time
+
+    Returns:
+        tuple: (SimilaritySummary by condition, SubmitterStats for the submitter-level resampling tests)
+    """
+    similarity_summary = SimilaritySummary('condition')
+    submitter_stats = SubmitterStats()
+
+    group_keys, groups = corpus.groups(['condition', 'object'])
+    for (condition, obj), rows in zip(group_keys, groups):
+        # The group's rows of the embedding matrix (a view, no copy)
+        group_embeddings = embeddings[rows]
+
+        # Cosine similarities of upper-triangle pairs (i < j), computed tile by tile,
+        # keeping only different-submitter pairs (compared by integer code). An idea with a missing
+        # submitter (code -1) counts as its own submitter: it gets a negative code unique to its row
+        submitters = corpus.codes['submitter_id'][rows].astype(np.int64)
+        submitters = np.where(submitters >= 0, submitters, -1 - np.arange(rows.start, rows.stop))
+        submitter_labels = corpus.labels('submitter_id', rows)
+        for i_keep, j_keep, similarities in iter_similarity_blocks(group_embeddings, submitters=submitters):
+            # Store only different-submitter similarities
+            similarity_summary.add(condition, similarities)
+            submitter_stats.add_pairs(condition, submitters[i_keep], submitters[j_keep], similarities)
+            if writer is not None:
+                writer.write({
+                    'condition': condition,
+                    'object': obj,
+                    'similarity': similarities,
+                    'submitter_comparison': 'different_submitter',
+                    'submitter_id': submitter_labels[i_keep]
+                })
+    return similarity_summary, submitter_stats
+
+
+# Guarded so that importing this module does not run the analysis
+if __name__ == '__main__':
+    # Load the data
+
+    data_path = '~/Git_Projects/idea_generation/data/evaluated_compliant_ideas.csv'  # Update with your actual data path
+    # Ideas sorted by condition, object and submitter, with integer-coded keys: every condition-object
+    # pair is a contiguous range of rows
+    corpus = IdeaCorpus.read_csv(data_path)
+
+    # Embed the whole corpus once (duplicates and cached ideas are not re-encoded), then slice per group.
     # Preprocess ideas (e.g., strip whitespace, convert to lowercase) to ensure consistency
-    ideas = [idea.strip().lower() for idea in ideas]
-
-    # Compute embeddings
-    embeddings = model.encode(ideas)
-
-    # Compute cosine similarity matrix
-    norm_embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
-    similarity_matrix = np.dot(norm_embeddings, norm_embeddings.T)
-
-   # Upper-triangle pair indices (i < j)
-    upper_i, upper_j = np.triu_indices_from(similarity_matrix, k=1)
-
-    # Keep only different-submitter pairs
-    submitters = group['submitter_id'].to_numpy()
-    mask = submitters[upper_i] != submitters[upper_j]
-
-    i_keep = upper_i[mask]
-    j_keep = upper_j[mask]
-
-    # Store only different-submitter similarities
-    for i, j in zip(i_keep, j_keep):
-        results.append({
-            'condition': condition,
-            'object': obj,
-            'similarity': similarity_matrix[i, j],
-            'submitter_comparison': 'different_submitter',
-            'submitter_id': submitters[i]
-        })
-
-# Convert results to DataFrame
-results_df = pd.DataFrame(results)
-
-# Save results to CSV
-output_path = os.path.expanduser('~/Git_Projects/psych252/final-project-sarah-wu/data/pairwise_similarities.csv')  # Update with your desired output path
-results_df.to_csv(output_path, index=False)
-
-# Compute mean and standard deviation of similarities for each condition
-summary = results_df.groupby('condition')['similarity'].agg(['mean', 'std'])
-
-# Display summary statistics
-print(summary)
-
+    batch_size = 256  # Lower this if encoding runs out of memory
+    all_embeddings = encode_ideas(corpus.text_list(), normalization='strip_lower', batch_size=batch_size)
+
+    # Compute the pairwise cosine similarity of ideas by condition and object
+
+    # Pairs are streamed to disk per group; use a '.parquet' path for columnar output with categorical
+    # condition/object columns. Set write_pairs = False to only compute the summary statistics.
+    write_pairs = True
+    output_path = os.path.expanduser('~/Git_Projects/psych252/final-project-sarah-wu/data/pairwise_similarities.csv')  # Update with your desired output path
+    writer = PairwiseWriter(output_path) if write_pairs else None
+    similarity_summary, submitter_stats = pairwise_similarities(corpus, all_embeddings, writer=writer)
+
+    if writer is not None:
+        writer.close()
+
+    # Compute mean and standard deviation of similarities for each condition
+    summary = similarity_summary.summary()
+
+    # Display summary statistics
+    print(summary)
+
+    # Run a simple ANOVA to see if there are significant differences between conditions
+    f_statistic, p_value = similarity_summary.anova()
+    print("ANOVA results:")
+    print(f"F-statistic: {f_statistic}")
+    print(f"P-value: {p_value}")
+
+    # Each idea appears in many pairs, so test condition differences by resampling submitters, not pairs
+    n_workers = os.cpu_count()  # Set to 1 to run on a single core
+    print("Cluster bootstrap by submitter:")
+    print(bootstrap_condition_means(submitter_stats, n_workers=n_workers))
+    print("Permutation test (condition labels permuted across submitters):")
+    print(permutation_test(submitter_stats, n_workers=n_workers))
@@ -0,0 +1,72 @@
+# Sample a fixed number of rows from every stratum (e.g. condition-object pair) in one vectorized pass.
+# Rows are ordered by stratum once; each row gets a random key from a single seeded generator, and
+# the rows with the n smallest keys in each stratum are kept. The sample is stored sorted by stratum,
+# so each stratum is a contiguous slice of the result instead of a boolean filter.
+import numpy as np
+
+
+class StratifiedSample:
+    """
+    Result of stratified_sample: the sampled rows plus the slice boundaries of each stratum.
+
+    Args:
+        frame (DataFrame): Sampled rows, sorted by stratum
+        keys (list): Stratum keys in the order they appear in frame
+        starts (np.ndarray): Start position of each stratum in frame (with the end as last element)
+    """
+
+    def __init__(self, frame, keys, starts):
+        self.frame = frame
+        self.keys = keys
+        self.starts = starts
+        self._positions = {key: i for i, key in enumerate(keys)}
+
+    def __len__(self):
+        return len(self.frame)
+
+    def stratum(self, key):
+        """Return the sampled rows of one stratum as a positional slice of frame."""
+        i = self._positions[key]
+        return self.frame.iloc[self.starts[i]:self.starts[i + 1]]
+
+    def items(self):
+        """Iterate over (key, rows) for every stratum."""
+        for i, key in enumerate(self.keys):
+            yield key, self.frame.iloc[self.starts[i]:self.starts[i + 1]]
+
+
+def stratified_sample(df, by, n_samples, seed=42):
+    """
+    Sample up to n_samples rows from every stratum of df without a per-group loop.
+
+    Strata with fewer than n_samples rows are returned whole instead of raising.
+
+    Args:
+        df (DataFrame): Data to sample from
+        by (list): Columns defining the strata (e.g. ['condition', 'object'])
+        n_samples (int): Rows to sample per stratum
+        seed (int): Seed of the single random generator used for all strata
+
+    Returns:
+        StratifiedSample: Sampled rows with per-stratum slices
+    """
+    grouped = df.groupby(by, sort=True)
+    codes = grouped.ngroup().to_numpy()
+    keys = list(grouped.groups.keys())
+    valid = ~np.isnan(codes) if codes.dtype.kind == 'f' else codes >= 0
+    positions = np.flatnonzero(valid)
+    codes = codes[valid].astype(np.int64)
+
+    # Order rows by stratum, and randomly within each stratum
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(len(codes)), codes))
+    counts = np.bincount(codes, minlength=len(keys))
+    group_starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    # Rank of each row within its stratum in the shuffled order; keep the first n_samples
+    rank = np.arange(len(order)) - group_starts[codes[order]]
+    selected = order[rank < n_samples]
+
+    taken = np.minimum(counts, n_samples)
+    starts = np.concatenate([[0], np.cumsum(taken)])
+    return StratifiedSample(df.iloc[positions[selected]], keys, starts)
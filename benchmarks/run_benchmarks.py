@@ -0,0 +1,308 @@
+# Benchmarks for the analysis and API hot paths on synthetic idea corpora.
+# A corpus has n_conditions x n_submitters (per condition) x n_objects x ideas_per_submitter rows;
+# ideas are short random phrases embedded by a stub encoder (sum of random word vectors), so no
+# model is downloaded and runs are reproducible. Each metric is timed over several repeats and then
+# run once more under tracemalloc for its peak memory; the API endpoints are load-tested in process
+# through an ASGI client. The metrics are timed through the same functions the analysis scripts and
+# the pipeline call. Results go to a JSON report that can be compared with an earlier one.
+#
+# Install the extra benchmark dependencies with: pip install -r benchmarks/requirements.txt
+#
+# Usage (from the repository root):
+#     python -m benchmarks.run_benchmarks --size medium --output bench_medium.json
+#     python -m benchmarks.run_benchmarks --size medium --compare bench_medium.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from analyses.iriss.centroid import centroid_distances
+from analyses.iriss.corpus import IdeaCorpus
+from analyses.iriss.doshi_analysis import doshi_similarities, sample_one_idea
+from analyses.iriss.person_level_homogeneity import person_similarities
+from analyses.iriss.semantic_similarity import pairwise_similarities
+
+# (n_conditions, n_objects, submitters per condition, ideas per submitter and object)
+SIZES = {
+    'small': (3, 3, 50, 5),
+    'medium': (3, 3, 300, 8),
+    'large': (3, 6, 1000, 10),
+}
+
+EMBEDDING_DIM = 384
+_WORDS_PER_OBJECT = 400
+
+
+class StubEncoder:
+    """
+    Deterministic stand-in for SentenceTransformer: a text is embedded as the sum of random word vectors.
+
+    Has the same encode(texts, batch_size, show_progress_bar) signature, so it can also replace the
+    model of an EmbeddingStore.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, seed=0):
+        self.dim = dim
+        self.seed = seed
+        self._vocabulary = {}
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+
+    def _word_ids(self, words):
+        new_words = [word for word in dict.fromkeys(words) if word not in self._vocabulary]
+        if new_words:
+            start = len(self._vocabulary)
+            self._vocabulary.update((word, start + i) for i, word in enumerate(new_words))
+            rng = np.random.default_rng([self.seed, start])
+            self._vectors = np.vstack([self._vectors, rng.standard_normal((len(new_words), self.dim), dtype=np.float32)])
+        return np.array([self._vocabulary[word] for word in words], dtype=np.int64)
+
+    def encode(self, texts, batch_size=None, show_progress_bar=False, **kwargs):
+        tokens = [text.split() or [''] for text in texts]
+        lengths = np.array([len(t) for t in tokens])
+        ids = self._word_ids([word for t in tokens for word in t])
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        return np.add.reduceat(self._vectors[ids], starts, axis=0)
+
+
+def synthetic_corpus(n_conditions, n_objects, n_submitters, ideas_per_submitter, seed=42):
+    """
+    Generate an idea corpus with the columns used by the analysis scripts and the API.
+
+    Every submitter belongs to one condition and lists ideas_per_submitter ideas for every object.
+    Ideas are 2-6 words drawn from a vocabulary per object, so ideas for the same object overlap.
+    """
+    rng = np.random.default_rng(seed)
+    conditions = np.array([f"condition_{c}" for c in range(n_conditions)])
+    objects = np.array([f"object_{o}" for o in range(n_objects)])
+
+    c, s, o, _ = np.meshgrid(np.arange(n_conditions), np.arange(n_submitters), np.arange(n_objects),
+                             np.arange(ideas_per_submitter), indexing='ij')
+    c, s, o = c.ravel(), s.ravel(), o.ravel()
+    submitter_ids = np.char.add(np.char.add(conditions[c], '_s'), s.astype(str))
+
+    # Zipf-like word popularity, so some ideas repeat as they do in real data
+    popularity = 1 / np.arange(1, _WORDS_PER_OBJECT + 1)
+    popularity /= popularity.sum()
+    n_words = rng.integers(2, 7, len(c))
+    words = rng.choice(_WORDS_PER_OBJECT, size=(len(c), 6), p=popularity)
+    uses = [' '.join(f"w{obj}_{w}" for w in row[:k]) for obj, row, k in zip(o, words, n_words)]
+
+    return pd.DataFrame({
+        'condition': conditions[c],
+        'object': objects[o],
+        'submitter_id': submitter_ids,
+        'ResponseId': submitter_ids,
+        'use': uses,
+    })
+
+
+# --- Analysis benchmarks (each runs the core function of one script) ---
+
+def bench_centroid(df, embeddings, n_workers):
+    # centroid.py
+    return centroid_distances(df, embeddings)
+
+
+def bench_doshi(df, embeddings, n_workers):
+    # doshi_analysis.py
+    sampled = sample_one_idea(df, seed=42)
+    rows = sampled.index.to_numpy()
+    return doshi_similarities(sampled.reset_index(drop=True), embeddings[rows])
+
+
+def bench_pairwise(df, embeddings, n_workers):
+    # semantic_similarity.py, including building the corpus as the script does
+    corpus = IdeaCorpus.from_frame(df)
+    summary, _ = pairwise_similarities(corpus, corpus.take(embeddings))
+    return summary.anova()
+
+
+def bench_person(df, embeddings, n_workers):
+    # person_level_homogeneity.py, including building the corpus as the script does
+    corpus = IdeaCorpus.from_frame(df, keys=('condition', 'object', 'ResponseId'))
+    summary, _ = person_similarities(corpus, corpus.take(embeddings), n_workers=n_workers)
+    return summary.anova()
+
+
+ANALYSIS_BENCHMARKS = {
+    'centroid': bench_centroid,
+    'doshi': bench_doshi,
+    'pairwise': bench_pairwise,
+    'person': bench_person,
+}
+
+
+def time_call(func, *args, repeats=3):
+    """Median and minimum wall time over repeats, then peak traced memory of one more call."""
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'seconds_median': statistics.median(seconds),
+        'seconds_min': min(seconds),
+        'peak_traced_mb': peak / 2 ** 20,
+    }
+
+
+# --- API load test ---
+
+async def _load_test(app, url, n_requests, concurrency):
+    import httpx
+
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+        queue = iter(range(n_requests))
+
+        async def worker():
+            for _ in queue:
+                start = time.perf_counter()
+                response = await client.get(url)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': n_requests,
+        'concurrency': concurrency,
+        'requests_per_second': n_requests / elapsed,
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p95': float(np.percentile(latencies, 95)),
+        'latency_ms_p99': float(np.percentile(latencies, 99)),
+    }
+
+
+def bench_api(df, n_requests, concurrency):
+    """Serve df from a temporary snapshot and load-test the sampling endpoints."""
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'stimuli.csv')
+        df.to_csv(csv_path, index=False)
+        # The app builds its stimulus store at import, from these paths
+        os.environ['STIMULUS_CSV_PATH'] = csv_path
+        os.environ['STIMULUS_SNAPSHOT_PATH'] = os.path.join(directory, 'stimuli.snapshot')
+        from creative_uses_api.app import app
+
+        results = {}
+        for url in ('/sample?n=10', '/sample?n=100', '/stratified_sample?n_per_category=5',
+                    '/stratified_sample?n_per_category=50', '/stratified_sample?n_per_category=5&balanced=true'):
+            results[f"api:{url}"] = asyncio.run(_load_test(app, url, n_requests, concurrency))
+        return results
+
+
+# --- Report ---
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_reports(current, previous):
+    """Print the ratio of current to previous timings for benchmarks present in both reports."""
+    print(f"\n{'benchmark':55s} {'previous':>10s} {'current':>10s} {'ratio':>7s}")
+    for name, result in current['results'].items():
+        old = previous['results'].get(name)
+        if old is None:
+            continue
+        key = 'seconds_median' if 'seconds_median' in result else 'latency_ms_p50'
+        print(f"{name:55s} {old[key]:10.4f} {result[key]:10.4f} {result[key] / old[key]:7.2f}")
+    if current['config'] != previous['config']:
+        print("Note: the reports were produced with different configurations")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the homogeneity metrics and the stimulus API.")
+    parser.add_argument('--size', choices=sorted(SIZES), default='small', help="Preset corpus size")
+    parser.add_argument('--conditions', type=int)
+    parser.add_argument('--objects', type=int)
+    parser.add_argument('--submitters', type=int, help="Submitters per condition")
+    parser.add_argument('--ideas-per-submitter', type=int, help="Ideas per submitter and object")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes for the person-level metric")
+    parser.add_argument('--only', nargs='+', choices=[*ANALYSIS_BENCHMARKS, 'api'], help="Run only these benchmarks")
+    parser.add_argument('--api-requests', type=int, default=2000)
+    parser.add_argument('--api-concurrency', type=int, default=16)
+    parser.add_argument('--output', default='bench_report.json', help="Where to write the JSON report")
+    parser.add_argument('--compare', help="Earlier report to compare against")
+    args = parser.parse_args()
+
+    n_conditions, n_objects, n_submitters, ideas_per_submitter = SIZES[args.size]
+    config = {
+        'n_conditions': args.conditions or n_conditions,
+        'n_objects': args.objects or n_objects,
+        'n_submitters': args.submitters or n_submitters,
+        'ideas_per_submitter': args.ideas_per_submitter or ideas_per_submitter,
+        'repeats': args.repeats,
+        'workers': args.workers,
+        'embedding_dim': EMBEDDING_DIM,
+    }
+    selected = args.only or [*ANALYSIS_BENCHMARKS, 'api']
+
+    start = time.perf_counter()
+    df = synthetic_corpus(config['n_conditions'], config['n_objects'], config['n_submitters'],
+                          config['ideas_per_submitter'])
+    embeddings = StubEncoder().encode(df['use'].tolist())
+    print(f"Corpus: {len(df)} ideas, generated and embedded in {time.perf_counter() - start:.2f}s")
+
+    results = {}
+    for name, func in ANALYSIS_BENCHMARKS.items():
+        if name in selected:
+            results[name] = time_call(func, df, embeddings, args.workers, repeats=args.repeats)
+            print(f"{name:10s} {results[name]['seconds_median']:8.3f}s  peak {results[name]['peak_traced_mb']:8.1f} MB")
+    if 'api' in selected:
+        config.update(api_requests=args.api_requests, api_concurrency=args.api_concurrency)
+        for name, result in bench_api(df, args.api_requests, args.api_concurrency).items():
+            results[name] = result
+            print(f"{name:55s} {result['requests_per_second']:8.0f} req/s  p95 {result['latency_ms_p95']:.2f} ms")
+
+    report = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_commit': _git_commit(),
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'n_ideas': len(df),
+            # ru_maxrss is in kilobytes on Linux and bytes on macOS
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10),
+        },
+        'config': config,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_reports(report, json.load(f))
+
+
+# Guarded so that worker processes started by the process pool do not rerun the benchmarks
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,672 @@
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Header, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-import pandas as pd
+from fastapi.middleware.gzip import GZipMiddleware
+import fcntl
+import functools
+import hashlib
+import hmac
+import json
+import mmap
+import os
 import random
+import resource
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from collections import Counter
+
+# orjson is much faster than the standard library encoder; fall back to json if it is not installed
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
 # --- Configuration ---
-CSV_PATH = "/data/iriss_trial_data.csv"  # your CSV file with a column "use"
+# The stimulus paths can be overridden with environment variables (e.g. for benchmarks on synthetic data)
+CSV_PATH = os.environ.get("STIMULUS_CSV_PATH", "/data/iriss_trial_data.csv")  # your CSV file with a column "use"
+SNAPSHOT_PATH = os.environ.get("STIMULUS_SNAPSHOT_PATH", "/data/iriss_trial_data.snapshot")  # binary snapshot of the CSV, memory-mapped by every worker
+RELOAD_CHECK_SECONDS = 2.0  # how often each worker's background thread checks whether the CSV or the snapshot changed
+ADMIN_TOKEN = os.environ.get("STIMULUS_ADMIN_TOKEN")  # bearer token required by POST /reload; reloading is disabled when unset
+GZIP_MIN_BYTES = 4096  # gzip responses larger than this when the client accepts it
+# SQLite database of balanced-mode exposure counts, shared by all workers and kept across restarts
+EXPOSURE_DB_PATH = os.environ.get("STIMULUS_EXPOSURE_DB", SNAPSHOT_PATH + ".exposure.sqlite")
+PROFILER_ENABLED = os.environ.get("STIMULUS_PROFILER") == "1"  # expose /profiler/start and /profiler/stop
+
+# Fields returned by each endpoint; every row is pre-serialized once for each of them
+SAMPLE_FIELDS = ("use", "condition", "ResponseId")
+STRATIFIED_FIELDS = ("use", "condition", "object", "ResponseId")
+
+# --- Stimulus snapshot ---
+# The CSV is compiled once into a binary snapshot: the pre-serialized JSON fragment of every row
+# for each endpoint, an offset table per field set, the row offsets grouped by object category,
+# the (condition, object) cell of every row, and a JSON footer with the section positions, the
+# category and cell labels and a content hash identifying the stimulus set. Per-row data is stored
+# as packed integers, so workers memory-map the snapshot read-only, share one copy of the data
+# through the page cache and start without parsing the CSV or building per-row Python lists.
+SNAPSHOT_MAGIC = b"STIMSNP3"
+_FOOTER = struct.Struct("<Q8s")  # footer length, magic
+
+
+def build_snapshot(csv_path, snapshot_path):
+    """Parse the stimulus CSV and atomically write its snapshot."""
+    # Imported here: workers that open an existing snapshot never need pandas
+    import pandas as pd
+
+    df = pd.read_csv(csv_path)
+    if "use" not in df.columns:
+        raise ValueError("CSV must contain a 'use' column")
+    n_rows = len(df)
+
+    # Plain Python values per column; missing values (and missing columns) become None
+    columns = {
+        column: df[column].astype(object).where(df[column].notna(), None).tolist()
+        if column in df.columns else [None] * n_rows
+        for column in ("use", "condition", "object", "ResponseId")
+    }
+
+    # Row offsets per object category, in order of first appearance (same order as df["object"].unique()),
+    # and per (condition, object) cell for balanced sampling
+    rows_by_object = {}
+    cells = {}
+    for offset, (condition, category) in enumerate(zip(columns["condition"], columns["object"])):
+        rows_by_object.setdefault(category, []).append(offset)
+        cells.setdefault((condition, category), []).append(offset)
+
+    tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    sections = {}
+    # The stratified fragments hold every field, so their hash identifies the stimulus set and its row order
+    version = hashlib.blake2b(digest_size=16)
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        for fields in (SAMPLE_FIELDS, STRATIFIED_FIELDS):
+            fragments = [
+                dumps({field: columns[field][i] for field in fields})
+                for i in range(n_rows)
+            ]
+            ends = [0]
+            for fragment in fragments:
+                ends.append(ends[-1] + len(fragment))
+            table_start = f.tell()
+            f.write(struct.pack(f"<{n_rows + 1}q", *ends))
+            blob_start = f.tell()
+            f.writelines(fragments)
+            sections[",".join(fields)] = {"table": table_start, "blob": blob_start}
+            if fields == STRATIFIED_FIELDS:
+                for fragment in fragments:
+                    version.update(fragment)
+                    version.update(b"\n")
+
+        # Row offsets of each object category, stored one category after the other
+        objects = []
+        object_rows_start = f.tell()
+        position = 0
+        for category, offsets in rows_by_object.items():
+            f.write(struct.pack(f"<{len(offsets)}q", *offsets))
+            objects.append([category, position, position + len(offsets)])
+            position += len(offsets)
+
+        # Cell number of every row
+        cell_of_row = [0] * n_rows
+        for cell_id, offsets in enumerate(cells.values()):
+            for offset in offsets:
+                cell_of_row[offset] = cell_id
+        cell_of_row_start = f.tell()
+        f.write(struct.pack(f"<{n_rows}i", *cell_of_row))
+
+        footer = json.dumps({
+            "n_rows": n_rows,
+            "version": version.hexdigest(),
+            "source_mtime_ns": os.stat(csv_path).st_mtime_ns,
+            "sections": sections,
+            "objects": objects,
+            "object_rows": object_rows_start,
+            "cells": [[condition, category] for condition, category in cells],
+            "cell_of_row": cell_of_row_start,
+        }).encode("utf-8")
+        f.write(footer)
+        f.write(_FOOTER.pack(len(footer), SNAPSHOT_MAGIC))
+    os.replace(tmp_path, snapshot_path)
+
+
+def _read_footer(f, size, snapshot_path):
+    """Read the JSON footer of an open snapshot file (f supports seek/read, or is an mmap)."""
+    f.seek(size - _FOOTER.size)
+    footer_length, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+    f.seek(0)
+    if magic != SNAPSHOT_MAGIC or f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        raise ValueError(f"{snapshot_path} is not a stimulus snapshot")
+    f.seek(size - _FOOTER.size - footer_length)
+    return json.loads(f.read(footer_length))
+
+
+def _snapshot_is_current(csv_path, snapshot_path):
+    # Reads only the footer; the file is closed again before returning
+    try:
+        with open(snapshot_path, "rb") as f:
+            footer = _read_footer(f, os.fstat(f.fileno()).st_size, snapshot_path)
+        source_mtime_ns = footer["source_mtime_ns"]
+    except (OSError, ValueError, KeyError, struct.error):
+        # Missing, or written by an older version of this module
+        return False
+    return not os.path.exists(csv_path) or os.stat(csv_path).st_mtime_ns == source_mtime_ns
+
+
+def build_snapshot_once(csv_path, snapshot_path, force=False):
+    """
+    Build the snapshot unless it is already current, holding a file lock so only one process builds.
+
+    Workers that wait for the lock find the snapshot that the first one wrote and skip the build.
+    With force=True the snapshot is rebuilt even if its CSV is unchanged.
+    """
+    with open(snapshot_path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if force or not _snapshot_is_current(csv_path, snapshot_path):
+                build_snapshot(csv_path, snapshot_path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class StimulusIndex:
+    """
+    Read-only view of a memory-mapped stimulus snapshot, so requests never touch pandas.
+
+    Each object category keeps the list of row offsets that belong to it, and every row is stored
+    as JSON bytes once per field set. Sampling therefore costs O(n) in the number of rows drawn,
+    and a response is assembled by joining the fragments of the sampled rows.
+    """
+
+    def __init__(self, snapshot_path):
+        with open(snapshot_path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Identifies this version of the snapshot file (a swapped-in file has a new inode)
+        self.file_id = (stat.st_ino, stat.st_mtime_ns)
+
+        footer = _read_footer(self._mm, len(self._mm), snapshot_path)
+
+        self.n_rows = footer["n_rows"]
+        self.version = footer["version"]
+        self.source_mtime_ns = footer["source_mtime_ns"]
+        # Zero-copy views of the per-row integer sections, the offset tables and the fragment blobs
+        view = memoryview(self._mm)
+        object_rows = view[footer["object_rows"]:footer["object_rows"] + 8 * self.n_rows].cast("q")
+        self.rows_by_object = {category: object_rows[start:stop] for category, start, stop in footer["objects"]}
+        # (condition, object) cell of every row, for the per-cell served counters in /metrics
+        self.cells = [(condition, category) for condition, category in footer["cells"]]
+        self.cell_of_row = view[footer["cell_of_row"]:footer["cell_of_row"] + 4 * self.n_rows].cast("i")
+        self._sections = {}
+        for fields in (SAMPLE_FIELDS, STRATIFIED_FIELDS):
+            section = footer["sections"][",".join(fields)]
+            table = view[section["table"]:section["table"] + 8 * (self.n_rows + 1)].cast("q")
+            self._sections[fields] = (table, section["blob"])
+
+    @functools.cached_property
+    def rows_by_cell(self):
+        """Row offsets of each (condition, object) cell, built on first use."""
+        rows = {}
+        for offsets in self.rows_by_object.values():
+            for offset in offsets:
+                rows.setdefault(self.cells[self.cell_of_row[offset]], []).append(offset)
+        return rows
+
+    def row_keys(self):
+        """
+        Stable 63-bit key of every row, from its use, condition, object and ResponseId.
+
+        Identical rows are told apart by their occurrence number, so keys are unique within a snapshot.
+        """
+        table, blob = self._sections[STRATIFIED_FIELDS]
+        seen = Counter()
+        keys = []
+        for i in range(self.n_rows):
+            fragment = self._mm[blob + table[i]:blob + table[i + 1]]
+            seen[fragment] += 1
+            digest = hashlib.blake2b(fragment + b"#%d" % seen[fragment], digest_size=8).digest()
+            keys.append(int.from_bytes(digest, "little") >> 1)
+        return keys
+
+    def rows_json(self, offsets, fields):
+        """Return the JSON array (as bytes) of the pre-serialized rows at the given offsets."""
+        table, blob = self._sections[fields]
+        mm = self._mm
+        return b"[" + b",".join([mm[blob + table[i]:blob + table[i + 1]] for i in offsets]) + b"]"
+
+
+# --- Exposure tracking for balanced sampling ---
+# Stimulus sets kept in the exposure database: the current one and the one before it, which
+# workers that have not yet noticed a reload keep drawing from for up to RELOAD_CHECK_SECONDS
+KEPT_STIMULUS_SETS = 2
+
+
+class ExposureDatabase:
+    """
+    The SQLite database of exposure counts, with one connection per process.
+
+    Every ExposureTracker of a worker (one per stimulus set it has opened) shares this connection,
+    so swapping in a new stimulus set opens no new connection; close() closes it on shutdown.
+    """
+
+    def __init__(self, db_path=EXPOSURE_DB_PATH):
+        self.db_path = db_path
+        # Shared by the request threads of this process
+        self.lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def connect(self):
+        """Return this process's connection; call with self.lock held."""
+        # A connection must not be shared with a forked child, so reconnect in a new process
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            # Counts written by an older layout (without cells) cannot be reused
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(exposure)")}
+            if columns and "cell" not in columns:
+                connection.execute("DROP TABLE exposure")
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    snapshot TEXT PRIMARY KEY,
+                    registered REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS exposure (
+                    snapshot TEXT NOT NULL,
+                    row_offset INTEGER NOT NULL,
+                    row_key INTEGER NOT NULL,
+                    object INTEGER NOT NULL,
+                    cell INTEGER NOT NULL,
+                    served INTEGER NOT NULL,
+                    tie INTEGER NOT NULL,
+                    PRIMARY KEY (snapshot, row_offset)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS exposure_order ON exposure (snapshot, served, tie);
+                CREATE INDEX IF NOT EXISTS exposure_object_order ON exposure (snapshot, object, served, tie);
+                CREATE INDEX IF NOT EXISTS exposure_cell_order ON exposure (snapshot, cell, served, tie);
+                CREATE INDEX IF NOT EXISTS exposure_row_key ON exposure (row_key);
+            """)
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def close(self):
+        with self.lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+class ExposureTracker:
+    """
+    Serves the least-exposed stimuli so every idea reaches its rating quota with fewer raters.
+
+    Counts live in one SQLite database shared by all worker processes, so balancing holds across
+    the whole deployment and survives restarts. Entries are keyed by the snapshot's content hash
+    and the row offset, so a different stimulus set never inherits counts, even with the same
+    number of rows. When a new stimulus set is registered, rows whose use, condition, object and
+    ResponseId are unchanged start from their count in the previous set, and sets older than that
+    are deleted, so the database holds at most KEPT_STIMULUS_SETS sets. Indexes on (times served,
+    random tie-breaker), overall, per object category and per (condition, object) cell, make
+    drawing k rows an O(k log n) index scan. The draw and the increments run in one write
+    transaction, so two workers never hand out the same least-exposed rows as if unserved.
+    """
+
+    def __init__(self, index, database):
+        self.version = index.version
+        self.database = database
+        self.object_ids = {category: i for i, category in enumerate(index.rows_by_object)}
+        self.cell_ids = {cell: i for i, cell in enumerate(index.cells)}
+
+        with database.lock:
+            connection = database.connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                # The first worker to open a stimulus set registers its rows; the others find them
+                if connection.execute("SELECT 1 FROM snapshots WHERE snapshot = ?", (self.version,)).fetchone() is None:
+                    row_keys = index.row_keys()
+                    connection.executemany(
+                        "INSERT INTO exposure (snapshot, row_offset, row_key, object, cell, served, tie) "
+                        "VALUES (?, ?, ?, ?, ?, 0, ?)",
+                        ((self.version, offset, row_keys[offset], self.object_ids[category], index.cell_of_row[offset],
+                          random.getrandbits(62))
+                         for category, offsets in index.rows_by_object.items() for offset in offsets),
+                    )
+                    # Carry counts over from earlier stimulus sets for rows that did not change
+                    connection.execute("""
+                        UPDATE exposure SET served = (
+                            SELECT MAX(earlier.served) FROM exposure AS earlier
+                            WHERE earlier.row_key = exposure.row_key AND earlier.snapshot != exposure.snapshot
+                        )
+                        WHERE snapshot = ? AND EXISTS (
+                            SELECT 1 FROM exposure AS earlier
+                            WHERE earlier.row_key = exposure.row_key AND earlier.snapshot != exposure.snapshot
+                        )
+                    """, (self.version,))
+                    connection.execute("INSERT INTO snapshots (snapshot, registered) VALUES (?, ?)",
+                                       (self.version, time.time()))
+                    # Forget sets that no worker serves any more
+                    stale = [version for version, in connection.execute(
+                        "SELECT snapshot FROM snapshots ORDER BY registered DESC LIMIT -1 OFFSET ?",
+                        (KEPT_STIMULUS_SETS,))]
+                    connection.executemany("DELETE FROM exposure WHERE snapshot = ?", [(v,) for v in stale])
+                    connection.executemany("DELETE FROM snapshots WHERE snapshot = ?", [(v,) for v in stale])
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def draw(self, k, category=None, condition=None):
+        """
+        Return the offsets of the k least-exposed rows and count them as served.
+
+        Rows are drawn from one (condition, object) cell when both are given, from one object
+        category when only category is given, and from all rows otherwise (condition needs category).
+        """
+        if category is None:
+            query, params = "SELECT row_offset FROM exposure WHERE snapshot = ? ORDER BY served, tie LIMIT ?", (self.version, k)
+        elif condition is None:
+            query = "SELECT row_offset FROM exposure WHERE snapshot = ? AND object = ? ORDER BY served, tie LIMIT ?"
+            params = (self.version, self.object_ids[category], k)
+        elif (condition, category) in self.cell_ids:
+            query = "SELECT row_offset FROM exposure WHERE snapshot = ? AND cell = ? ORDER BY served, tie LIMIT ?"
+            params = (self.version, self.cell_ids[(condition, category)], k)
+        else:
+            return []
+        with self.database.lock:
+            connection = self.database.connect()
+            # IMMEDIATE takes the write lock up front, so concurrent draws in other workers wait
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                offsets = [offset for offset, in connection.execute(query, params)]
+                # A fresh tie-breaker spreads rows with equal counts randomly on the next draws
+                connection.executemany(
+                    "UPDATE exposure SET served = served + 1, tie = ? WHERE snapshot = ? AND row_offset = ?",
+                    [(random.getrandbits(62), self.version, offset) for offset in offsets],
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return offsets
+
+
+# --- Hot-reloadable stimulus store ---
+class StimulusStore:
+    """
+    Holds the current (StimulusIndex, ExposureTracker) pair and swaps in new versions atomically.
+
+    A background thread in each worker checks every RELOAD_CHECK_SECONDS whether the CSV is newer
+    than the snapshot (then one process rebuilds it, under a file lock) or whether the snapshot
+    file was replaced (then the worker re-maps it). Requests never build or wait: they get the
+    current pair, and requests already in flight keep using the version they started with; the
+    old mapping stays valid until they finish because os.replace never modifies the old file in place.
+    """
+
+    def __init__(self, csv_path, snapshot_path, check_interval=RELOAD_CHECK_SECONDS, exposure_db_path=EXPOSURE_DB_PATH):
+        self.csv_path = csv_path
+        self.snapshot_path = snapshot_path
+        self.check_interval = check_interval
+        self.exposure_db = ExposureDatabase(exposure_db_path)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher = None
+        self._state = None
+
+        build_snapshot_once(csv_path, snapshot_path)
+        self._open()
+
+    def _open(self):
+        index = StimulusIndex(self.snapshot_path)
+        # Counts are stored per stimulus set, so reopening an unchanged snapshot keeps them; all
+        # trackers of this worker share one database connection
+        self._state = (index, ExposureTracker(index, self.exposure_db))
+
+    def current(self):
+        """Return the current (index, exposure) pair."""
+        return self._state
+
+    def check(self):
+        """Rebuild the snapshot if the CSV changed and re-map it if its file was replaced."""
+        with self._lock:
+            index = self._state[0]
+            if os.path.exists(self.csv_path) and os.stat(self.csv_path).st_mtime_ns != index.source_mtime_ns:
+                build_snapshot_once(self.csv_path, self.snapshot_path)
+            stat = os.stat(self.snapshot_path)
+            if (stat.st_ino, stat.st_mtime_ns) != index.file_id:
+                self._open()
+
+    def _watch(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                # Keep serving the current version; the next check tries again
+                print(f"Stimulus reload check failed: {e!r}")
+
+    def start_watching(self):
+        """Start this worker's background reload thread (once per process)."""
+        if self._watcher is None or not self._watcher.is_alive():
+            self._stop.clear()
+            self._watcher = threading.Thread(target=self._watch, daemon=True)
+            self._watcher.start()
+
+    def stop_watching(self):
+        self._stop.set()
+
+    def close(self):
+        """Stop the reload thread and close this worker's exposure database connection."""
+        self.stop_watching()
+        self.exposure_db.close()
+
+    def reload(self):
+        """Rebuild the snapshot from the CSV and swap it in."""
+        with self._lock:
+            build_snapshot_once(self.csv_path, self.snapshot_path, force=True)
+            self._open()
+        return self._state
+
 
-# --- Load stimuli ---
-df = pd.read_csv(CSV_PATH)
-if "use" not in df.columns:
-    raise ValueError("CSV must contain a 'use' column")
+# --- Instrumentation ---
+# Request latency and sample size histograms, per-endpoint counters and per-(condition, object)
+# served counters, rendered in the Prometheus text format on /metrics. Each update is a few dict
+# operations under one lock. Values are per worker process: with several uvicorn workers, every
+# scrape reports the worker that happened to answer it.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SAMPLE_SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+METRIC_ENDPOINTS = {"/sample", "/stratified_sample", "/reload", "/metrics", "/profiler/start", "/profiler/stop"}
+_START_TIME = time.time()
+
+
+def _labels(**labels):
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in labels.values()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a label string."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self, name, help_text):
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for labels, series in sorted(self.series.items()):
+            prefix = labels[:-1] + "," if labels != "{}" else "{"
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{name}_bucket{prefix}le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{prefix}le="+Inf"}} {series[-1]}')
+            lines.append(f"{name}_sum{labels} {series[-2]}")
+            lines.append(f"{name}_count{labels} {series[-1]}")
+        return lines
+
+
+def _resident_memory_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Not Linux: fall back to the peak, which ru_maxrss reports in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Metrics:
+    """Process-wide request and sampling statistics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()  # (endpoint, method, status) -> count
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.sample_size = Histogram(SAMPLE_SIZE_BUCKETS)
+        self.served = Counter()  # (condition, object) -> rows served
+
+    def observe_request(self, endpoint, method, status, seconds):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.latency.observe(_labels(endpoint=endpoint), seconds)
+
+    def observe_sample(self, endpoint, index, offsets, balanced):
+        cell_counts = Counter(index.cell_of_row[i] for i in offsets)
+        with self._lock:
+            self.sample_size.observe(_labels(endpoint=endpoint, balanced=str(balanced).lower()), len(offsets))
+            for cell_id, count in cell_counts.items():
+                self.served[index.cells[cell_id]] += count
+
+    def render(self, index):
+        with self._lock:
+            lines = [
+                "# HELP stimulus_http_requests_total Requests by endpoint, method and status code.",
+                "# TYPE stimulus_http_requests_total counter",
+            ]
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f"stimulus_http_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {count}")
+            lines += self.latency.render("stimulus_http_request_duration_seconds",
+                                         "Request latency in seconds, including response compression.")
+            lines += self.sample_size.render("stimulus_sample_size", "Rows returned per sampling request.")
+            lines += [
+                "# HELP stimulus_served_total Rows served per condition and object.",
+                "# TYPE stimulus_served_total counter",
+            ]
+            for (condition, category), count in sorted(self.served.items(), key=lambda item: str(item[0])):
+                lines.append(f"stimulus_served_total{_labels(condition=condition, object=category)} {count}")
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        lines += [
+            "# HELP stimulus_rows Rows in the loaded stimulus set.",
+            "# TYPE stimulus_rows gauge",
+            f"stimulus_rows {index.n_rows}",
+            "# HELP process_resident_memory_bytes Resident memory size in bytes.",
+            "# TYPE process_resident_memory_bytes gauge",
+            f"process_resident_memory_bytes {_resident_memory_bytes()}",
+            "# HELP process_cpu_seconds_total Total user and system CPU time in seconds.",
+            "# TYPE process_cpu_seconds_total counter",
+            f"process_cpu_seconds_total {usage.ru_utime + usage.ru_stime}",
+            "# HELP process_start_time_seconds Start time of the process since the epoch in seconds.",
+            "# TYPE process_start_time_seconds gauge",
+            f"process_start_time_seconds {_START_TIME}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request (a plain ASGI wrapper, cheaper than BaseHTTPMiddleware)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Unknown paths share one label so scanners cannot blow up the number of series
+            endpoint = scope["path"] if scope["path"] in METRIC_ENDPOINTS else "other"
+            metrics.observe_request(endpoint, scope["method"], status, time.perf_counter() - start)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads at a fixed interval from a background thread.
+
+    The result is in collapsed-stack format (one "frame;frame;frame count" line per stack),
+    which flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.stacks = Counter()
+
+    def start(self, interval):
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self.stacks = Counter()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self, interval):
+        own_id = threading.get_ident()
+        while not self._stop.wait(interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return None
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+profiler = SamplingProfiler()
+
+
+store = StimulusStore(CSV_PATH, SNAPSHOT_PATH)
 
 # --- Initialize app ---
 app = FastAPI(title="Creativity Stimulus Sampler")
@@ -23,62 +680,129 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large responses (e.g. big stratified samples) for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_BYTES)
+
+# Added last so it is the outermost middleware and times the whole request
+app.add_middleware(MetricsMiddleware)
+
+
+def json_response(body):
+    """Send already-encoded JSON bytes without going through FastAPI's encoder."""
+    return Response(content=body, media_type="application/json")
+
 # --- Endpoint: get N random uses ---
 @app.get("/sample")
-def get_random_uses(n: int = Query(10, ge=1, le=100)):
-    """Return n randomly sampled uses from the CSV with their conditions."""
-    # Get random indices using random.sample
-    available_indices = list(range(len(df)))
-    sampled_indices = random.sample(available_indices, min(n, len(df)))
-    
-    # Get the rows at those indices and return both use and condition
-    sample_data = [
-        {
-            "use": df.iloc[i]["use"],
-            "condition": df.iloc[i]["condition"],
-            "ResponseId": df.iloc[i]["ResponseId"]
-        }
-        for i in sampled_indices
-    ]
+def get_random_uses(n: int = Query(10, ge=1, le=100), balanced: bool = Query(False)):
+    """Return n randomly sampled uses from the CSV with their conditions.
+
+    With balanced=true, the n least-exposed uses are returned instead of a uniform sample.
+    """
+    index, exposure = store.current()
+    if balanced:
+        sampled_indices = exposure.draw(n)
+    else:
+        # Sampling from a range draws n offsets without building a list of all rows
+        sampled_indices = random.sample(range(index.n_rows), min(n, index.n_rows))
+    metrics.observe_sample("/sample", index, sampled_indices, balanced)
     
-    return {"uses": sample_data}
+    # Join the pre-serialized rows at those offsets (use, condition and ResponseId)
+    return json_response(b'{"uses":' + index.rows_json(sampled_indices, SAMPLE_FIELDS) + b"}")
 
 # --- Endpoint: get stratified sample ---
 @app.get("/stratified_sample")
-def get_stratified_sample(n_per_category: int = Query(5, ge=1, le=50)):
-    """Return n randomly sampled uses from each object category with conditions."""
-    result = {}
-    
-    # Get unique object categories
-    categories = df["object"].unique()
+def get_stratified_sample(n_per_category: int = Query(5, ge=1, le=50), balanced: bool = Query(False),
+                          condition: str = Query(None)):
+    """Return n randomly sampled uses from each object category with conditions.
+
+    With balanced=true, the least-exposed uses of each object category are returned.
+    With condition, only uses from that condition are sampled.
+    """
+    index, exposure = store.current()
+    parts = []
+    total_samples = 0
+    served = []
     
-    for category in categories:
-        # Filter data for this category
-        category_data = df[df["object"] == category]
-        
-        # Use random.sample to get random indices from this category
-        available_indices = list(category_data.index)
-        n_samples = min(n_per_category, len(category_data))
-        sampled_indices = random.sample(available_indices, n_samples)
+    # Object categories and their row offsets were precomputed in the snapshot
+    for category, offsets in index.rows_by_object.items():
+        if condition is not None:
+            offsets = index.rows_by_cell.get((condition, category), [])
+        n_samples = min(n_per_category, len(offsets))
+        if balanced:
+            sampled_indices = exposure.draw(n_samples, category, condition)
+        else:
+            sampled_indices = random.sample(offsets, n_samples)
+        total_samples += len(sampled_indices)
+        served.extend(sampled_indices)
         
         # Return both use and condition for each sample
-        sample_data = [
-            {
-                "use": df.loc[i, "use"],
-                "condition": df.loc[i, "condition"],
-                "object": df.loc[i, "object"],
-                "ResponseId": df.loc[i, "ResponseId"]
-            }
-            for i in sampled_indices
-        ]
-        
-        result[category] = sample_data
+        parts.append(dumps(str(category)) + b":" + index.rows_json(sampled_indices, STRATIFIED_FIELDS))
     
     # Add summary information
-    result["summary"] = {
-        "categories_found": len(categories),
+    summary = {
+        "categories_found": len(index.rows_by_object),
         "samples_per_category": n_per_category,
-        "total_samples": sum(len(uses) for uses in result.values() if isinstance(uses, list))
+        "total_samples": total_samples
     }
+    parts.append(b'"summary":' + dumps(summary))
+    metrics.observe_sample("/stratified_sample", index, served, balanced)
     
-    return result
+    return json_response(b"{" + b",".join(parts) + b"}")
+
+
+@app.on_event("startup")
+def start_reload_watcher():
+    """Start this worker's background check for a changed CSV or snapshot."""
+    store.start_watching()
+
+
+# --- Endpoint: swap in a new stimulus set ---
+@app.post("/reload")
+def reload_stimuli(authorization: str = Header(None)):
+    """Rebuild the snapshot from CSV_PATH and swap it in without restarting the server.
+
+    Requires the header "Authorization: Bearer <STIMULUS_ADMIN_TOKEN>"; without a configured
+    token the endpoint is disabled. Other workers pick up the new snapshot within RELOAD_CHECK_SECONDS.
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Reload is disabled; set STIMULUS_ADMIN_TOKEN")
+    if authorization is None or not hmac.compare_digest(authorization.encode("utf-8"), f"Bearer {ADMIN_TOKEN}".encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+    index, _ = store.reload()
+    return {"rows": index.n_rows, "categories_found": len(index.rows_by_object)}
+
+
+@app.on_event("shutdown")
+def close_exposure_counts():
+    """Stop the reload thread and close this worker's connection to the exposure database (counts are already committed)."""
+    store.close()
+
+
+# --- Endpoint: Prometheus metrics ---
+@app.get("/metrics")
+def get_metrics():
+    """Request, sampling and process metrics of this worker in the Prometheus text format."""
+    index, _ = store.current()
+    return Response(content=metrics.render(index), media_type="text/plain; version=0.0.4")
+
+
+# --- Endpoints: sampling profiler (only with STIMULUS_PROFILER=1) ---
+@app.post("/profiler/start")
+def start_profiler(interval_ms: float = Query(5.0, ge=1.0, le=1000.0)):
+    """Start sampling the stacks of this worker every interval_ms milliseconds."""
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler is disabled; set STIMULUS_PROFILER=1")
+    if not profiler.start(interval_ms / 1000):
+        raise HTTPException(status_code=409, detail="Profiler is already running")
+    return {"status": "started", "interval_ms": interval_ms}
+
+
+@app.post("/profiler/stop")
+def stop_profiler():
+    """Stop the profiler and return the sampled stacks in collapsed-stack format."""
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler is disabled; set STIMULUS_PROFILER=1")
+    stacks = profiler.stop()
+    if stacks is None:
+        raise HTTPException(status_code=409, detail="Profiler is not running")
+    return Response(content=stacks, media_type="text/plain")
@@ -0,0 +1,14 @@
+# Shared fixtures. Run from the repository root with: python -m pytest
+import pytest
+
+from analyses.iriss import encoders
+from analyses.iriss.embedding_store import DEFAULT_MODEL
+from benchmarks.run_benchmarks import StubEncoder
+
+
+@pytest.fixture
+def stub_encoder(monkeypatch):
+    """Replace the default sentence encoder with the benchmarks' deterministic stub (no model download)."""
+    encoder = StubEncoder(dim=16)
+    monkeypatch.setitem(encoders._ENCODERS, (DEFAULT_MODEL, 'torch'), encoder)
+    return encoder
@@ -0,0 +1,77 @@
+import importlib
+import os
+import sqlite3
+import sys
+
+import pandas as pd
+import pytest
+
+
+def _write_stimuli(path, n_per_cell=6, tag=''):
+    rows = [{'use': f"{condition} {category} idea {i}{tag}", 'condition': condition, 'object': category,
+             'ResponseId': f"R{i}"}
+            for condition in ('control', 'pilot') for category in ('brick', 'cup') for i in range(n_per_cell)]
+    pd.DataFrame(rows).to_csv(path, index=False)
+    # Reloads notice a changed CSV by its modification time
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    _write_stimuli(tmp_path / 'stimuli.csv')
+    monkeypatch.setenv('STIMULUS_CSV_PATH', str(tmp_path / 'stimuli.csv'))
+    monkeypatch.setenv('STIMULUS_SNAPSHOT_PATH', str(tmp_path / 'stimuli.snapshot'))
+    sys.modules.pop('creative_uses_api.app', None)
+    module = importlib.import_module('creative_uses_api.app')
+    yield module
+    module.store.close()
+    sys.modules.pop('creative_uses_api.app', None)
+
+
+def _exposure_sets(module):
+    with sqlite3.connect(module.EXPOSURE_DB_PATH) as connection:
+        return [version for version, in connection.execute("SELECT DISTINCT snapshot FROM exposure")]
+
+
+def test_reloads_keep_two_stimulus_sets_and_one_connection(api, tmp_path):
+    database = api.store.exposure_db
+    versions = [api.store.current()[0].version]
+    for tag in ('a', 'b', 'c'):
+        _write_stimuli(tmp_path / 'stimuli.csv', tag=tag)
+        index, tracker = api.store.reload()
+        versions.append(index.version)
+        assert tracker.database is database
+    assert sorted(_exposure_sets(api)) == sorted(versions[-2:])
+
+    connection = database._connection
+    api.store.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        connection.execute("SELECT 1")
+
+
+def test_balanced_draws_per_condition_and_object(api):
+    _, tracker = api.store.current()
+    served = [tracker.draw(2, 'brick', 'pilot') for _ in range(3)]
+    index = api.store.current()[0]
+    cells = {index.cells[index.cell_of_row[offset]] for draw in served for offset in draw}
+    assert cells == {('pilot', 'brick')}
+    # Three draws of two from a cell of six serve every row once
+    assert sorted(offset for draw in served for offset in draw) == sorted(index.rows_by_cell[('pilot', 'brick')])
+
+
+def test_stratified_sample_filters_by_condition(api):
+    from fastapi.testclient import TestClient
+
+    with TestClient(api.app) as client:
+        for balanced in ('false', 'true'):
+            body = client.get(f"/stratified_sample?n_per_category=3&condition=control&balanced={balanced}").json()
+            for category in ('brick', 'cup'):
+                assert [row['condition'] for row in body[category]] == ['control'] * 3
+
+
+def test_snapshot_check_closes_the_file(api):
+    descriptors = len(os.listdir('/proc/self/fd'))
+    for _ in range(20):
+        assert api._snapshot_is_current(api.CSV_PATH, api.SNAPSHOT_PATH)
+    assert len(os.listdir('/proc/self/fd')) == descriptors
@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+
+from analyses.iriss.doshi_analysis import doshi_similarities
+
+
+def _cosine(a, b):
+    return a @ b / (np.linalg.norm(a) * np.linalg.norm(b))
+
+
+def test_missing_submitter_is_left_out_of_its_own_centroid():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'condition': ['a'] * 6,
+        'object': ['brick'] * 6,
+        'submitter_id': ['s1', 's1', 's2', None, None, 's3'],
+        'use': [f"idea {i}" for i in range(6)],
+    })
+    embeddings = rng.normal(size=(6, 8))
+
+    result = doshi_similarities(df, embeddings)
+
+    for row in range(6):
+        # Other submitters' ideas; a missing submitter is only its own submitter
+        submitter = df['submitter_id'][row]
+        others = [i for i in range(6) if i != row and (pd.isna(submitter) or df['submitter_id'][i] != submitter)]
+        expected = _cosine(embeddings[row], embeddings[others].mean(axis=0))
+        np.testing.assert_allclose(result[row], expected)
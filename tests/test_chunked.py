@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+from analyses.iriss.centroid_engine import leave_submitter_out_similarity
+from analyses.iriss.chunked import KeyCodes, chunked_centroid_similarity
+
+
+def test_encode_chunk_with_only_missing_keys():
+    chunk = pd.DataFrame({'condition': ['a', 'b'], 'object': ['brick', 'brick'],
+                          'submitter_id': pd.array([pd.NA, pd.NA], dtype='string')})
+    codes = KeyCodes().encode(chunk, ['condition', 'object', 'submitter_id'])
+    assert codes.tolist() == [-1, -1]
+
+
+def test_submitter_exclusion_with_a_chunk_of_missing_submitters(tmp_path, stub_encoder):
+    # With chunk_rows=4 the middle chunk has no submitter_id at all
+    df = pd.DataFrame({
+        'condition': ['a'] * 12,
+        'object': ['brick', 'cup'] * 6,
+        'submitter_id': ['s1', 's2', 's1', 's2', None, None, None, None, 's3', 's3', 's1', 's2'],
+        'use': [f"word{i} word{i % 3}" for i in range(12)],
+    })
+    df.to_csv(tmp_path / 'ideas.csv', index=False)
+
+    chunked_centroid_similarity([str(tmp_path / 'ideas.csv')], str(tmp_path / 'embeddings.npy'),
+                                str(tmp_path / 'out.csv'), exclude='submitter', chunk_rows=4,
+                                cache_path=str(tmp_path / 'cache.sqlite'))
+
+    embeddings = np.load(tmp_path / 'embeddings.npy')
+    expected = leave_submitter_out_similarity(embeddings, df.groupby(['condition', 'object']).ngroup().to_numpy(),
+                                              df.groupby('submitter_id').ngroup().to_numpy())
+    result = pd.read_csv(tmp_path / 'out.csv')['similarity_to_cond_obj'].to_numpy()
+    np.testing.assert_allclose(result, expected, equal_nan=True)
@@ -0,0 +1,84 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from analyses.iriss.incremental import IncrementalHomogeneity
+
+
+def _batch(rng, n, submitters):
+    return pd.DataFrame({
+        'condition': rng.choice(['a', 'b'], n),
+        'object': rng.choice(['brick', 'cup'], n),
+        'submitter_id': pd.array(rng.choice(submitters, n), dtype='string'),
+    })
+
+
+def _different_submitter_pairs(df):
+    # Brute force: ideas without a submitter are their own submitter
+    submitters = df['submitter_id'].astype(object).to_numpy()
+    submitters = np.where(pd.isna(submitters), [f"missing{i}" for i in range(len(df))], submitters)
+    counts = {}
+    for (condition, _), group in df.groupby(['condition', 'object']):
+        s = submitters[group.index.to_numpy()]
+        same = s[:, None] == s[None, :]
+        counts[condition] = counts.get(condition, 0) + int((~same).sum() // 2)
+    return counts
+
+
+def test_batch_of_only_missing_submitters():
+    rng = np.random.default_rng(0)
+    batches = [_batch(rng, 30, ['s1', 's2', 's3']), _batch(rng, 10, [None]), _batch(rng, 20, ['s1', 's4', None])]
+    embeddings = [rng.normal(size=(len(batch), 8)) for batch in batches]
+
+    state = IncrementalHomogeneity(8)
+    for batch, batch_embeddings in zip(batches, embeddings):
+        scored = state.add(batch, batch_embeddings)
+    assert scored['similarity_to_cond_obj'].notna().any()
+
+    counts = state.pairwise_summary().summary(include_count=True)['count'].to_dict()
+    assert counts == _different_submitter_pairs(pd.concat(batches, ignore_index=True))
+
+
+def test_saved_state_keeps_vectors_out_of_the_pickle(tmp_path, monkeypatch):
+    rng = np.random.default_rng(1)
+    batches = [_batch(rng, 40, ['s1', 's2', 's3', None]) for _ in range(3)]
+    batches.append(_batch(rng, 200, ['s1', 's2', 's3']))
+    embeddings = [rng.normal(size=(len(batch), 8)) for batch in batches]
+    path = str(tmp_path / 'state.pkl')
+
+    in_memory = IncrementalHomogeneity(8)
+    for batch, batch_embeddings in zip(batches, embeddings):
+        in_memory.add(batch, batch_embeddings)
+
+    state = IncrementalHomogeneity(8)
+    for batch, batch_embeddings in zip(batches[:2], embeddings[:2]):
+        state.add(batch, batch_embeddings)
+        state.save(path)
+        state = IncrementalHomogeneity.load(path)
+
+    # A crash after the vectors were appended but before the state was written: the rows are cut off
+    crashed = IncrementalHomogeneity.load(path)
+    crashed.add(batches[2], embeddings[2])
+    with monkeypatch.context() as patch:
+        patch.setattr(pickle, 'dump', lambda *args, **kwargs: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            crashed.save(path)
+    state = IncrementalHomogeneity.load(path)
+    state.add(batches[2], embeddings[2])
+    state.save(path)
+
+    # Known submitters only: the pickle stays the same size while the vector file grows
+    pickle_size = os.path.getsize(path)
+    state = IncrementalHomogeneity.load(path)
+    state.add(batches[3], embeddings[3])
+    state.save(path)
+    assert os.path.getsize(path) - pickle_size < 200
+    assert np.load(path + '.vectors.npy', mmap_mode='r').shape == (sum(map(len, batches)), 8)
+
+    state = IncrementalHomogeneity.load(path)
+    for summary in ('pairwise_summary', 'person_summary'):
+        expected = getattr(in_memory, summary)().summary(include_count=True)
+        pd.testing.assert_frame_equal(getattr(state, summary)().summary(include_count=True), expected)
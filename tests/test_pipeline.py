@@ -0,0 +1,24 @@
+import glob
+import os
+
+import pandas as pd
+
+from analyses.iriss.pipeline import Pipeline
+from benchmarks.run_benchmarks import synthetic_corpus
+
+
+def test_artifact_without_hash_is_recomputed(tmp_path, stub_encoder, capsys):
+    synthetic_corpus(2, 2, 4, 3).to_csv(tmp_path / 'ideas.csv', index=False)
+    params = {'data_path': str(tmp_path / 'ideas.csv'), 'embedding_cache': str(tmp_path / 'cache.sqlite'),
+              'n_workers': 1}
+    cache_dir = str(tmp_path / 'cache')
+    first = pd.read_pickle(Pipeline(cache_dir, params).run()['summary'])
+
+    # A crash between writing an artifact and its hash leaves the artifact alone
+    for sidecar in glob.glob(os.path.join(cache_dir, 'centroids-*.sha256')):
+        os.remove(sidecar)
+    capsys.readouterr()
+    second = pd.read_pickle(Pipeline(cache_dir, params).run()['summary'])
+
+    assert '[running]  centroids' in capsys.readouterr().out
+    pd.testing.assert_frame_equal(first, second)